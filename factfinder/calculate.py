@@ -1,31 +1,172 @@
 import importlib
+import logging
 import os
+from functools import cached_property, wraps
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from retry import retry
+from retry.api import retry_call
 
 from .download import Download
-from .median import Median
+from .median import BatchMedian
+from .memo import Memo
 from .metadata import Metadata, Variable
-from .special import *
-from .utils import get_c, get_p, get_z, rounding, write_to_cache
+from .planner import Plan
+from .special import evaluate
+from .utils import (
+    cache_lock,
+    file_fingerprint,
+    fingerprint,
+    get_c_array,
+    get_p_array,
+    get_z_array,
+    rounding,
+    write_to_cache,
+)
+
+
+def memoized(step: str):
+    """
+    decorator for the steps of Calculate, their results are cached in
+    Calculate.memo, in front of the disk cache
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, pff_variable: str, geotype: str) -> pd.DataFrame:
+            key = self.memo_key(step, pff_variable, geotype)
+            df = self.memo.get(key)
+            if df is None:
+                df = func(self, pff_variable, geotype)
+                self.memo.put(key, df)
+            return df
+
+        return wrapper
+
+    return decorator
 
 
 class Calculate:
-    def __init__(self, api_key, year, source, geography):
+    # below poverty variables, which take p, z from the associated percent variable
+    poverty_variables = ["pbwpv", "pu18bwpv", "p65plbwpv"]
+    output_columns = [
+        "census_geoid",
+        "labs_geoid",
+        "geotype",
+        "labs_geotype",
+        "pff_variable",
+        "c",
+        "e",
+        "m",
+        "p",
+        "z",
+    ]
+
+    def __init__(self, api_key, year, source, geography, memo_bytes=2 ** 30):
         self.year = year
         self.source = source
         self.geography = geography
         self.d = Download(
             api_key=api_key, year=year, source=source, geography=geography
         )
-        self.meta = Metadata(year=year, source=source)
+        self.meta = Metadata.load(year=year, source=source)
         AggregatedGeography = importlib.import_module(
             f"factfinder.geography.{geography}"
         ).AggregatedGeography
         self.geo = AggregatedGeography()
+        # In-memory cache of intermediate and final results,
+        # bounded to memo_bytes
+        self.memo = Memo(max_bytes=memo_bytes)
+
+    @cached_property
+    def version(self) -> str:
+        """
+        fingerprint of the code that goes into calculating a variable
+        """
+        path = Path(__file__).parent
+        return file_fingerprint(
+            *[
+                path / i
+                for i in [
+                    "calculate.py",
+                    "median.py",
+                    "metadata.py",
+                    "special.py",
+                    "utils.py",
+                ]
+            ]
+        )
+
+    def cache_path(self, stage: str, pff_variable: str, geotype: str, key: str) -> str:
+        """
+        returns the cache path of a calculation stage for the given
+        pff_variable and geotype. The key is a fingerprint of every input of
+        the stage, so a cache entry is only reused if none of them changed
+        """
+        return (
+            f".cache/{stage}"
+            f"/year={self.year}"
+            f"/source={self.source}"
+            f"/geography={self.geography}"
+            f"/geotype={geotype}"
+            f"/{pff_variable}-{key}.pkl"
+        )
+
+    def cache_key(self, stage: str, pff_variable: str, geotype: str) -> str:
+        """
+        returns the current key of a calculation stage ("calculate" or
+        "results") for the given pff_variable and geotype
+        """
+        if stage == "calculate":
+            return fingerprint(
+                self.meta.create_variable(pff_variable).census_variable,
+                self.d.version,
+                self.version,
+                self.geo.version if geotype in self.geo.aggregated_geography else None,
+            )
+        # Results are only recalculated if the fingerprint of the variable's
+        # metadata, the geography lookups or the code changed
+        return fingerprint(
+            self.meta.fingerprint(pff_variable),
+            self.d.version,
+            self.version,
+            self.geo.version,
+        )
+
+    def prune(self) -> list:
+        """
+        delete the cache entries of every calculation stage for the year,
+        source and geography that are not keyed by the current key of their
+        pff_variable and geotype (e.g. after the metadata or the code
+        changed), and the lock files, e.g. before the cache is saved to a
+        CI cache. Returns the deleted paths
+        """
+        deleted = []
+        for stage in ["calculate", "results"]:
+            path = Path(
+                f".cache/{stage}"
+                f"/year={self.year}"
+                f"/source={self.source}"
+                f"/geography={self.geography}"
+            )
+            for i in sorted(path.glob("geotype=*/*")):
+                pff_variable = i.name.rsplit("-", 1)[0]
+                geotype = i.parent.name[len("geotype=") :]
+                if i.suffix == ".lock" or not (
+                    pff_variable in self.meta.variables
+                    and str(i)
+                    == self.cache_path(
+                        stage,
+                        pff_variable,
+                        geotype,
+                        self.cache_key(stage, pff_variable, geotype),
+                    )
+                ):
+                    os.remove(i)
+                    deleted.append(i)
+        return deleted
 
     def calculate_e_m_multiprocessing(
         self, pff_variables: list, geotype: str
@@ -36,59 +177,180 @@ class Calculate:
         """
         dfs = []
         for pff_variable in pff_variables:
-            if pff_variable in self.meta.special_variables:
+            if pff_variable in self.meta.categories["special"]:
                 dfs.append(self.calculate_e_m_special(pff_variable, geotype))
             else:
                 dfs.append(self.calculate_e_m(pff_variable, geotype))
         return pd.concat(dfs)
 
-    def calculate_e_m(self, pff_variable: str, geotype: str) -> pd.DataFrame:
+    def from_geotype(self, geotype: str) -> str:
         """
-        Given pff_variable and geotype, download and calculate the variable
+        given a geotype, return the geotype that needs to be downloaded
+        to calculate it, e.g. "NTA" -> "tract"
         """
-        cache_path = (
-            ".cache/calculate"
-            f"/year={self.year}"
-            f"/geography={self.geography}"
-            f"/geotype={geotype}"
-            f"/{pff_variable}.pkl"
-        )
-
-        if os.path.isfile(cache_path):
-            df = pd.read_pickle(cache_path)
-        else:
-            # 0. create variable
-            v = self.meta.create_variable(pff_variable)
+        if geotype not in self.geo.aggregated_geography:
+            return geotype
+        options = self.geo.options.get(self.source)
+        for k, val in options.items():
+            if geotype in val.keys():
+                from_geotype = k
+        return from_geotype
+
+    def intermediate_geotype(self, geotype: str) -> str:
+        """
+        given a geotype, return the aggregated geotype it is aggregated from,
+        e.g. "NTA" -> "CT20", or None if it is aggregated from its from_geotype
+        """
+        options = self.geo.intermediate_options.get(self.source, {})
+        return next((k for k, val in options.items() if geotype in val), None)
 
-            # 1. Determin from and to geotype
-            to_geotype = geotype
-            if geotype not in self.geo.aggregated_geography:
-                from_geotype = geotype
+    def plan(self, pff_variables: list, geotypes: list) -> Plan:
+        """
+        returns the dependency graph of the calculations needed for the
+        given pff_variables and geotypes, which calculate_many batches
+        (calculating every intermediate result once) and can be reported on
+        """
+        return Plan(self, pff_variables, geotypes)
 
-                def aggregate_vertical(df):
-                    return df
+    def prefetch(self, geotypes: list) -> None:
+        """
+        given a list of geotypes, bulk download every variable in the
+        metadata for the geotypes they are calculated from
+        """
+        from_geotypes = set([self.from_geotype(geotype) for geotype in geotypes])
+        self.d.prefetch(sorted(from_geotypes))
 
+    @memoized("e_m")
+    def calculate_e_m(self, pff_variable: str, geotype: str) -> pd.DataFrame:
+        """
+        Given pff_variable and geotype, download and calculate the variable
+        """
+        # 0. create variable
+        v = self.meta.create_variable(pff_variable)
+        key = self.cache_key("calculate", pff_variable, geotype)
+        cache_path = self.cache_path("calculate", pff_variable, geotype, key)
+
+        # Only one process calculates a missing entry,
+        # the others wait for it and read it from the cache
+        with cache_lock(cache_path):
+            if os.path.isfile(cache_path):
+                df = pd.read_pickle(cache_path)
             else:
-                options = self.geo.options.get(self.source)
-                for k, val in options.items():
-                    if geotype in val.keys():
-                        from_geotype = k
-                aggregate_vertical = options[from_geotype][to_geotype]
+                # 1. Determin from and to geotype
+                to_geotype = geotype
+                from_geotype = self.from_geotype(geotype)
+                if geotype not in self.geo.aggregated_geography:
 
-            # 2. Download Dataframe for given geotype
-            df = self.d(from_geotype, pff_variable)
+                    def aggregate_vertical(df):
+                        return df
 
-            # 3. Aggregate by variable (horizontal) first
-            df = self.aggregate_horizontal(df, v)
+                else:
+                    options = self.geo.options.get(self.source)
+                    aggregate_vertical = options[from_geotype][to_geotype]
+
+                intermediate = self.intermediate_geotype(geotype)
+                stream_options = self.geo.stream_options.get(self.source, {})
+                if intermediate:
+                    # 2-4. Aggregate the (memoized) intermediate geotype
+                    options = self.geo.intermediate_options[self.source]
+                    df = options[intermediate][to_geotype](
+                        self.calculate_e_m(pff_variable, intermediate)
+                    )
+                elif to_geotype in stream_options.get(from_geotype, {}):
+                    # 2-4. Large geotypes are downloaded, aggregated horizontally
+                    # and vertically one chunk at a time
+                    chunks = (
+                        self.aggregate_horizontal(df, v)
+                        for df in self.d.stream(from_geotype, pff_variable)
+                    )
+                    df = stream_options[from_geotype][to_geotype](chunks)
+                else:
+                    # 2. Download Dataframe for given geotype
+                    df = self.d(from_geotype, pff_variable)
 
-            # 4. Aggregate by Geography (vertical) first
-            df = aggregate_vertical(df)
+                    # 3. Aggregate by variable (horizontal) first
+                    df = self.aggregate_horizontal(df, v)
 
-            # 5. Caching
-            os.makedirs(Path(cache_path).parent, exist_ok=True)
-            write_to_cache(df, cache_path)
+                    # 4. Aggregate by Geography (vertical) first
+                    df = aggregate_vertical(df)
+
+                # 5. Caching
+                write_to_cache(df, cache_path)
         return df
 
+    def memo_key(self, step: str, pff_variable: str, geotype: str) -> tuple:
+        return (self.year, self.source, self.geography, step, pff_variable, geotype)
+
+    def calculate_e_m_many(self, pff_variables: list, geotype: str) -> None:
+        """
+        calculate_e_m for many pff_variables at once, the results are put
+        in the memo. Variables whose census fields could not be downloaded
+        and geotypes that are streamed are left to calculate_e_m
+        """
+        from_geotype = self.from_geotype(geotype)
+        intermediate = self.intermediate_geotype(geotype)
+        stream_options = self.geo.stream_options.get(self.source, {})
+        if geotype in stream_options.get(from_geotype, {}):
+            return
+        if intermediate:
+            self.calculate_e_m_many(pff_variables, intermediate)
+            keys = [self.memo_key("e_m", i, intermediate) for i in pff_variables]
+            dfs = [self.memo.get(key) for key in keys if key in self.memo]
+            if not dfs:
+                return
+            df = pd.concat(dfs, ignore_index=True)
+            translate = self.geo.intermediate_options[self.source][intermediate]
+            df = translate[geotype](df)
+        else:
+            self.d.prefetch([from_geotype], pff_variables)
+            partitions = self.d.partitions(from_geotype)
+            fields = {}
+            for pff_variable in pff_variables:
+                E, M, _, _ = self.meta.create_variable(pff_variable).census_variables
+                if not self.d.store.missing(from_geotype, E + M, partitions):
+                    fields[pff_variable] = E + M
+            if not fields:
+                return
+            df = self.d.store.read(
+                from_geotype,
+                sorted(set(i for f in fields.values() for i in f)),
+                partitions,
+            )
+            df["geotype"] = from_geotype
+            df = self.aggregate_horizontal_many(df, list(fields))
+            if geotype in self.geo.aggregated_geography:
+                # the translators aggregate every pff_variable at once
+                df = self.geo.options[self.source][from_geotype][geotype](df)
+        for pff_variable, output in df.groupby("pff_variable", sort=False):
+            output = output.reset_index(drop=True)
+            self.memo.put(self.memo_key("e_m", pff_variable, geotype), output)
+
+    def aggregate_horizontal_many(
+        self, df: pd.DataFrame, pff_variables: list
+    ) -> pd.DataFrame:
+        """
+        same as aggregate_horizontal for many pff_variables at once, using
+        the incidence matrices of the census fields (see Metadata.incidence).
+        Returns the e and m of every pff_variable, one after the other
+        """
+        E_fields, A_E, M_fields, A_M = self.meta.incidence(pff_variables)
+        # missing values are skipped, like in the sums of aggregate_horizontal
+        e = np.nan_to_num(df[E_fields].to_numpy("float64")) @ A_E
+        m = (
+            (np.nan_to_num(df[M_fields].to_numpy("float64")) ** 2 @ A_M) ** 0.5
+            if self.source != "decennial"
+            else np.full(e.shape, np.nan)
+        )
+        return pd.DataFrame(
+            {
+                "census_geoid": np.tile(df.census_geoid.to_numpy(), len(pff_variables)),
+                "pff_variable": np.repeat(pff_variables, len(df)).astype(object),
+                "geotype": np.tile(df.geotype.to_numpy(), len(pff_variables)),
+                "e": e.T.ravel(),
+                "m": m.T.ravel(),
+            }
+        )
+
     def aggregate_horizontal(self, df: pd.DataFrame, v: Variable) -> pd.DataFrame:
         """
         this function will aggregate multiple census_variables into 1 pff_variable
@@ -106,6 +368,7 @@ class Calculate:
         # Output
         return df[["census_geoid", "pff_variable", "geotype", "e", "m"]]
 
+    @memoized("e_m_p_z")
     def calculate_e_m_p_z(self, pff_variable: str, geotype: str) -> pd.DataFrame:
         """
         This function is used for calculating profile variables only with
@@ -128,6 +391,7 @@ class Calculate:
         df = df.rename(columns=columns)
         return df[["census_geoid", "pff_variable", "geotype", "e", "m", "p", "z"]]
 
+    @memoized("median")
     def calculate_e_m_median(self, pff_variable: str, geotype: str) -> pd.DataFrame:
         """
         Given median variable in the form of pff_variable and geotype
@@ -148,26 +412,18 @@ class Calculate:
             index="census_geoid", columns="pff_variable", values=["e"]
         )
 
-        def get_median_and_median_moe(
-            ranges, row, pff_variable, DF, top_coding, bottom_coding
-        ):
-            md = Median(ranges, row, pff_variable, DF, top_coding, bottom_coding)
-            e = md.median
-            m = md.median_moe
-            return pd.Series({"e": e, "m": m})
-
-        results = df_pivoted.e.apply(
-            lambda x: get_median_and_median_moe(
-                ranges, x, pff_variable, design_factor, top_coding, bottom_coding
-            ),
-            axis=1,
+        # 4. calculate the median and median moe of all geographies at once
+        md = BatchMedian(
+            ranges, df_pivoted.e, pff_variable, design_factor, top_coding, bottom_coding
+        )
+        results = pd.DataFrame(
+            {"census_geoid": df_pivoted.index, "e": md.median, "m": md.median_moe}
         )
-        results["census_geoid"] = df_pivoted.index
-        results = results.reset_index(drop=True)
         results["pff_variable"] = pff_variable
         results["geotype"] = geotype
         return results[["census_geoid", "pff_variable", "geotype", "e", "m"]]
 
+    @memoized("poverty_p_z")
     def calculate_poverty_p_z(self, pff_variable: str, geotype: str) -> pd.DataFrame:
         """
         For below poverty vars, the percent and percent MOE are taken from the ACS,
@@ -181,20 +437,38 @@ class Calculate:
         )
         return pz
 
+    @memoized("special")
     def calculate_e_m_special(self, pff_variable: str, geotype: str) -> pd.DataFrame:
         """
         Given pff_variable and geotype, download and calculate the variable.
         Used for variables requiring special horizontal aggregation techniques.
         """
-        assert pff_variable in self.meta.special_variables
+        assert pff_variable in self.meta.categories["special"]
         base_variables = self.meta.get_special_base_variables(pff_variable)
         df = self.calculate_e_m_multiprocessing(base_variables, geotype)
-        func = globals()[pff_variable]
-        df = func(df, base_variables)
-        df["pff_variable"] = pff_variable
+        df = evaluate(df, [self.meta.formulas[pff_variable]])
         df["geotype"] = geotype
         return df[["census_geoid", "pff_variable", "geotype", "e", "m"]]
 
+    def calculate_e_m_special_many(self, pff_variables: list, geotype: str) -> None:
+        """
+        calculate_e_m_special for many pff_variables at once, the formulas
+        are evaluated in one batch over the e and m of their base variables
+        and the results are put in the memo
+        """
+        formulas = [self.meta.formulas[i] for i in pff_variables]
+        outputs = set(pff_variables)
+        base_variables = sorted(
+            set(i for f in formulas for i in f.base_variables if i not in outputs)
+        )
+        df = self.calculate_e_m_multiprocessing(base_variables, geotype)
+        df = evaluate(df, formulas)
+        df["geotype"] = geotype
+        df = df[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        for pff_variable, output in df.groupby("pff_variable", sort=False):
+            output = output.reset_index(drop=True)
+            self.memo.put(self.memo_key("special", pff_variable, geotype), output)
+
     def calculate_c_e_m_p_z(self, pff_variable: str, geotype: str) -> pd.DataFrame:
         """
         this function will calculate e, m first, then based on if the
@@ -206,12 +480,12 @@ class Calculate:
         # there's no need to calculate p, z for median variables
         v = self.meta.create_variable(pff_variable)
         if (
-            pff_variable in self.meta.profile_only_variables
+            pff_variable in self.meta.categories["profile_only"]
             and geotype not in self.geo.aggregated_geography
         ):
             df = self.calculate_e_m_p_z(pff_variable, geotype)
 
-        elif pff_variable in self.meta.median_variables:
+        elif pff_variable in self.meta.categories["median"]:
             df = (
                 self.calculate_e_m_median(pff_variable, geotype)
                 if geotype in self.geo.aggregated_geography
@@ -224,7 +498,7 @@ class Calculate:
                 self.calculate_e_m(pff_variable, geotype)
                 if not (
                     (
-                        pff_variable in self.meta.special_variables
+                        pff_variable in self.meta.categories["special"]
                         and geotype in self.geo.aggregated_geography
                     )
                     or (pff_variable == "wrkrnothm")
@@ -235,9 +509,9 @@ class Calculate:
             )
             # If pff_variable is not base_variable, then p,z
             # are calculated against the base variable e(agg_e), m(agg_m)
-            if pff_variable not in self.meta.base_variables:
+            if pff_variable not in self.meta.categories["base"]:
                 if (
-                    pff_variable in ["pbwpv", "pu18bwpv", "p65plbwpv"]
+                    pff_variable in self.poverty_variables
                     and geotype not in self.geo.aggregated_geography
                     and self.year != 2010
                 ):
@@ -245,13 +519,11 @@ class Calculate:
                     df_pz = self.calculate_poverty_p_z(pff_variable, geotype)
                     df = df.merge(df_pz, on=["census_geoid", "geotype"])
                 elif v.base_variable != "nan":
+                    # Special base variables of aggregated geotypes used to be
+                    # calculated here as well, but the result was always
+                    # overwritten below
                     if (
-                        v.base_variable in self.meta.special_variables
-                        and geotype in self.geo.aggregated_geography
-                    ):
-                        df_base = self.calculate_e_m_special(v.base_variable, geotype)
-                    if (
-                        v.base_variable in self.meta.median_variables
+                        v.base_variable in self.meta.categories["median"]
                         and geotype in self.geo.aggregated_geography
                     ):
                         df_base = self.calculate_e_m_median(v.base_variable, geotype)
@@ -266,15 +538,10 @@ class Calculate:
                         on="census_geoid",
                     )
                     del df_base
-                    df["p"] = df.apply(
-                        lambda row: get_p(row["e"], row["agg_e"]), axis=1
-                    )
+                    df["p"] = get_p_array(df["e"], df["agg_e"])
 
-                    df["z"] = df.apply(
-                        lambda row: get_z(
-                            row["e"], row["m"], row["p"], row["agg_e"], row["agg_m"]
-                        ),
-                        axis=1,
+                    df["z"] = get_z_array(
+                        df["e"], df["m"], df["p"], df["agg_e"], df["agg_m"]
                     )
                 else:
                     # special case for grnorntpd, smpntc,
@@ -287,7 +554,7 @@ class Calculate:
                 df["p"] = 100
                 df["z"] = np.nan
 
-        df["c"] = df.apply(lambda row: get_c(row["e"], row["m"]), axis=1)
+        df["c"] = get_c_array(df["e"], df["m"])
         return df[["census_geoid", "pff_variable", "geotype", "c", "e", "m", "p", "z"]]
 
     def cleaning(self, df: pd.DataFrame) -> pd.DataFrame:
@@ -310,38 +577,38 @@ class Calculate:
 
         df.loc[
             df.geotype.isin(["borough", "city"])
-            & df.pff_variable.isin(self.meta.base_variables)
+            & df.pff_variable.isin(self.meta.categories["base"])
             & df.c.isna(),
             "c",
         ] = 0
 
         df.loc[
             df.geotype.isin(["borough", "city"])
-            & df.pff_variable.isin(self.meta.base_variables)
+            & df.pff_variable.isin(self.meta.categories["base"])
             & df.m.isna(),
             "m",
         ] = 0
 
         df.loc[
-            df.pff_variable.isin(self.meta.base_variables)
-            & ~df.pff_variable.isin(self.meta.median_variables),
+            df.pff_variable.isin(self.meta.categories["base"])
+            & ~df.pff_variable.isin(self.meta.categories["median"]),
             "p",
         ] = 100
 
         df.loc[
-            df.pff_variable.isin(self.meta.base_variables)
-            & ~df.pff_variable.isin(self.meta.median_variables),
+            df.pff_variable.isin(self.meta.categories["base"])
+            & ~df.pff_variable.isin(self.meta.categories["median"]),
             "z",
         ] = 0
 
         df.loc[
-            df.pff_variable.isin(self.meta.median_inputs)
+            df.pff_variable.isin(self.meta.categories["median_inputs"])
             & ~df.pff_variable.str.contains("rms"),
             ["c", "m", "p", "z"],
         ] = pd.Series({"c": np.nan, "m": np.nan, "p": np.nan, "z": np.nan})
 
         df.loc[
-            df.pff_variable.isin(self.meta.special_variables), ["p", "z"]
+            df.pff_variable.isin(self.meta.categories["special"]), ["p", "z"]
         ] = pd.Series({"p": np.nan, "z": np.nan})
 
         # If e == 0/np.nan, then all other fields are np.nan
@@ -355,34 +622,114 @@ class Calculate:
         """
         Format geoid and geotype to match Planning Labs standards
         """
-        df["labs_geoid"] = df.census_geoid.apply(self.geo.format_geoid)
-        df["labs_geotype"] = df.geotype.apply(lambda x: self.geo.format_geotype(x))
-
-        return df[
-            [
-                "census_geoid",
-                "labs_geoid",
-                "geotype",
-                "labs_geotype",
-                "pff_variable",
-                "c",
-                "e",
-                "m",
-                "p",
-                "z",
-            ]
-        ]
+        # format every unique geoid and geotype once
+        labs_geoids = {i: self.geo.format_geoid(i) for i in df.census_geoid.unique()}
+        labs_geotypes = {i: self.geo.format_geotype(i) for i in df.geotype.unique()}
+        df["labs_geoid"] = df.census_geoid.map(labs_geoids)
+        df["labs_geotype"] = df.geotype.map(labs_geotypes)
 
-    @retry(tries=3, delay=5)
+        return df[self.output_columns]
+
+    @retry(Download.transient_errors, tries=3, delay=5)
+    @memoized("output")
     def __call__(self, pff_variable: str, geotype: str) -> pd.DataFrame:
         # 0. Initialize Variable class instance
         v = self.meta.create_variable(pff_variable)
-        # 1. get calculated values (c,e,m,p,z)
-        df = self.calculate_c_e_m_p_z(pff_variable, geotype)
-        # 2. rounding
-        df = rounding(df, v.rounding)
-        # 3. last round of data cleaning
+        key = self.cache_key("results", pff_variable, geotype)
+        cache_path = self.cache_path("results", pff_variable, geotype, key)
+        with cache_lock(cache_path):
+            if os.path.isfile(cache_path):
+                return pd.read_pickle(cache_path)
+            # 1. get calculated values (c,e,m,p,z)
+            df = self.calculate_c_e_m_p_z(pff_variable, geotype)
+            # 2. rounding
+            df = rounding(df, v.rounding)
+            # 3. last round of data cleaning
+            df = self.cleaning(df)
+            # 4. Assign Labs geoid and geotype
+            df = self.labs_geoid(df)
+            # 5. Caching
+            write_to_cache(df, cache_path)
+        return df
+
+    def calculate_many(
+        self,
+        pff_variables: list,
+        geotypes: list,
+        errors: str = "raise",
+        failures: dict = None,
+    ) -> pd.DataFrame:
+        """
+        calculate every pff_variable for every geotype, the output is the
+        same as concatenating calculate(pff_variable, geotype) for each
+        pff_variable and geotype (in that order), but rounding, cleaning
+        and labeling are done once for the whole batch.
+        Errors of the census API and the network are retried, other errors
+        are not. With errors="ignore", pairs that fail to calculate are
+        logged and left out of the output, and recorded in failures (if
+        given) as {(pff_variable, geotype): error message}
+        """
+        # the e and m of every variable the batch depends on are calculated
+        # at once for each geotype
+        known = [i for i in pff_variables if i in self.meta.variables]
+        plan = self.plan(known, geotypes)
+        for geotype in geotypes:
+            variables = sorted(
+                set(v for s, v, g in plan.graph if s == "e_m" and g == geotype)
+            )
+            try:
+                retry_call(
+                    self.calculate_e_m_many,
+                    fargs=[variables, geotype],
+                    exceptions=Download.transient_errors,
+                    tries=3,
+                    delay=5,
+                )
+            except Exception as e:
+                # left to calculate_e_m, pair by pair
+                logging.warning(f"Failed to calculate {variables}, {geotype}: {e}")
+            specials = sorted(
+                set(v for s, v, g in plan.graph if s == "special" and g == geotype)
+            )
+            if specials:
+                try:
+                    self.calculate_e_m_special_many(specials, geotype)
+                except Exception as e:
+                    # left to calculate_e_m_special, pair by pair
+                    logging.info(f"Failed to calculate {specials}, {geotype}: {e}")
+        dfs = []
+        for pff_variable in pff_variables:
+            for geotype in geotypes:
+                try:
+                    df = retry_call(
+                        self.calculate_c_e_m_p_z,
+                        fargs=[pff_variable, geotype],
+                        exceptions=Download.transient_errors,
+                        tries=3,
+                        delay=5,
+                    )
+                except Exception as e:
+                    if errors != "ignore":
+                        raise
+                    logging.warning(
+                        f"Failed to calculate {pff_variable}, {geotype}: {e}"
+                    )
+                    if failures is not None:
+                        failures[(pff_variable, geotype)] = repr(e)
+                    continue
+                dfs.append(df)
+        if not dfs:
+            # every pair failed (with errors="ignore")
+            return pd.DataFrame(columns=self.output_columns)
+        df = pd.concat(dfs)
+        # the batch is cleaned on a unique index
+        index = df.index
+        df = df.reset_index(drop=True)
+        digits = {
+            i: self.meta.create_variable(i).rounding for i in df.pff_variable.unique()
+        }
+        df = rounding(df, df.pff_variable.map(digits))
         df = self.cleaning(df)
-        # 4. Assign Labs geoid and geotype
         df = self.labs_geoid(df)
+        df.index = index
         return df
@@ -1,19 +1,64 @@
 import importlib
+import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
+import requests
 from census import Census
+from census.core import CensusException
 
 from .metadata import Metadata, Variable
-from .utils import outliers, write_to_cache
+from .store import Store
+from .transport import Transport
+from .utils import file_fingerprint, outliers
 
 
 class Download:
-    def __init__(self, api_key, year=2019, source="acs", geography=2010) -> None:
-        self.c = Census(api_key)
+    # The Census API accepts at most 50 variables per query, including NAME
+    max_fields = 49
+    # Geotypes too large to download in one piece, they are downloaded
+    # and stored one county at a time, and read back in chunks of rows
+    streaming_geotypes = {"block"}
+    chunksize = 50000
+    # Errors of the network and the census API that may not happen again
+    # when the request is retried
+    transient_errors = (requests.exceptions.RequestException, CensusException)
+
+    def __init__(
+        self,
+        api_key,
+        year=2019,
+        source="acs",
+        geography=2010,
+        concurrency=5,
+        transport=None,
+        fixtures=None,
+    ) -> None:
+        # All census clients share one keep-alive connection pool,
+        # sized to the maximum number of concurrent requests.
+        # The transport can record API responses to fixtures, or
+        # replay them without touching the network
+        transport = transport or os.environ.get("CENSUS_TRANSPORT", "live")
+        fixtures = fixtures or os.environ.get("CENSUS_FIXTURES", ".cache/transport")
+        self.concurrency = concurrency
+        self.session = requests.Session()
+        adapter = Transport(
+            mode=transport,
+            path=fixtures,
+            pool_connections=concurrency,
+            pool_maxsize=concurrency,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # No API key is needed to replay recorded responses
+        if transport == "replay" and not api_key:
+            api_key = "replay"
+        self.c = Census(api_key, session=self.session)
         self.year = year
         self.source = source
         self.state = 36
@@ -25,6 +70,17 @@ class Download:
             "P": self.c.sf1,
             "B": self.c.acs5,
         }
+        self.store = Store(year=year, source=source, version=self.version)
+        # Geotypes for which the API rejected coalesced geoqueries
+        self.split_geotypes = set()
+
+    @cached_property
+    def version(self) -> str:
+        """
+        fingerprint of the download and storage code, downloaded fields
+        are stored under it
+        """
+        return file_fingerprint(__file__, Path(__file__).parent / "store.py")
 
     @cached_property
     def geoqueries(self):
@@ -48,97 +104,278 @@ class Download:
             ],
         }
 
-    def download_variable(
-        self, download_function: callable, geotype: dict, v: Variable
-    ) -> pd.DataFrame:
-        geoqueries = self.geoqueries.get(geotype)
-        dfs = []
-        for geoquery in geoqueries:
-            dfs.append(download_function(geotype, geoquery, v))
-        return pd.concat(dfs)
-
-    def download_e_m_p_z(
-        self, geotype: str, geoquery: dict, v: Variable
-    ) -> pd.DataFrame:
-        """
-        This function is for downloading non-aggregated-geotype and data profile only
-        variables. It will return e, m, p, z variables for a single pff variable.
-        """
-        # single source (data profile) only, so safe to set a default
-        client = self.c.acs5dp
-        E, M, PE, PM = v.census_variables
-        E_variables, M_variables, PE_variables, PM_variables = E[0], M[0], PE[0], PM[0]
-        variables = [E_variables, M_variables, PE_variables, PM_variables]
-        df = pd.DataFrame(
-            client.get(("NAME", ",".join(variables)), geoquery, year=self.year)
+    @cached_property
+    def coalesced_geoqueries(self):
+        """
+        Same as geoqueries, with the five per-county geoqueries of each
+        geotype merged into a single geoquery for all counties
+        """
+        counties = ",".join(self.counties)
+        return {
+            "tract": [
+                {"for": "tract:*", "in": f"state:{self.state} county:{counties}"}
+            ],
+            "borough": [{"for": f"county:{counties}", "in": f"state:{self.state}"}],
+            "city": self.geoqueries["city"],
+            "block": [
+                {"for": "block:*", "in": f"state:{self.state} county:{counties}"}
+            ],
+            "block group": [
+                {"for": "block group:*", "in": f"state:{self.state} county:{counties}"}
+            ],
+        }
+
+    @cached_property
+    def meta(self) -> Metadata:
+        return Metadata.load(year=self.year, source=self.source)
+
+    @cached_property
+    def aggregated_geography(self):
+        AggregatedGeography = importlib.import_module(
+            f"factfinder.geography.{self.geography}"
+        ).AggregatedGeography
+        return AggregatedGeography()
+
+    def profile_only(self, geotype: str, pff_variable: str) -> bool:
+        """
+        For profile only variables with non-aggregated-geotype
+        we will get e, m, p, z directly from the data profile
+        """
+        return (
+            pff_variable in self.meta.categories["profile_only"]
+            and geotype not in self.aggregated_geography.aggregated_geography
         )
+
+    @staticmethod
+    def census_fields(v: Variable, profile_only: bool) -> dict:
+        """
+        Given a variable, return the census fields needed to download it,
+        grouped by source (the first letter of the census variable, which
+        determines the census client). e.g.
+        {"B": ["B01001_044E", "B01001_020E", "B01001_044M", "B01001_020M"]}
+        """
+        if profile_only:
+            E, M, PE, PM = v.census_variables
+            return {"D": [E[0], M[0], PE[0], PM[0]]}
+        fields = {}
+        for source in set([i[0] for i in v.census_variable]):
+            variables = [i for i in v.census_variable if i[0] == source]
+            # create_census_variables Will be deprecated eventually
+            E_variables, M_variables = v.create_census_variables(variables)
+            fields[source] = E_variables + M_variables
+        return fields
+
+    def chunks(self, fields: list) -> list:
+        """
+        Split census fields into chunks of at most max_fields, keeping the
+        E, M, PE and PM fields of a census variable in the same chunk
+        """
+        groups = {}
+        for field in fields:
+            groups.setdefault(re.sub("(PE|PM|E|M)$", "", field), []).append(field)
+        chunks = [[]]
+        for group in groups.values():
+            if len(chunks[-1]) + len(group) > self.max_fields:
+                chunks.append([])
+            chunks[-1].extend(group)
+        return [chunk for chunk in chunks if chunk]
+
+    @staticmethod
+    def clean(df: pd.DataFrame, geotype: str, fields: list) -> pd.DataFrame:
+        """
+        Enforce type safety and replace sentinel values in downloaded fields.
+        All fields are sanitized together as one float64 block with a fixed
+        number of array operations, regardless of the number of fields.
+        """
+        values = df[fields].astype("float64").to_numpy(copy=True)
+        # Pair up the E and M columns of each census variable
+        E_index = [
+            i
+            for i, E in enumerate(fields)
+            if E.endswith("E") and not E.endswith("PE") and E[:-1] + "M" in fields
+        ]
+        M_index = [fields.index(fields[i][:-1] + "M") for i in E_index]
+        E, M = values[:, E_index], values[:, M_index]
+        # If E is zero, then set M as zero
+        M[E == 0] = 0
         # If E is an outlier, then set M as Nan
-        for var in variables:  # Enforce type safety
-            df[var] = df[var].astype("float64")
-        df.loc[df[E_variables].isin(outliers), M_variables] = np.nan
-        df.loc[df[E_variables] == 0, M_variables] = 0
+        M[np.isin(E, outliers)] = np.nan
+        values[:, M_index] = M
         # 555555555 indicates controled value,
         # for city and borough, we will set it to 0
         if geotype in ("city", "borough"):
-            df.loc[df[M_variables].isin([-555555555, 555555555]), M_variables] = 0
-            df.loc[df[PM_variables].isin([-555555555, 555555555]), PM_variables] = 0
+            M_index = [i for i, M in enumerate(fields) if M.endswith("M")]
+            M = values[:, M_index]
+            M[np.isin(M, [-555555555, 555555555])] = 0
+            values[:, M_index] = M
         # Replace all outliers as Nan
-        df = df.replace(outliers, np.nan)
+        values[np.isin(values, outliers)] = np.nan
+        df[fields] = values
         return df
 
-    def download_e_m(self, geotype: str, geoquery: dict, v: Variable) -> pd.DataFrame:
+    def partitions(self, geotype: str) -> list:
         """
-        this function works in conjunction with download_variable,
-        and is only created to facilitate multiprocessing, this function
-        if for generic variable calculation, returns e, m
+        returns the partitions a geotype is stored in (one per county for
+        streaming geotypes), or None if it is stored in one piece
         """
-        # Get unique sources
-        sources = set([i[0] for i in v.census_variable])
-        frames = []
-        for source in sources:
-            # Create Variables for given source and set client
-            variables = [i for i in v.census_variable if i[0] == source]
-            client = self.client_options.get(source, self.c.acs5)
-            # create_census_variables Will be deprecated eventually
-            E_variables, M_variables = v.create_census_variables(variables)
-            frames.append(
-                pd.DataFrame(
-                    client.get(
-                        ("NAME", ",".join(E_variables + M_variables)),
-                        geoquery,
-                        year=self.year,
+        if geotype in self.streaming_geotypes:
+            return self.counties
+        return None
+
+    def plan(self, geotype: str) -> list:
+        """
+        returns the geoqueries to download a geotype with: the coalesced
+        geoqueries, unless the API rejected them before for the geotype,
+        in which case we fall back to one geoquery per county
+        """
+        if geotype in self.split_geotypes:
+            return self.geoqueries.get(geotype)
+        return self.coalesced_geoqueries.get(geotype)
+
+    def get(self, source: str, fields: list, geoquery: dict) -> pd.DataFrame:
+        """
+        Download census fields from a single source for a single geoquery,
+        keeping only geographies within the NYC counties
+        """
+        client = self.client_options.get(source, self.c.acs5)
+        df = pd.DataFrame(
+            client.get(("NAME", ",".join(fields)), geoquery, year=self.year)
+        )
+        if "county" in df.columns:
+            df = df.loc[df.county.isin(self.counties)]
+        return df
+
+    def download(self, geotype: str, fields: dict, skip_errors=False) -> None:
+        """
+        Download census fields (grouped by source) for every geoquery of the
+        geotype into the store, packing as many fields as the API allows
+        into each request. Requests run in parallel, at most
+        self.concurrency at a time. With skip_errors, chunks rejected by
+        the API are logged and left out of the store instead of raising.
+
+        Chunks are downloaded in batches whose fields are locked across
+        processes, a field that another process downloaded while we were
+        waiting for the lock is not requested again.
+        """
+        chunks = [
+            (source, chunk)
+            for source, _fields in fields.items()
+            for chunk in self.chunks(_fields)
+        ]
+        for i in range(0, len(chunks), self.concurrency):
+            batch = chunks[i : i + self.concurrency]
+            with self.store.lock(geotype, [f for _, chunk in batch for f in chunk]):
+                batch = [
+                    (
+                        source,
+                        self.store.missing(geotype, chunk, self.partitions(geotype)),
                     )
+                    for source, chunk in batch
+                ]
+                if geotype in self.streaming_geotypes:
+                    self.download_partitions(geotype, batch, skip_errors)
+                else:
+                    self.download_batch(geotype, batch, skip_errors)
+
+    def download_partitions(self, geotype: str, batch: list, skip_errors: bool) -> None:
+        """
+        Same as download_batch for streaming geotypes: every county is
+        requested separately and written to its partition of the store as
+        soon as it arrives, so that at most self.concurrency county chunks
+        are held in memory at any time
+        """
+
+        def download_partition(source, chunk, county, geoquery):
+            try:
+                df = self.get(source, chunk, geoquery)
+            except CensusException as e:
+                if not skip_errors:
+                    raise
+                logging.warning(
+                    f"Skipping {len(chunk)} {source} fields in county {county}: {e}"
                 )
-            )
-        # Combine results from each source by joining on geo name
-        df = frames[0]
-        for i in frames[1:]:
-            df = pd.merge(
-                df,
-                i[i.columns.difference(["state", "county", "tract", "place"])],
-                left_on="NAME",
-                right_on="NAME",
-            )
-        del frames
-        # Enforce type safety
-        for i in v.census_variable:
-            if i[0] != "P":
-                df[f"{i}E"] = df[f"{i}E"].astype("float64")
-                df[f"{i}M"] = df[f"{i}M"].astype("float64")
-                # If E is zero, then set M as zero
-                df.loc[df[f"{i}E"] == 0, f"{i}M"] = 0
-                # If E is an outlier, then set M as Nan
-                df.loc[df[f"{i}E"].isin(outliers), f"{i}M"] = np.nan
-            else:
-                df[i] = df[i].astype("float64")
-            # 555555555 indicates controled value,
-            # for city and borough, we will set it to 0
-            if geotype in ("city", "borough"):
-                df.loc[df[f"{i}M"].isin([-555555555, 555555555]), f"{i}M"] = 0
+                return
+            df = self.create_census_geoid(df, geotype)
+            df = self.clean(df, geotype, chunk)
+            self.store.write(geotype, df[["census_geoid"] + chunk], partition=county)
 
-        # Replace all outliers as Nan
-        df = df.replace(outliers, np.nan)
-        return df
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(download_partition, source, chunk, county, geoquery)
+                for source, chunk in batch
+                if chunk
+                for county, geoquery in zip(self.counties, self.geoqueries.get(geotype))
+            ]
+            for future in futures:
+                future.result()
+
+    def download_batch(self, geotype: str, batch: list, skip_errors: bool) -> None:
+        geoqueries = self.plan(geotype)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                (
+                    source,
+                    chunk,
+                    [
+                        executor.submit(self.get, source, chunk, geoquery)
+                        for geoquery in geoqueries
+                    ],
+                )
+                for source, chunk in batch
+                if chunk
+            ]
+            for source, chunk, results in futures:
+                try:
+                    try:
+                        df = pd.concat([i.result() for i in results], ignore_index=True)
+                    except CensusException:
+                        if geoqueries == self.geoqueries.get(geotype):
+                            raise
+                        # Fall back to one request per county
+                        df = pd.concat(
+                            executor.map(
+                                lambda geoquery: self.get(source, chunk, geoquery),
+                                self.geoqueries.get(geotype),
+                            ),
+                            ignore_index=True,
+                        )
+                        self.split_geotypes.add(geotype)
+                except CensusException as e:
+                    if not skip_errors:
+                        raise
+                    logging.warning(f"Skipping {len(chunk)} {source} fields: {e}")
+                    continue
+                df = self.create_census_geoid(df, geotype)
+                df = self.clean(df, geotype, chunk)
+                self.store.write(geotype, df[["census_geoid"] + chunk])
+
+    def prefetch(self, geotypes: list, pff_variables: list = None) -> None:
+        """
+        Populate the store for the given geotypes in bulk. All census fields
+        needed by pff_variables (every variable in metadata.json by default)
+        are deduplicated, grouped by census client and downloaded with the
+        fewest requests possible, so that later calls to Download never
+        touch the API.
+        """
+        if pff_variables is None:
+            pff_variables = [
+                i["pff_variable"] for i in self.meta.metadata if "census_variable" in i
+            ]
+        for geotype in geotypes:
+            fields = {}
+            for pff_variable in pff_variables:
+                v = self.meta.create_variable(pff_variable)
+                profile_only = self.profile_only(geotype, pff_variable)
+                for source, f in self.census_fields(v, profile_only).items():
+                    fields.setdefault(source, set()).update(f)
+            self.download(
+                geotype,
+                {
+                    k: self.store.missing(geotype, sorted(f), self.partitions(geotype))
+                    for k, f in fields.items()
+                },
+                skip_errors=True,
+            )
 
     def create_census_geoid(self, df: pd.DataFrame, geotype: str) -> pd.DataFrame:
         if geotype == "tract":
@@ -155,35 +392,37 @@ class Download:
             )
         return df
 
-    def __call__(self, geotype: str, pff_variable: str) -> pd.DataFrame:
-        cache_path = (
-            ".cache/download"
-            f"/year={self.year}"
-            f"/geography={self.geography}"
-            f"/geotype={geotype}"
-            f"/{pff_variable}.pkl"
+    def fetch(self, geotype: str, pff_variable: str) -> list:
+        """
+        download the census fields of pff_variable that are not in the
+        store yet, and return the list of fields
+        """
+        v = self.meta.create_variable(pff_variable)
+        fields = self.census_fields(v, self.profile_only(geotype, pff_variable))
+        partitions = self.partitions(geotype)
+        self.download(
+            geotype,
+            {k: self.store.missing(geotype, f, partitions) for k, f in fields.items()},
         )
-        if os.path.isfile(cache_path):
-            df = pd.read_pickle(cache_path)
-        else:
-            meta = Metadata(year=self.year, source=self.source)
-            AggregatedGeography = importlib.import_module(
-                f"factfinder.geography.{self.geography}"
-            ).AggregatedGeography
-            geography = AggregatedGeography()
-
-            v = meta.create_variable(pff_variable)
-            if (
-                pff_variable in meta.profile_only_variables
-                and geotype not in geography.aggregated_geography
-            ):
-                # For profile only variables we will get e, m, p, z
-                df = self.download_variable(self.download_e_m_p_z, geotype, v)
-            else:
-                df = self.download_variable(self.download_e_m, geotype, v)
-            df = self.create_census_geoid(df, geotype)
+        return [i for f in fields.values() for i in f]
+
+    def stream(self, geotype: str, pff_variable: str):
+        """
+        same as calling Download, but yields the dataframe in chunks of at
+        most self.chunksize rows, so that the whole geotype never has to be
+        in memory at once
+        """
+        fields = self.fetch(geotype, pff_variable)
+        for df in self.store.read_chunks(
+            geotype, fields, self.partitions(geotype), self.chunksize
+        ):
             df["geotype"] = geotype
             df["pff_variable"] = pff_variable
-            os.makedirs(Path(cache_path).parent, exist_ok=True)
-            write_to_cache(df, cache_path)
+            yield df
+
+    def __call__(self, geotype: str, pff_variable: str) -> pd.DataFrame:
+        fields = self.fetch(geotype, pff_variable)
+        df = self.store.read(geotype, fields, self.partitions(geotype))
+        df["geotype"] = geotype
+        df["pff_variable"] = pff_variable
         return df
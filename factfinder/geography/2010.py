@@ -1,20 +1,49 @@
 import itertools
-import math
 from pathlib import Path
 
-import numpy as np
 import pandas as pd
 from cached_property import cached_property
 
-from . import agg_moe
+from ..utils import file_fingerprint
+from . import AggregationOperator, empty_frame, load_lookup, load_operator
 
 
 class AggregatedGeography:
     def __init__(self):
         self.year = 2010
+        self.operators = {}
+
+    @cached_property
+    def version(self) -> str:
+        """
+        fingerprint of the geography lookups and translation code
+        """
+        return file_fingerprint(
+            __file__,
+            Path(__file__).parent.parent
+            / f"data/lookup_geo/{self.year}/lookup_geo.csv",
+        )
 
     @cached_property
     def lookup_geo(self):
+        return load_lookup(
+            f"{self.year}/lookup_geo", self.version, self.read_lookup_geo
+        )
+
+    def compile(self) -> None:
+        """
+        build the lookup and operator artifacts, so that other processes
+        load them instead of parsing the csv file. Running every translator
+        on an empty dataframe builds the operators it uses
+        """
+        load_lookup(f"{self.year}/lookup_geo", self.version, self.read_lookup_geo)
+        for options in [self.options, self.intermediate_options]:
+            for translators in options.values():
+                for translator in translators.values():
+                    for func in translator.values():
+                        func(empty_frame())
+
+    def read_lookup_geo(self) -> pd.DataFrame:
         # find the current decennial year based on given year
         lookup_geo = pd.read_csv(
             Path(__file__).parent.parent
@@ -22,166 +51,115 @@ class AggregatedGeography:
             dtype="str",
         )
         lookup_geo["geoid_block"] = lookup_geo.county_fips + lookup_geo.ctcb2010
-        lookup_geo["geoid_block_group"] = lookup_geo.geoid_block.apply(
-            lambda x: x[0:12]
-        )
+        lookup_geo["geoid_block_group"] = lookup_geo.geoid_block.str[:12]
         lookup_geo["geoid_tract"] = lookup_geo.county_fips + lookup_geo.ct2010
-        lookup_geo["cd_fp_500"] = lookup_geo.apply(
-            lambda row: row["cd"] if int(row["fp_500"]) else np.nan, axis=1
-        )
-        lookup_geo["cd_fp_100"] = lookup_geo.apply(
-            lambda row: row["cd"] if int(row["fp_100"]) else np.nan, axis=1
-        )
-        lookup_geo["cd_park_access"] = lookup_geo.apply(
-            lambda row: row["cd"] if int(row["park_access"]) else np.nan, axis=1
-        )
+        for colname, flag in [
+            ("cd_fp_500", "fp_500"),
+            ("cd_fp_100", "fp_100"),
+            ("cd_park_access", "park_access"),
+        ]:
+            lookup_geo[colname] = lookup_geo.cd.where(lookup_geo[flag].astype(int) != 0)
         return lookup_geo
 
-    @staticmethod
-    def create_output(df, colname):
+    def operator(self, geoid, colname, how="right") -> AggregationOperator:
         """
-        this function will calculate the aggregated e and m
-        given colname we would like to aggregate over
+        the operator compiled from lookup_geo for geoid and colname, loaded
+        from its (memory mapped) artifact once per process
         """
-        return (
-            df[[colname, "e"]]
-            .groupby([colname])
-            .sum()
-            .merge(df[[colname, "m"]].groupby([colname]).agg(agg_moe), on=colname)
-            .reset_index()
-            .rename(columns={colname: "census_geoid"})
-        )
+        key = (geoid, colname, how)
+        if key not in self.operators:
+            self.operators[key] = load_operator(
+                f"{self.year}/lookup_geo/{geoid}-{colname}",
+                self.version,
+                lambda: AggregationOperator(self.lookup_geo, geoid, colname, how),
+                how,
+            )
+        return self.operators[key]
 
-    def tract_to_nta(self, df):
-        df = df.merge(
-            self.lookup_geo[["geoid_tract", "nta"]].drop_duplicates(),
-            how="left",
-            right_on="geoid_tract",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "nta")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "NTA"
+    def aggregate(self, df, geoid, colname, geotype, how="right"):
+        """
+        aggregate df from geoid to colname, with the operator compiled from
+        lookup_geo once per geoid and colname
+        """
+        output = self.operator(geoid, colname, how)(df)
+        output["geotype"] = geotype
         return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
 
+    def aggregate_chunks(self, chunks, geoid, colname, geotype, how="right"):
+        """
+        same as aggregate for an iterable of dataframes, the operator is
+        applied one chunk at a time, so that only one chunk is in memory
+        """
+        output = self.operator(geoid, colname, how).stream(chunks)
+        output["geotype"] = geotype
+        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+
+    def tract_to_nta(self, df):
+        return self.aggregate(df, "geoid_tract", "nta", "NTA", how="left")
+
     def block_group_to_cd_fp500(self, df):
         """
         500 yr flood plain aggregation for block group data (ACS)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cd_fp_500.isna(), ["geoid_block_group", "cd_fp_500"]
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block_group",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "cd_fp_500")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cd_fp_500"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.aggregate(df, "geoid_block_group", "cd_fp_500", "cd_fp_500")
 
     def block_group_to_cd_fp100(self, df):
         """
         100 yr flood plain aggregation for block group data (ACS)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cd_fp_100.isna(), ["geoid_block_group", "cd_fp_100"]
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block_group",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "cd_fp_100")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cd_fp_100"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.aggregate(df, "geoid_block_group", "cd_fp_100", "cd_fp_100")
 
     def block_group_to_cd_park_access(self, df):
         """
         walk-to-park access zone aggregation for block group data (acs)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cd_park_access.isna(),
-                ["geoid_block_group", "cd_park_access"],
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block_group",
-            left_on="census_geoid",
+        return self.aggregate(
+            df, "geoid_block_group", "cd_park_access", "cd_park_access"
         )
-        output = AggregatedGeography.create_output(df, "cd_park_access")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cd_park_access"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
 
     def block_to_cd_fp500(self, df):
         """
         500 yr flood plain aggregation for block data (decennial)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cd_fp_500.isna(), ["geoid_block", "cd_fp_500"]
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "cd_fp_500")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cd_fp_500"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.aggregate(df, "geoid_block", "cd_fp_500", "cd_fp_500")
 
     def block_to_cd_fp100(self, df):
         """
         100 yr flood plain aggregation for block data (decennial)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cd_fp_100.isna(), ["geoid_block", "cd_fp_100"]
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "cd_fp_100")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cd_fp_100"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.aggregate(df, "geoid_block", "cd_fp_100", "cd_fp_100")
 
     def block_to_cd_park_access(self, df):
         """
         walk-to-park access zone aggregation for block data (decennial)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cd_park_access.isna(),
-                ["geoid_block", "cd_park_access"],
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block",
-            left_on="census_geoid",
+        return self.aggregate(df, "geoid_block", "cd_park_access", "cd_park_access")
+
+    def block_to_cd_fp500_chunks(self, chunks):
+        """
+        500 yr flood plain aggregation for chunks of block data (decennial)
+        """
+        return self.aggregate_chunks(chunks, "geoid_block", "cd_fp_500", "cd_fp_500")
+
+    def block_to_cd_fp100_chunks(self, chunks):
+        """
+        100 yr flood plain aggregation for chunks of block data (decennial)
+        """
+        return self.aggregate_chunks(chunks, "geoid_block", "cd_fp_100", "cd_fp_100")
+
+    def block_to_cd_park_access_chunks(self, chunks):
+        """
+        walk-to-park access zone aggregation for chunks of block data (decennial)
+        """
+        return self.aggregate_chunks(
+            chunks, "geoid_block", "cd_park_access", "cd_park_access"
         )
-        output = AggregatedGeography.create_output(df, "cd_park_access")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cd_park_access"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
 
     def tract_to_cd(self, df):
         """
         tract to cd
         """
-        df = df.merge(
-            self.lookup_geo[["geoid_tract", "cd"]].drop_duplicates(),
-            how="left",
-            right_on="geoid_tract",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "cd")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cd"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.aggregate(df, "geoid_tract", "cd", "cd", how="left")
 
     @cached_property
     def options(self):
@@ -204,6 +182,30 @@ class AggregatedGeography:
             },
         }
 
+    @cached_property
+    def intermediate_options(self):
+        """
+        translators from an intermediate geotype, none of the geotypes
+        here are calculated from another aggregated geotype
+        """
+        return {}
+
+    @cached_property
+    def stream_options(self):
+        """
+        translators that take an iterable of dataframes instead of a
+        dataframe, for geotypes that are read in chunks
+        """
+        return {
+            "decennial": {
+                "block": {
+                    "cd_fp_500": self.block_to_cd_fp500_chunks,
+                    "cd_fp_100": self.block_to_cd_fp100_chunks,
+                    "cd_park_access": self.block_to_cd_park_access_chunks,
+                }
+            }
+        }
+
     @cached_property
     def aggregated_geography(self) -> list:
         list3d = [[list(k.keys()) for k in i.values()] for i in self.options.values()]
@@ -6,36 +6,67 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
-from . import agg_moe
+from ..utils import file_fingerprint
+from . import AggregationOperator, empty_frame, load_lookup, load_operator
 
 
 class AggregatedGeography:
     def __init__(self):
-        pass
+        self.operators = {}
+
+    @cached_property
+    def version(self) -> str:
+        """
+        fingerprint of the geography lookups and translation code
+        """
+        return file_fingerprint(
+            __file__,
+            Path(__file__).parent.parent / f"data/lookup_geo/2020/lookup_geo.csv",
+            Path(__file__).parent.parent / f"data/lookup_geo/2010_to_2020/ratio.csv",
+        )
 
     @cached_property
     def lookup_geo(self):
+        return load_lookup("2020/lookup_geo", self.version, self.read_lookup_geo)
+
+    @cached_property
+    def ratio(self):
+        return load_lookup("2010_to_2020/ratio", self.version, self.read_ratio)
+
+    def compile(self) -> None:
+        """
+        build the lookup and operator artifacts, so that other processes
+        load them instead of parsing the csv files. Running every translator
+        on an empty dataframe builds the operators it uses
+        """
+        load_lookup("2020/lookup_geo", self.version, self.read_lookup_geo)
+        load_lookup("2010_to_2020/ratio", self.version, self.read_ratio)
+        for options in [self.options, self.intermediate_options]:
+            for translators in options.values():
+                for translator in translators.values():
+                    for func in translator.values():
+                        func(empty_frame())
+
+    def read_lookup_geo(self) -> pd.DataFrame:
         # find the current decennial year based on given year
         lookup_geo = pd.read_csv(
             Path(__file__).parent.parent / f"data/lookup_geo/2020/lookup_geo.csv",
             dtype="str",
         )
         # Create geoid_tract
-        lookup_geo["geoid_tract"] = lookup_geo.geoid.apply(lambda x: str(x)[:11])
-        lookup_geo["geoid_block_group"] = lookup_geo.geoid.apply(lambda x: x[0:12])
-        lookup_geo["cdta_fp_500"] = lookup_geo.apply(
-            lambda row: row["cdta2020"] if int(row["fp_500"]) else np.nan, axis=1
-        )
-        lookup_geo["cdta_fp_100"] = lookup_geo.apply(
-            lambda row: row["cdta2020"] if int(row["fp_100"]) else np.nan, axis=1
-        )
-        lookup_geo["cdta_park_access"] = lookup_geo.apply(
-            lambda row: row["cdta2020"] if int(row["park_access"]) else np.nan, axis=1
-        )
+        lookup_geo["geoid_tract"] = lookup_geo.geoid.str[:11]
+        lookup_geo["geoid_block_group"] = lookup_geo.geoid.str[:12]
+        for colname, flag in [
+            ("cdta_fp_500", "fp_500"),
+            ("cdta_fp_100", "fp_100"),
+            ("cdta_park_access", "park_access"),
+        ]:
+            lookup_geo[colname] = lookup_geo.cdta2020.where(
+                lookup_geo[flag].astype(int) != 0
+            )
         return lookup_geo
 
-    @cached_property
-    def ratio(self):
+    def read_ratio(self) -> pd.DataFrame:
         ratio = pd.read_csv(
             Path(__file__).parent.parent / f"data/lookup_geo/2010_to_2020/ratio.csv",
             dtype="str",
@@ -49,21 +80,6 @@ class AggregatedGeography:
         )
         return ratio[["geoid_ct2010", "geoid_ct2020", "ratio"]]
 
-    @staticmethod
-    def create_output(df, colname):
-        """
-        this function will calculate the aggregated e and m
-        given colname we would like to aggregate over
-        """
-        return (
-            df[[colname, "e"]]
-            .groupby([colname])
-            .sum()
-            .merge(df[[colname, "m"]].groupby([colname]).agg(agg_moe), on=colname)
-            .reset_index()
-            .rename(columns={colname: "census_geoid"})
-        )
-
     @staticmethod
     def agg_moe(x):
         return math.sqrt(sum([i ** 2 for i in x if i or not np.isnan(i)]))
@@ -79,122 +95,126 @@ class AggregatedGeography:
         else:
             return ((((ratio * 100) ** (0.56901)) * 7.96309) / 100) * m_2010
 
+    def operator(self, geoid, colname, how="right") -> AggregationOperator:
+        """
+        the operator compiled from lookup_geo for geoid and colname, loaded
+        from its (memory mapped) artifact once per process
+        """
+        key = (geoid, colname, how)
+        if key not in self.operators:
+            self.operators[key] = load_operator(
+                f"2020/lookup_geo/{geoid}-{colname}",
+                self.version,
+                lambda: AggregationOperator(self.lookup_geo, geoid, colname, how),
+                how,
+            )
+        return self.operators[key]
+
+    def aggregate(self, df, geoid, colname, geotype, how="right"):
+        """
+        aggregate df from geoid to colname, with the operator compiled from
+        lookup_geo once per geoid and colname
+        """
+        output = self.operator(geoid, colname, how)(df)
+        output["geotype"] = geotype
+        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+
+    @cached_property
+    def ct2010_to_ct2020_operator(self) -> AggregationOperator:
+        """
+        the ratio table compiled into an operator from 2010 to 2020 tracts,
+        with the ratio of every entry and the moe factor of convert_moe
+        """
+
+        def build():
+            operator = AggregationOperator(self.ratio, "geoid_ct2010", "geoid_ct2020")
+            operator.ratio = self.ratio.ratio.loc[operator.index].to_numpy()[:, None]
+            # computed with the same scalar operations as convert_moe
+            operator.factor = np.array(
+                [
+                    ((ratio * 100) ** (0.56901)) * 7.96309
+                    for ratio in operator.ratio[:, 0]
+                ]
+            )[:, None]
+            return operator
+
+        return load_operator("2010_to_2020/ratio/ct2010_to_ct2020", self.version, build)
+
     def ct2010_to_ct2020(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         this function will translate a dataframe from ct2010 to ct2020
-        by multiplying a ratio on E/M
+        by multiplying a ratio on E/M, for every pff_variable at once
         """
-        df = df.merge(
-            self.ratio[["geoid_ct2010", "geoid_ct2020", "ratio"]],
-            how="right",
-            right_on="geoid_ct2010",
-            left_on="census_geoid",
-        )
-        df["e_2010"] = df.e
-        df["m_2010"] = df.m
-        df.e = df.e * df.ratio
-        df.m = df.apply(
-            lambda row: self.convert_moe(
-                row["e_2010"], row["m_2010"], row["e"], row["ratio"]
-            ),
-            axis=1,
+        operator = self.ct2010_to_ct2020_operator
+        variables, (e, m), _ = operator.gather(df, ["e", "m"])
+        e_2010, m_2010 = e[operator.cols], m[operator.cols]
+        e = e_2010 * operator.ratio
+        # convert_moe, one array mask per branch
+        with np.errstate(invalid="ignore"):
+            m = np.where(
+                operator.ratio == 1,
+                m_2010,
+                np.where(
+                    e == 0,
+                    np.nan,
+                    np.where(
+                        operator.factor >= 100, m_2010, operator.factor / 100 * m_2010
+                    ),
+                ),
+            )
+        e = np.nan_to_num(e.round(16))
+        m = np.nan_to_num(m.round(16))
+        output = operator.frame(
+            variables, operator.sum(e), np.sqrt(operator.sum(m ** 2))
         )
-
-        df.e = df.e.round(16)
-        df.m = df.m.round(16)
-
-        output = AggregatedGeography.create_output(df, "geoid_ct2020")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
         output["geotype"] = "CT20"
         return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
 
+    def ct2020_to_nta(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        aggregate 2020 tract data to NTA2020 level
+        """
+        return self.aggregate(df, "geoid_tract", "nta2020", "NTA", how="left")
+
+    def ct2020_to_cdta(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        aggregate 2020 tract data to CDTA level
+        """
+        return self.aggregate(df, "geoid_tract", "cdta2020", "CDTA", how="left")
+
     def tract_to_nta(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Function to translate 2010 tract data to 2020 tract data,
         then aggregate to NTA2020 level
         """
-        df = self.ct2010_to_ct2020(df)
-        df = df.merge(
-            self.lookup_geo[["geoid_tract", "nta2020"]].drop_duplicates(),
-            how="left",
-            right_on="geoid_tract",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "nta2020")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "NTA"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.ct2020_to_nta(self.ct2010_to_ct2020(df))
 
     def tract_to_cdta(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Function to translate 2010 tract data to 2020 tract data,
         then aggregate to CDTA level
         """
-        df = self.ct2010_to_ct2020(df)
-        df = df.merge(
-            self.lookup_geo[["geoid_tract", "cdta2020"]].drop_duplicates(),
-            how="left",
-            right_on="geoid_tract",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "cdta2020")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "CDTA"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.ct2020_to_cdta(self.ct2010_to_ct2020(df))
 
     def block_group_to_cdta_fp500(self, df):
         """
         500 yr flood plain aggregation for block group data (ACS)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cdta_fp_500.isna(),
-                ["geoid_block_group", "cdta_fp_500"],
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block_group",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "cdta_fp_500")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cdta_fp_500"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.aggregate(df, "geoid_block_group", "cdta_fp_500", "cdta_fp_500")
 
     def block_group_to_cdta_fp100(self, df):
         """
         100 yr flood plain aggregation for block group data (ACS)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cdta_fp_100.isna(),
-                ["geoid_block_group", "cdta_fp_100"],
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block_group",
-            left_on="census_geoid",
-        )
-        output = AggregatedGeography.create_output(df, "cdta_fp_100")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cdta_fp_100"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+        return self.aggregate(df, "geoid_block_group", "cdta_fp_100", "cdta_fp_100")
 
     def block_group_to_cdta_park_access(self, df):
         """
         walk-to-park access zone aggregation for block group data (acs)
         """
-        df = df.merge(
-            self.lookup_geo.loc[
-                ~self.lookup_geo.cdta_park_access.isna(),
-                ["geoid_block_group", "cdta_park_access"],
-            ].drop_duplicates(),
-            how="right",
-            right_on="geoid_block_group",
-            left_on="census_geoid",
+        return self.aggregate(
+            df, "geoid_block_group", "cdta_park_access", "cdta_park_access"
         )
-        output = AggregatedGeography.create_output(df, "cdta_park_access")
-        output["pff_variable"] = df["pff_variable"].to_list()[0]
-        output["geotype"] = "cdta_park_access"
-        return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
 
     @cached_property
     def options(self):
@@ -218,6 +238,25 @@ class AggregatedGeography:
             }
         }
 
+    @cached_property
+    def intermediate_options(self):
+        """
+        translators from an intermediate geotype, to calculate a geotype from
+        the (cached) result of another one instead of its from geotype,
+        e.g. NTA is aggregated from CT20 instead of translating tracts again
+        """
+        return {
+            "acs": {"CT20": {"NTA": self.ct2020_to_nta, "CDTA": self.ct2020_to_cdta}}
+        }
+
+    @cached_property
+    def stream_options(self):
+        """
+        translators that take an iterable of dataframes instead of a
+        dataframe, none of the geotypes here are read in chunks
+        """
+        return {}
+
     @cached_property
     def aggregated_geography(self) -> list:
         """
@@ -1,7 +1,222 @@
 import math
+import os
+import shutil
+from pathlib import Path
 
 import numpy as np
+import pandas as pd
+
+from ..utils import atomic_write, cache_lock, write_to_cache
 
 
 def agg_moe(x):
     return math.sqrt(sum([i ** 2 if not np.isnan(i) else 0 for i in x]))
+
+
+def empty_frame() -> pd.DataFrame:
+    """
+    census_geoid, pff_variable, e and m without any row, the input
+    translators are run on to build their operators
+    """
+    return pd.DataFrame(
+        {
+            "census_geoid": pd.Series([], dtype=object),
+            "pff_variable": pd.Series([], dtype=object),
+            "e": pd.Series([], dtype="float64"),
+            "m": pd.Series([], dtype="float64"),
+        }
+    )
+
+
+def load_lookup(name: str, version: str, build) -> pd.DataFrame:
+    """
+    returns the lookup compiled by build (from the csv files in data/),
+    cached as a pickle keyed by version, the fingerprint of the csv files
+    and of the code building it. Only a missing or stale (differently
+    keyed) artifact is built again
+    """
+    path = f".cache/lookup_geo/{name}-{version}.pkl"
+    if os.path.isfile(path):
+        return pd.read_pickle(path)
+    df = build()
+    os.makedirs(Path(path).parent, exist_ok=True)
+    write_to_cache(df, path)
+    return df
+
+
+def load_operator(name: str, version: str, build, how="right"):
+    """
+    returns the AggregationOperator compiled by build, saved as .npy files
+    in .cache/lookup_geo/{name}-{version}/ and memory mapped, so that the
+    processes of a pool share the pages of one copy of its entries instead
+    of each compiling their own
+    """
+    path = f".cache/lookup_geo/{name}-{version}"
+    with cache_lock(path):
+        if not os.path.isfile(f"{path}/targets.npy"):
+            build().save(path)
+    return AggregationOperator.load(path, how)
+
+
+def prune_lookups(versions: list) -> list:
+    """
+    delete the lookups and operators in .cache/lookup_geo that are not
+    keyed by one of the given versions (the current versions of the
+    geographies), and the lock files. Returns the deleted paths
+    """
+    deleted = []
+    for path in sorted(Path(".cache/lookup_geo").glob("**/*-*")):
+        if path.suffix == ".lock":
+            os.remove(path)
+        elif path.suffix == ".pkl" and path.stem.rsplit("-", 1)[1] not in versions:
+            os.remove(path)
+        elif path.is_dir() and path.name.rsplit("-", 1)[1] not in versions:
+            shutil.rmtree(path)
+        else:
+            continue
+        deleted.append(path)
+    return deleted
+
+
+class AggregationOperator:
+    """
+    Sparse source geoid x target geoid aggregation matrix compiled from a
+    lookup, stored as the (target, source) pairs of its non-zero entries.
+    Targets are sorted, like the groups of a groupby. Applying the
+    operator sums e and takes the root sum of squares of m, counting
+    missing values as 0 like agg_moe, for every pff_variable at once.
+
+    With how="right", every target of the lookup is in the output, with
+    how="left", only the targets of at least one of the given geoids
+    (same as merging the data with the lookup and grouping by target)
+    """
+
+    def __init__(self, lookup: pd.DataFrame, geoid: str, colname: str, how="right"):
+        lookup = lookup.loc[~lookup[colname].isna(), [geoid, colname]]
+        lookup = lookup.drop_duplicates()
+        self.how = how
+        # index of the lookup rows the entries are compiled from
+        self.index = lookup.index
+        self.sources = pd.Index(lookup[geoid].unique())
+        self.targets = pd.Index(sorted(lookup[colname].unique()))
+        self.rows = self.targets.get_indexer(lookup[colname])
+        self.cols = self.sources.get_indexer(lookup[geoid])
+
+    # attributes that are loaded back as pd.Index
+    indexes = ["index", "sources", "targets"]
+
+    def save(self, path: str) -> None:
+        """
+        save every array of the operator (including the ones set on it
+        after compiling) as a .npy file in the path directory. targets is
+        written last, an operator is complete once targets.npy exists
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            k: v for k, v in vars(self).items() if isinstance(v, (np.ndarray, pd.Index))
+        }
+        for name in sorted(arrays, key=lambda k: k == "targets"):
+            values = arrays[name]
+            if isinstance(values, pd.Index):
+                # geoids are saved as fixed width strings, which can be mapped
+                values = values.to_numpy(None if values.dtype.kind in "iuf" else str)
+            with atomic_write(f"{path}/{name}.npy") as tmp:
+                with open(tmp, "wb") as f:
+                    np.save(f, values)
+
+    @classmethod
+    def load(cls, path: str, how="right") -> "AggregationOperator":
+        """
+        load an operator saved with save, its arrays are memory mapped
+        """
+        operator = cls.__new__(cls)
+        operator.how = how
+        for file in Path(path).glob("*.npy"):
+            values = np.load(file, mmap_mode="r")
+            if file.stem in cls.indexes:
+                values = pd.Index(
+                    values.astype(object) if values.dtype.kind == "U" else values
+                )
+            setattr(operator, file.stem, values)
+        return operator
+
+    def gather(self, df: pd.DataFrame, fields: list) -> tuple:
+        """
+        given census_geoid, pff_variable and fields, with one row per geoid
+        and pff_variable, returns the pff_variables, the source x pff_variable
+        matrix of each field (NaN where missing) and the matrix of the
+        sources that are in df
+        """
+        variables = pd.Index(df.pff_variable.unique())
+        sources = self.sources.get_indexer(df.census_geoid)
+        matched = sources >= 0
+        index = (sources[matched], variables.get_indexer(df.pff_variable)[matched])
+        shape = (len(self.sources), len(variables))
+        values = []
+        for field in fields:
+            values.append(np.full(shape, np.nan))
+            values[-1][index] = df[field].to_numpy("float64")[matched]
+        present = np.zeros(shape, dtype=bool)
+        present[index] = True
+        return variables, values, present
+
+    def sum(self, entries: np.ndarray) -> np.ndarray:
+        """
+        given the values of every entry (lookup row), returns the target x k
+        matrix of their sums
+        """
+        output = np.zeros((len(self.targets),) + entries.shape[1:], entries.dtype)
+        np.add.at(output, self.rows, entries)
+        return output
+
+    def frame(self, variables: pd.Index, e: np.ndarray, m: np.ndarray, keep=None):
+        """
+        given target x pff_variable matrices of e and m, returns census_geoid,
+        pff_variable, e and m, one pff_variable after the other
+        """
+        output = pd.DataFrame(
+            {
+                "census_geoid": np.tile(self.targets.to_numpy(), len(variables)),
+                "pff_variable": np.repeat(variables.to_numpy(), len(self.targets)),
+                "e": e.T.ravel(),
+                "m": m.T.ravel(),
+            }
+        )
+        return output if keep is None else output[keep.T.ravel()].reset_index(drop=True)
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        given census_geoid, pff_variable, e and m of the source geoids,
+        returns census_geoid, pff_variable, e and m of the targets,
+        one pff_variable after the other
+        """
+        variables, (e, m), present = self.gather(df, ["e", "m"])
+        keep = self.sum(present[self.cols]) if self.how == "left" else None
+        e = self.sum(np.nan_to_num(e[self.cols]))
+        m = np.sqrt(self.sum(np.nan_to_num(m[self.cols]) ** 2))
+        return self.frame(variables, e, m, keep)
+
+    def stream(self, chunks) -> pd.DataFrame:
+        """
+        same as calling the operator on the concatenation of chunks, an
+        iterable of dataframes, one chunk at a time. Only the target x
+        pff_variable sums of e and of the squares of m are kept between
+        chunks
+        """
+        variables = pd.Index([], dtype=object)
+        shape = (len(self.targets), 0)
+        e, m2, keep = np.zeros(shape), np.zeros(shape), np.zeros(shape, dtype=bool)
+        for df in chunks:
+            chunk_variables, (chunk_e, chunk_m), present = self.gather(df, ["e", "m"])
+            new = chunk_variables[~chunk_variables.isin(variables)]
+            if len(new):
+                variables = variables.append(new)
+                padding = ((0, 0), (0, len(new)))
+                e, m2, keep = (np.pad(i, padding) for i in (e, m2, keep))
+            columns = variables.get_indexer(chunk_variables)
+            e[:, columns] += self.sum(np.nan_to_num(chunk_e[self.cols]))
+            m2[:, columns] += self.sum(np.nan_to_num(chunk_m[self.cols]) ** 2)
+            keep[:, columns] |= self.sum(present[self.cols])
+        return self.frame(
+            variables, e, np.sqrt(m2), keep if self.how == "left" else None
+        )
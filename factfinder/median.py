@@ -1,4 +1,5 @@
 import logging
+from functools import cached_property
 
 import numpy as np
 
@@ -195,3 +196,149 @@ class Median:
         )
 
         return moe
+
+
+class BatchMedian:
+    """
+    Same as Median, for many geographies at once. Takes a dataframe with
+    one row per geography and one column per bin (in any order), and
+    computes the median and median moe of every row as array operations
+    over the geography x bin matrix, following every rule of Median
+    """
+
+    def __init__(
+        self,
+        ranges: dict,
+        df,
+        pff_variable,
+        DF=1.1,
+        top_coding: bool = True,
+        bottom_coding: bool = True,
+    ):
+        self.ordered = list(ranges.keys())
+        self.ranges = ranges
+        self.pff_variable = pff_variable
+        self.top_coding = top_coding
+        self.bottom_coding = bottom_coding
+        # geographies are named by the index of df, e.g. census_geoid
+        self.geoids = df.index
+        self.X = np.ascontiguousarray(df[self.ordered].to_numpy(dtype="float64"))
+        self.rows = np.arange(self.X.shape[0])
+        self.n = len(self.ordered)
+        # lower and upper boundaries of each bin
+        self.L = np.array([i[0] for i in ranges.values()], dtype="float64")
+        self.U = np.array([i[1] for i in ranges.values()], dtype="float64")
+        self.A = np.array([min(i) for i in ranges.values()], dtype="float64")
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.B = np.where(np.isnan(self.X), 0, self.X).sum(axis=1)
+            nonzero = self.B != 0
+            # the square root is taken one geography at a time, the vectorized
+            # power (and sqrt) can differ from Median in the last digit
+            self.se_50 = np.where(
+                nonzero,
+                DF * np.array([i ** 0.5 for i in (93 / (7 * self.B)) * 2500]),
+                np.nan,
+            )
+            self.p_lower = np.where(nonzero, 50 - self.se_50, np.nan)
+            self.p_upper = np.where(nonzero, 50 + self.se_50, np.nan)
+            # cumulative distribution, skipping missing bins
+            cumm_dist = np.nancumsum(self.X, axis=1)
+            cumm_dist[np.isnan(self.X)] = np.nan
+            self.cumm_dist = cumm_dist / self.B[:, None] * 100
+
+        # lower_bin (upper_bin) is the first bin with a cumulative
+        # distribution above p_lower (p_upper)
+        above = self.cumm_dist > self.p_lower[:, None]
+        invalid = nonzero & ~above.any(axis=1)
+        if invalid.any():
+            raise self.error(invalid, "no bin is above the lower percentile")
+        self.lower_bin = np.where(nonzero, above.argmax(axis=1), -1)
+        above = self.cumm_dist > self.p_upper[:, None]
+        self.upper_bin = np.where(nonzero & above.any(axis=1), above.argmax(axis=1), -1)
+        # missing bins count as non-zero, -1 if all bins are zero
+        non_zero = self.cumm_dist != 0
+        self.first_non_zero_bin = np.where(
+            non_zero.any(axis=1), non_zero.argmax(axis=1), -1
+        )
+
+    def error(self, invalid: np.ndarray, reason: str) -> ValueError:
+        """
+        the error raised for the geographies where invalid is True, e.g.
+        because of negative counts, where Median fails on an empty sequence
+        or a missing bin index
+        """
+        geoids = ", ".join(str(i) for i in self.geoids[invalid][:5])
+        if invalid.sum() > 5:
+            geoids += f" and {invalid.sum() - 5} more"
+        return ValueError(
+            f"cannot calculate the median of {self.pff_variable} for {geoids}: "
+            f"{reason}"
+        )
+
+    @cached_property
+    def median(self) -> np.ndarray:
+        N = self.B
+        C = np.cumsum(self.X, axis=1)
+        # the median bin is the first bin where the cumulative frequency
+        # reaches N/2, the top bin if it never does, and -1 if N is 0
+        reached = ~(C < N[:, None] / 2)
+        i = np.where(reached.any(axis=1), reached.argmax(axis=1), self.n - 1)
+        i = np.where(N / 2 > 0, i, -1)
+        C = np.where(i >= 0, C[self.rows, i], 0)
+        F = self.X[self.rows, i]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            median = self.L[i] + (N / 2 - (C - F)) * (self.U[i] - self.L[i]) / F
+        median = np.where((i == self.n - 1) & self.top_coding, self.L[-1], median)
+        median = np.where(C == 0.0, np.nan, median)
+        return np.where((i == 0) & self.bottom_coding, self.U[0], median)
+
+    @staticmethod
+    def get_bound(p, A1, A2, C1, C2) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(
+                ((C2 - C1) + A1) != 0, (p - C1) * (A2 - A1) / (C2 - C1) + A1, np.nan
+            )
+
+    def base_case(self, _bin):
+        A1 = self.A[_bin]
+        A2 = np.where(_bin + 1 <= self.n - 1, self.A[(_bin + 1) % self.n], np.nan)
+        C1 = self.cumm_dist[self.rows, _bin - 1]
+        C2 = self.cumm_dist[self.rows, _bin]
+        return A1, A2, C1, C2
+
+    @property
+    def lower_bound(self) -> np.ndarray:
+        A1, A2, C1, C2 = self.base_case(self.lower_bin)
+        C1 = np.where(self.lower_bin == 0, 0, C1)
+        first_non_zero = self.lower_bin == self.first_non_zero_bin
+        A1 = np.where(first_non_zero, 0.5 if self.pff_variable == "mdrms" else 0, A1)
+        A2 = np.where(first_non_zero, self.A[1], A2)
+        return BatchMedian.get_bound(self.p_lower, A1, A2, C1, C2)
+
+    @property
+    def upper_bound(self) -> np.ndarray:
+        A1, A2, C1, C2 = self.base_case(self.upper_bin)
+        A2 = np.where(self.upper_bin + 1 > self.n - 1, A1, A2)
+        # same as Median, i.e. the chained comparison
+        # upper_bin == (lower_bin & upper_bin) == first_non_zero_bin
+        both = self.lower_bin & self.upper_bin
+        first_non_zero = (self.upper_bin == both) & (both == self.first_non_zero_bin)
+        A1 = np.where(first_non_zero, 0, A1)
+        A2 = np.where(first_non_zero, self.A[1], A2)
+        return BatchMedian.get_bound(self.p_upper, A1, A2, C1, C2)
+
+    @cached_property
+    def median_moe(self) -> np.ndarray:
+        undefined = (
+            (self.median >= self.L[-1])
+            | (self.B == 0)
+            | (self.se_50 >= 50)
+            | (self.lower_bin >= self.n - 1)
+        )
+        invalid = ~undefined & (self.upper_bin < 0)
+        if invalid.any():
+            raise self.error(invalid, "no bin is above the upper percentile")
+        return np.where(
+            undefined, np.nan, (self.upper_bound - self.lower_bound) * 1.645 / 2
+        )
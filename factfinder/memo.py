@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+class Memo:
+    """
+    In-memory least recently used cache of dataframes, bounded by the
+    total size of the cached dataframes in bytes. Keeps track of hits,
+    misses and evictions. Dataframes are copied in and out of the cache,
+    so callers are free to modify them.
+    """
+
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def size(df: pd.DataFrame) -> int:
+        return int(df.memory_usage(index=True, deep=True).sum())
+
+    def get(self, key: tuple) -> pd.DataFrame:
+        """
+        returns a copy of the cached dataframe, or None if key is not cached
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            df, _ = self.entries[key]
+        return df.copy()
+
+    def put(self, key: tuple, df: pd.DataFrame) -> None:
+        """
+        cache a copy of df, evicting the least recently used dataframes
+        until it fits. Dataframes larger than max_bytes are not cached
+        """
+        size = self.size(df)
+        if size > self.max_bytes:
+            return
+        df = df.copy()
+        with self.lock:
+            self.pop(key)
+            while self.bytes + size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+            self.entries[key] = (df, size)
+            self.bytes += size
+
+    def pop(self, key: tuple) -> None:
+        with self.lock:
+            if key in self.entries:
+                _, size = self.entries.pop(key)
+                self.bytes -= size
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def __getstate__(self):
+        # the cache is local to a process, a pickled copy (e.g. sent to
+        # a worker process) starts empty
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+        }
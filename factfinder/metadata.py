@@ -1,7 +1,14 @@
 import json
+import os
+import pickle
 from functools import cached_property
 from pathlib import Path
 
+import numpy as np
+
+from .special import Formula
+from .utils import atomic_write, file_fingerprint, fingerprint
+
 
 class Variable:
     def __init__(self, kwargs):
@@ -42,6 +49,11 @@ class Variable:
 
 
 class Metadata:
+    # shared instances, one per (year, source), see Metadata.load
+    registry = {}
+    # json files of a year and source
+    files = ["metadata", "median", "special"]
+
     def __init__(self, year=2019, source="acs"):
         self.year = year
         self.source = source
@@ -59,70 +71,114 @@ class Metadata:
             "pbwpv",
             "pu18bwpv",
         ]
+        self.fingerprints = {}
+
+    @classmethod
+    def load(cls, year=2019, source="acs") -> "Metadata":
+        """
+        returns the Metadata instance of year and source shared by the
+        whole process, so that the json files are parsed and indexed once.
+        The parsed files are read from the artifact saved by compile, if
+        there is one for the current version of the json files
+        """
+        if (year, source) not in cls.registry:
+            meta = cls(year=year, source=source)
+            if os.path.isfile(meta.artifact):
+                with open(meta.artifact, "rb") as f:
+                    meta.definitions = pickle.load(f)
+            cls.registry[(year, source)] = meta
+        return cls.registry[(year, source)]
+
+    def path(self, name: str) -> Path:
+        return Path(__file__).parent / f"data/{self.source}/{self.year}/{name}.json"
+
+    def read_json(self, name: str):
+        with open(self.path(name)) as f:
+            return json.load(f)
+
+    @cached_property
+    def version(self) -> str:
+        """
+        fingerprint of the json files
+        """
+        return file_fingerprint(*[self.path(i) for i in self.files])
+
+    @property
+    def artifact(self) -> str:
+        return f".cache/metadata/{self.source}/{self.year}-{self.version}.pkl"
+
+    @cached_property
+    def definitions(self) -> dict:
+        """
+        the parsed json files of the year and source (the ones that exist)
+        """
+        return {
+            name: self.read_json(name)
+            for name in self.files
+            if os.path.isfile(self.path(name))
+        }
+
+    def compile(self) -> None:
+        """
+        save the parsed json files as a pickle keyed by their fingerprint,
+        so that other processes (e.g. the workers of a pipeline) unpickle
+        them in Metadata.load instead of parsing the json files
+        """
+        if not os.path.isfile(self.artifact):
+            os.makedirs(Path(self.artifact).parent, exist_ok=True)
+            with atomic_write(self.artifact) as tmp:
+                with open(tmp, "wb") as f:
+                    pickle.dump(self.definitions, f, pickle.HIGHEST_PROTOCOL)
+
+    def definition(self, name: str):
+        # a missing file raises FileNotFoundError, when it is first needed
+        if name not in self.definitions:
+            return self.read_json(name)
+        return self.definitions[name]
 
     @cached_property
     def metadata(self) -> list:
-        with open(
-            f"{Path(__file__).parent}/data/{self.source}/{self.year}/metadata.json"
-        ) as f:
-            return json.load(f)
+        return self.definition("metadata")
 
     @cached_property
     def median(self) -> list:
-        with open(
-            f"{Path(__file__).parent}/data/{self.source}/{self.year}/median.json"
-        ) as f:
-            return json.load(f)
+        return self.definition("median")
 
     @cached_property
     def special(self) -> list:
-        with open(
-            f"{Path(__file__).parent}/data/{self.source}/{self.year}/special.json"
-        ) as f:
-            return json.load(f)
+        return self.definition("special")
 
-    @cached_property
+    @property
     def profile_only_variables(self) -> list:
-        return [
-            i["pff_variable"]
-            for i in self.metadata
-            if (
-                i["census_variable"][0][0:2] == "DP"
-                and len(i["census_variable"]) == 1
-                and i["pff_variable"] not in self.profile_only_exceptions
-            )
-        ]
+        return sorted(self.categories["profile_only"])
 
-    @cached_property
+    @property
     def base_variables(self) -> list:
         """
         returns a list of base variables in the format of pff_variable
         """
-        return list(set([i["base_variable"] for i in self.metadata]))
+        return sorted(self.categories["base"])
 
     def get_special_base_variables(self, pff_variable) -> list:
         """
         returns a list of special calculation base variables in the format
         of pff_variable
         """
-        special = next(
-            filter(lambda x: x["pff_variable"] == pff_variable, self.special)
-        )
-        return special["base_variables"]
+        return self.special_index[pff_variable]["base_variables"]
 
-    @cached_property
+    @property
     def median_variables(self) -> list:
         """
         returns a list of median variables in the format of pff_variable
         """
-        return list(self.median.keys())
+        return sorted(self.categories["median"])
 
-    @cached_property
+    @property
     def median_inputs(self) -> list:
         """
         returns a list of inputs to median variables
         """
-        return [in_var for sublist in [list(self.median[var]["ranges"].keys()) for var in self.median] for in_var in sublist]
+        return sorted(self.categories["median_inputs"])
 
     def median_ranges(self, pff_variable) -> dict:
         """
@@ -151,18 +207,137 @@ class Metadata:
         """
         return self.median[pff_variable]["design_factor"]
 
-    @cached_property
+    @property
     def special_variables(self) -> list:
         """
         returns a list of special calculation variables in the format
         of pff_variable
         """
-        return [i["pff_variable"] for i in self.special]
+        return sorted(self.categories["special"])
+
+    @cached_property
+    def variables(self) -> dict:
+        """
+        index of the Variable objects by pff_variable
+        """
+        return {i["pff_variable"]: Variable(i) for i in self.metadata}
+
+    @cached_property
+    def special_index(self) -> dict:
+        """
+        index of the special calculation definitions by pff_variable
+        """
+        return {i["pff_variable"]: i for i in self.special}
+
+    @cached_property
+    def formulas(self) -> dict:
+        """
+        index of the compiled special calculation formulas by pff_variable
+        """
+        return {i["pff_variable"]: Formula(i) for i in self.special}
+
+    @cached_property
+    def categories(self) -> dict:
+        """
+        frozensets of the pff_variables in each category, for fast
+        membership tests, e.g. pff_variable in meta.categories["median"].
+        The list properties (e.g. median_variables) are sorted copies
+        """
+        return {
+            "profile_only": frozenset(
+                i["pff_variable"]
+                for i in self.metadata
+                if (
+                    i["census_variable"][0][0:2] == "DP"
+                    and len(i["census_variable"]) == 1
+                    and i["pff_variable"] not in self.profile_only_exceptions
+                )
+            ),
+            "base": frozenset(i["base_variable"] for i in self.metadata),
+            "median": frozenset(self.median),
+            "median_inputs": frozenset(
+                k for i in self.median.values() for k in i["ranges"]
+            ),
+            "special": frozenset(i["pff_variable"] for i in self.special),
+        }
 
     def create_variable(self, pff_variable: str) -> Variable:
         """
-        given pff_variable name, return a Variable object
+        given pff_variable name, return the (shared) Variable object
+        """
+        return self.variables[pff_variable]
+
+    def incidence(self, pff_variables: list) -> tuple:
+        """
+        given a list of pff_variables, returns the E fields, the census field
+        x pff_variable incidence matrix of the E fields, the M fields and
+        the incidence matrix of the M fields. e.g. for ["mdpop65t66"]
+        (["B01001_020E", "B01001_044E"], [[1], [1]],
+        ["B01001_020M", "B01001_044M"], [[1], [1]])
+        so that E @ A_E sums the E fields of every pff_variable at once
         """
-        meta = next(
-            filter(lambda x: x["pff_variable"] == pff_variable, self.metadata))
-        return Variable(meta)
+        variables = [self.create_variable(i) for i in pff_variables]
+        census_variables = [i.census_variables for i in variables]
+        matrices = []
+        for k in [0, 1]:
+            fields = sorted(set(f for i in census_variables for f in i[k]))
+            index = {f: i for i, f in enumerate(fields)}
+            A = np.zeros((len(fields), len(variables)))
+            for j, i in enumerate(census_variables):
+                for f in i[k]:
+                    A[index[f], j] += 1
+            matrices += [fields, A]
+        return tuple(matrices)
+
+    def dependencies(self, pff_variable: str) -> list:
+        """
+        given pff_variable name, return the sorted list of pff_variables
+        (including itself) whose metadata goes into calculating it, i.e.
+        special base variables, median inputs, base variable and the
+        associated percent variable, followed recursively
+        """
+        pff_variables = self.variables
+        special_variables = self.categories["special"]
+        median_variables = self.categories["median"]
+        seen = set()
+        stack = [pff_variable]
+        while stack:
+            name = stack.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            if name in special_variables:
+                stack.extend(self.get_special_base_variables(name))
+            if name in median_variables:
+                stack.extend(self.median_ranges(name).keys())
+            if name in pff_variables:
+                base_variable = self.create_variable(name).base_variable
+                if base_variable in pff_variables:
+                    stack.append(base_variable)
+                if f"{name}_pct" in pff_variables:
+                    stack.append(f"{name}_pct")
+        return sorted(seen)
+
+    def fingerprint(self, pff_variable: str) -> str:
+        """
+        given pff_variable name, return a hash of every metadata, special
+        and median definition it depends on. The fingerprint changes
+        whenever one of those definitions change
+        """
+        if pff_variable not in self.fingerprints:
+            records = []
+            for name in self.dependencies(pff_variable):
+                variable = self.variables.get(name)
+                special = self.special_index.get(name)
+                records.append(
+                    [
+                        name,
+                        [variable.meta] if variable else [],
+                        [special] if special else [],
+                        self.median.get(name),
+                    ]
+                )
+            self.fingerprints[pff_variable] = fingerprint(
+                self.year, self.source, records
+            )
+        return self.fingerprints[pff_variable]
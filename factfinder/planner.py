@@ -0,0 +1,128 @@
+from graphlib import TopologicalSorter
+
+
+class Plan:
+    """
+    Dependency graph of the calculations needed for a list of pff_variables
+    and geotypes, built from metadata.json, special.json and median.json.
+    Nodes are (step, pff_variable, geotype) tuples, where step is one of the
+    Calculate methods in Plan.steps. The output node of a (pff_variable,
+    geotype) pair is the result of calling Calculate with it.
+
+    Calculate.calculate_many calculates the e_m and special nodes of the
+    plan in batches, one per geotype, and then every output node, so that
+    every node is calculated exactly once as long as Calculate.memo is
+    large enough to keep its result until the nodes depending on it are
+    calculated.
+    """
+
+    steps = {
+        "e_m": "calculate_e_m",
+        "e_m_p_z": "calculate_e_m_p_z",
+        "special": "calculate_e_m_special",
+        "median": "calculate_e_m_median",
+        "poverty_p_z": "calculate_poverty_p_z",
+        "output": "__call__",
+    }
+
+    def __init__(self, calculate, pff_variables: list, geotypes: list):
+        self.calculate = calculate
+        self.meta = calculate.meta
+        self.geo = calculate.geo
+        self.graph = {}
+        for geotype in geotypes:
+            for pff_variable in pff_variables:
+                self.add(("output", pff_variable, geotype))
+        self.order = list(TopologicalSorter(self.graph).static_order())
+
+    def add(self, node: tuple) -> None:
+        if node in self.graph:
+            return
+        self.graph[node] = self.dependencies(node)
+        for dependency in self.graph[node]:
+            self.add(dependency)
+
+    def dependencies(self, node: tuple) -> list:
+        """
+        given a node, return the nodes it is calculated from,
+        following the same rules as Calculate.calculate_c_e_m_p_z
+        """
+        step, pff_variable, geotype = node
+        aggregated = geotype in self.geo.aggregated_geography
+        if step in ["special", "median"]:
+            # inputs are calculated by calculate_e_m_multiprocessing
+            inputs = (
+                self.meta.get_special_base_variables(pff_variable)
+                if step == "special"
+                else list(self.meta.median_ranges(pff_variable).keys())
+            )
+            special = self.meta.categories["special"]
+            return [("special" if i in special else "e_m", i, geotype) for i in inputs]
+        if step == "poverty_p_z":
+            return [("e_m", f"{pff_variable}_pct", geotype)]
+        if step == "e_m":
+            intermediate = self.calculate.intermediate_geotype(geotype)
+            return [("e_m", pff_variable, intermediate)] if intermediate else []
+        if step != "output":
+            return []
+
+        if pff_variable in self.meta.categories["profile_only"] and not aggregated:
+            return [("e_m_p_z", pff_variable, geotype)]
+        if pff_variable in self.meta.categories["median"]:
+            return [("median" if aggregated else "e_m", pff_variable, geotype)]
+        special = (
+            pff_variable in self.meta.categories["special"] and aggregated
+        ) or pff_variable == "wrkrnothm"
+        nodes = [("special" if special else "e_m", pff_variable, geotype)]
+        if pff_variable in self.meta.categories["base"]:
+            return nodes
+        if (
+            pff_variable in self.calculate.poverty_variables
+            and not aggregated
+            and self.calculate.year != 2010
+        ):
+            return nodes + [("poverty_p_z", pff_variable, geotype)]
+        base_variable = self.meta.create_variable(pff_variable).base_variable
+        if base_variable != "nan":
+            median = base_variable in self.meta.categories["median"] and aggregated
+            nodes.append(("median" if median else "e_m", base_variable, geotype))
+        return nodes
+
+    @property
+    def dependents(self) -> dict:
+        """
+        returns the nodes that depend on each node
+        """
+        dependents = {node: [] for node in self.graph}
+        for node, dependencies in self.graph.items():
+            for dependency in dependencies:
+                dependents[dependency].append(node)
+        return dependents
+
+    @property
+    def critical_path(self) -> list:
+        """
+        returns the longest chain of nodes that have to be calculated
+        one after the other
+        """
+        path = {}
+        for node in self.order:
+            path[node] = max(
+                [path[i] for i in self.graph[node]], key=len, default=[]
+            ) + [node]
+        return max(path.values(), key=len, default=[])
+
+    def report(self) -> dict:
+        """
+        returns the number of nodes (by step), the number of nodes shared by
+        more than one dependent and the critical path of the plan
+        """
+        steps = {}
+        for step, _, _ in self.graph:
+            steps[step] = steps.get(step, 0) + 1
+        return {
+            "nodes": len(self.graph),
+            "steps": steps,
+            "shared": len([i for i in self.dependents.values() if len(i) > 1]),
+            "critical_path": self.critical_path,
+        }
@@ -1,142 +1,161 @@
-import math
+import ast
+from graphlib import TopologicalSorter
 
 import numpy as np
 import pandas as pd
 
 
-def pivot(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+def pivot(df: pd.DataFrame, base_variables: list) -> tuple:
+    """
+    given the e and m of base_variables, returns the census_geoids and a
+    dict of arrays, one per base variable and field, named {variable}e
+    and {variable}m, aligned with the census_geoids
+    """
     dff = df.loc[:, ["census_geoid", "pff_variable", "e", "m"]].pivot(
         index="census_geoid", columns="pff_variable", values=["e", "m"]
     )
-    pivoted = pd.DataFrame()
-    pivoted["census_geoid"] = dff.index
-    del df
+    values = {}
     for i in base_variables:
-        pivoted[i + "e"] = dff.e.loc[pivoted.census_geoid, i].to_list()
-        pivoted[i + "m"] = dff.m.loc[pivoted.census_geoid, i].to_list()
-    del dff
-    return pivoted
-
-
-def hovacrtm(hovacue, vacsalee, vacsalem, hovacum):
-    if hovacue == 0:
-        return 0
-    elif vacsalee == 0:
-        return 0
-    elif vacsalem ** 2 - (vacsalee * hovacum / hovacue) ** 2 < 0:
-        return (
-            math.sqrt(vacsalem ** 2 + (vacsalee * hovacum / hovacue) ** 2)
-            / hovacue
-            * 100
-        )
-    else:
-        return (
-            math.sqrt(vacsalem ** 2 - (vacsalee * hovacum / hovacue) ** 2)
-            / hovacue
-            * 100
-        )
-
-
-def percapinc(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = df.agip15ple / df.pop_6e
-    df["m"] = (
-        1
-        / df.pop_6e
-        * np.sqrt(df.agip15plm ** 2 + (df.agip15ple * df.pop_6m / df.pop_6e) ** 2)
+        values[i + "e"] = dff["e"][i].to_numpy("float64")
+        values[i + "m"] = dff["m"][i].to_numpy("float64")
+    return dff.index.to_numpy(), values
+
+
+def null_zero(x):
+    """
+    zeros are missing values
+    """
+    return np.where(x == 0, np.nan, x)
+
+
+def proportion_moe(e, m, agg_e, agg_m):
+    """
+    moe of a proportion (in percent) of e over agg_e, 0 when either e or
+    agg_e is 0. Falls back to the moe of a ratio when the term under the
+    square root is negative
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = (e * agg_m / agg_e) ** 2
+        d = m ** 2 - ratio
+        moe = np.where(d < 0, np.sqrt(m ** 2 + ratio), np.sqrt(d)) / agg_e * 100
+    return np.where((agg_e == 0) | (e == 0), 0, moe)
+
+
+class Formula:
+    """
+    e and m of a special variable, declared in special.json as arithmetic
+    expressions of the e and m of its base variables ({variable}e and
+    {variable}m), numbers and the functions below, e.g.
+    {
+        "pff_variable": "wrkrnothm",
+        "base_variables": ["wrkr16pl", "cw_wrkdhm"],
+        "e": "wrkr16ple - cw_wrkdhme",
+        "m": "(wrkr16plm ** 2 + cw_wrkdhmm ** 2) ** 0.5"
+    }
+    Expressions are parsed once and only the nodes below are allowed, so
+    they can be evaluated on numpy arrays without running arbitrary code
+    """
+
+    functions = {
+        "sqrt": np.sqrt,
+        "where": np.where,
+        "null_zero": null_zero,
+        "proportion_moe": proportion_moe,
+    }
+    nodes = (
+        ast.Expression,
+        ast.BinOp,
+        ast.UnaryOp,
+        ast.Compare,
+        ast.Call,
+        ast.Name,
+        ast.Load,
+        ast.Constant,
+        ast.Add,
+        ast.Sub,
+        ast.Mult,
+        ast.Div,
+        ast.Pow,
+        ast.USub,
+        ast.Eq,
+        ast.NotEq,
+        ast.Lt,
+        ast.LtE,
+        ast.Gt,
+        ast.GtE,
     )
-    return df
-
 
-def mntrvtm(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = df["agttme"] / (df["wrkr16ple"] - df["cw_wrkdhme"])
-    df["m"] = (
-        1
-        / df["wrkrnothme"]
-        * np.sqrt(
-            df["agttmm"] ** 2
-            + (df["agttme"] * df["wrkrnothmm"] / df["wrkrnothme"]) ** 2
+    def __init__(self, special: dict):
+        self.pff_variable = special["pff_variable"]
+        self.base_variables = special["base_variables"]
+        inputs = [i + field for i in self.base_variables for field in ["e", "m"]]
+        self.e = self.compile(special["e"], inputs)
+        self.m = self.compile(special["m"], inputs)
+
+    def compile(self, expression: str, inputs: list):
+        tree = ast.parse(expression, mode="eval")
+        for node in ast.walk(tree):
+            if not isinstance(node, self.nodes):
+                raise ValueError(
+                    f"{self.pff_variable}: {type(node).__name__} is not allowed"
+                    f" in {expression}"
+                )
+            if isinstance(node, ast.Name) and node.id not in inputs + ["nan"]:
+                if node.id not in self.functions:
+                    raise ValueError(
+                        f"{self.pff_variable}: unknown name {node.id} in {expression}"
+                    )
+            if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and node.func.id in self.functions
+            ):
+                raise ValueError(
+                    f"{self.pff_variable}: only {list(self.functions)} can be"
+                    f" called in {expression}"
+                )
+            if isinstance(node, ast.Constant) and not isinstance(
+                node.value, (int, float)
+            ):
+                raise ValueError(
+                    f"{self.pff_variable}: {node.value!r} is not a number"
+                    f" in {expression}"
+                )
+        return compile(tree, f"<{self.pff_variable}>", "eval")
+
+    def __call__(self, values: dict) -> tuple:
+        """
+        given a dict of input arrays, returns the arrays of e and m
+        """
+        namespace = {"__builtins__": {}, "nan": np.nan, **self.functions, **values}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return eval(self.e, namespace), eval(self.m, namespace)
+
+
+def evaluate(df: pd.DataFrame, formulas: list) -> pd.DataFrame:
+    """
+    given the e and m of the base variables of formulas, returns the
+    census_geoid, pff_variable, e and m of every formula, one after the
+    other. Formulas are evaluated over one geography x input matrix, after
+    the formulas they use the result of (e.g. wrkrnothm before mntrvtm)
+    """
+    index = {f.pff_variable: f for f in formulas}
+    order = TopologicalSorter(
+        {f.pff_variable: [i for i in f.base_variables if i in index] for f in formulas}
+    ).static_order()
+    base_variables = sorted(set(i for f in formulas for i in f.base_variables))
+    geoids, values = pivot(df, [i for i in base_variables if i not in index])
+    dfs = []
+    for formula in [index[i] for i in order]:
+        e, m = formula(values)
+        values[formula.pff_variable + "e"] = e
+        values[formula.pff_variable + "m"] = m
+        dfs.append(
+            pd.DataFrame(
+                {
+                    "census_geoid": geoids,
+                    "pff_variable": formula.pff_variable,
+                    "e": e,
+                    "m": m,
+                }
+            )
         )
-    )
-    return df
-
-
-def mnhhinc(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = df["aghhince"] / df["hh2e"]
-    df["m"] = (
-        1
-        / df["hh5e"]
-        * np.sqrt(df["aghhincm"] ** 2 + (df["aghhince"] * df["hh5m"] / df["hh5e"]) ** 2)
-    )
-    return df
-
-
-def avghhsooc(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = df["popoochue"] / df["oochu1e"]
-    df["m"] = (
-        df["popoochum"] ** 2 + (df["popoochue"] * df["oochu4m"] / df["oochu4e"]) ** 2
-    ) ** 0.5 / df["oochu4e"]
-    return df
-
-
-def avghhsroc(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = df["poprtochue"] / df["rochu1e"]
-    df["m"] = (
-        df["poprtochum"] ** 2 + (df["poprtochue"] * df["rochu2m"] / df["rochu2e"]) ** 2
-    ) ** 0.5 / df["rochu2e"]
-    return df
-
-
-def avghhsz(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = df["hhpop1e"] / df["hh1e"]
-    df["m"] = (
-        df["hhpop1m"] ** 2 + (df["hh4m"] * df["hhpop1e"] / df["hh4e"]) ** 2
-    ) ** 0.5 / df["hh4e"]
-    return df
-
-
-def avgfmsz(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = df["popinfmse"] / df["fam1e"]
-    df["m"] = (
-        df["popinfmsm"] ** 2 + (df["fam3m"] * df["popinfmse"] / df["fam3e"]) ** 2
-    ) ** 0.5 / df["fam3e"]
-    return df
-
-
-def hovacrt(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = 100 * df["vacsalee"] / df["hovacue"]
-    df["m"] = df.apply(
-        lambda row: hovacrtm(
-            row["hovacue"], row["vacsalee"], row["vacsalem"], row["hovacum"]
-        ),
-        axis=1,
-    )
-    df.loc[df.e == 0, "e"] = np.nan
-    return df
-
-
-def rntvacrt(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = 100 * df["vacrnte"] / df["rntvacue"]
-    df["m"] = df.apply(
-        lambda row: hovacrtm(
-            row["rntvacue"], row["vacrnte"], row["vacrntm"], row["rntvacum"]
-        ),
-        axis=1,
-    )
-    df.loc[df.e == 0, "e"] = np.nan
-    return df
-
-
-def wrkrnothm(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
-    df = pivot(df, base_variables)
-    df["e"] = df["wrkr16ple"] - df["cw_wrkdhme"]
-    df["m"] = (df["wrkr16plm"] ** 2 + df["cw_wrkdhmm"] ** 2) ** 0.5
-    return df
+    return pd.concat(dfs, ignore_index=True)
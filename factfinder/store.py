@@ -0,0 +1,189 @@
+import os
+import shutil
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .utils import atomic_write, cache_lock
+
+
+class Store:
+    """
+    Columnar on-disk store for downloaded census fields. Every field is
+    saved as a float64 .npy array aligned to one shared census_geoid
+    index per year, source and geotype. Fields are stored under a version,
+    e.g. a fingerprint of the download code, so that a new version never
+    reads fields written by an older one, e.g.
+
+    .cache/download/year=2019/source=acs/version=1a2b3c/geotype=tract/census_geoid.npy
+    .cache/download/year=2019/source=acs/version=1a2b3c/geotype=tract/B01001_044E.npy
+
+    Large geotypes can be split into partitions (e.g. one per county),
+    each with its own census_geoid index, so that they can be written as
+    they are downloaded and read back in bounded-size chunks.
+    """
+
+    def __init__(self, year, source, version=None, base_path=".cache/download"):
+        self.year = year
+        self.source = source
+        self.version = version
+        self.base_path = base_path
+
+    def path(self, geotype: str, partition: str = None) -> Path:
+        path = Path(self.base_path) / f"year={self.year}" / f"source={self.source}"
+        if self.version:
+            path = path / f"version={self.version}"
+        path = path / f"geotype={geotype}"
+        if partition is not None:
+            path = path / f"partition={partition}"
+        return path
+
+    def prune(self) -> list:
+        """
+        delete the fields stored under any other version for the year and
+        source, and the lock files of the current version, e.g. before the
+        store is saved to a CI cache. Returns the deleted paths
+        """
+        path = Path(self.base_path) / f"year={self.year}" / f"source={self.source}"
+        if not path.is_dir():
+            return []
+        current = path / f"version={self.version}" if self.version else path
+        deleted = []
+        for i in sorted(path.glob("version=*")):
+            if i != current:
+                shutil.rmtree(i)
+                deleted.append(i)
+        for i in sorted(current.glob("**/*.lock")):
+            os.remove(i)
+            deleted.append(i)
+        return deleted
+
+    def field_path(self, geotype: str, field: str, partition: str = None) -> Path:
+        return self.path(geotype, partition) / f"{field}.npy"
+
+    def index(self, geotype: str, partition: str = None) -> np.ndarray:
+        """
+        returns the census_geoid index shared by all fields of the geotype
+        (or of one partition of the geotype), or None if nothing has been
+        stored for it yet
+        """
+        path = self.field_path(geotype, "census_geoid", partition)
+        if not os.path.isfile(path):
+            return None
+        return np.load(path)
+
+    def missing(self, geotype: str, fields: list, partitions: list = None) -> list:
+        """
+        given a list of census fields, return the ones not in the store,
+        for a partitioned geotype, the ones missing from any of the partitions
+        """
+        return [
+            i
+            for i in fields
+            if not all(
+                os.path.isfile(self.field_path(geotype, i, partition))
+                for partition in (partitions or [None])
+            )
+        ]
+
+    def read(self, geotype: str, fields: list, partitions: list = None) -> pd.DataFrame:
+        """
+        returns a dataframe with census_geoid and the given census fields
+        """
+        return pd.concat(
+            [
+                self.read_partition(geotype, fields, partition)
+                for partition in (partitions or [None])
+            ],
+            ignore_index=True,
+        )
+
+    def read_partition(
+        self, geotype: str, fields: list, partition: str = None, mmap_mode=None
+    ) -> pd.DataFrame:
+        # all fields are added at once, wide reads are not fragmented
+        index = self.index(geotype, partition)
+        columns = {"census_geoid": index.astype(object)}
+        for field in fields:
+            columns[field] = np.load(
+                self.field_path(geotype, field, partition), mmap_mode=mmap_mode
+            )[: len(index)]
+        return pd.DataFrame(columns)
+
+    def read_chunks(
+        self, geotype: str, fields: list, partitions: list = None, chunksize=50000
+    ):
+        """
+        same as read, but yields dataframes of at most chunksize rows.
+        Fields are memory mapped, so only one chunk is loaded at a time
+        """
+        for partition in partitions or [None]:
+            index = np.load(
+                self.field_path(geotype, "census_geoid", partition), mmap_mode="r"
+            )
+            values = {
+                field: np.load(
+                    self.field_path(geotype, field, partition), mmap_mode="r"
+                )
+                for field in fields
+            }
+            for i in range(0, len(index), chunksize):
+                df = pd.DataFrame(
+                    {"census_geoid": index[i : i + chunksize].astype(object)}
+                )
+                for field in fields:
+                    df[field] = np.array(values[field][i : i + chunksize])
+                yield df
+
+    def lock(self, geotype: str, fields: list) -> ExitStack:
+        """
+        lock the given fields of a geotype across processes, so that only
+        one process downloads a missing field while the others wait for it.
+        Locks are always acquired in the same order to avoid deadlocks
+        """
+        os.makedirs(self.path(geotype), exist_ok=True)
+        with ExitStack() as stack:
+            for field in sorted(set(fields)):
+                stack.enter_context(cache_lock(self.field_path(geotype, field)))
+            return stack.pop_all()
+
+    def save(
+        self, geotype: str, field: str, values: np.ndarray, partition: str = None
+    ) -> None:
+        path = self.field_path(geotype, field, partition)
+        with atomic_write(path) as tmp:
+            with open(tmp, "wb") as f:
+                np.save(f, values)
+
+    def write(self, geotype: str, df: pd.DataFrame, partition: str = None) -> None:
+        """
+        store every column of df other than census_geoid as a separate field,
+        aligned to the geotype's (or partition's) census_geoid index, which
+        is created by the first write for the geotype (or partition). Geoids
+        of df that are not in the index yet are appended to it, and the
+        fields already stored are padded with NaN for them
+        """
+        os.makedirs(self.path(geotype, partition), exist_ok=True)
+        # the index and fields are written under one lock, so that no field
+        # is written against an index that is being extended
+        with cache_lock(self.field_path(geotype, "census_geoid", partition)):
+            geoids = df.census_geoid.to_numpy(dtype=str)
+            index = self.index(geotype, partition)
+            if index is None:
+                index = geoids
+                self.save(geotype, "census_geoid", index, partition)
+            new = pd.unique(geoids[~np.isin(geoids, index)])
+            if len(new):
+                # fields are padded before the index is extended, reads
+                # only take as many values of a field as there are geoids
+                for path in sorted(self.path(geotype, partition).glob("*.npy")):
+                    if path.stem != "census_geoid":
+                        values = np.append(np.load(path), np.full(len(new), np.nan))
+                        self.save(geotype, path.stem, values, partition)
+                index = np.concatenate([index, new])
+                self.save(geotype, "census_geoid", index, partition)
+            df = df.set_index("census_geoid").reindex(index)
+            for field in df.columns:
+                self.save(geotype, field, df[field].to_numpy("float64"), partition)
@@ -1,5 +1,10 @@
+import fcntl
+import hashlib
+import json
 import math
 import os
+import tempfile
+from contextlib import contextmanager
 from pathlib import Path
 
 import numpy as np
@@ -48,22 +53,122 @@ def get_z(e, m, p, agg_e, agg_m):
         return math.sqrt(m ** 2 - (e * agg_m / agg_e) ** 2) / agg_e * 100
 
 
-def rounding(df: pd.DataFrame, digits: int) -> pd.DataFrame:
+def get_c_array(e, m) -> np.ndarray:
     """
-    Round c, e, m, p, z fields based on rounding digits from metadata
+    array version of get_c, for arrays (or series) of e and m
+    """
+    e, m = np.asarray(e, dtype="float64"), np.asarray(m, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(e == 0, np.nan, m / 1.645 / e * 100)
+
+
+def get_p_array(e, agg_e) -> np.ndarray:
+    """
+    array version of get_p, for arrays (or series) of e and agg_e
+    """
+    e, agg_e = np.asarray(e, dtype="float64"), np.asarray(agg_e, dtype="float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(agg_e == 0, np.nan, e / agg_e * 100)
+
+
+def get_z_array(e, m, p, agg_e, agg_m) -> np.ndarray:
+    """
+    array version of get_z, for arrays (or series) of e, m, p, agg_e and agg_m
+    """
+    e, m, p, agg_e, agg_m = [
+        np.asarray(i, dtype="float64") for i in (e, m, p, agg_e, agg_m)
+    ]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d = m ** 2 - (e * agg_m / agg_e) ** 2
+        z = np.where(
+            d < 0,
+            np.sqrt(m ** 2 + (e * agg_m / agg_e) ** 2) / agg_e * 100,
+            np.sqrt(d) / agg_e * 100,
+        )
+    return np.where((p == 0) | (p == 100) | (agg_e == 0), np.nan, z)
+
+
+def rounding(df: pd.DataFrame, digits) -> pd.DataFrame:
+    """
+    Round c, e, m, p, z fields based on rounding digits from metadata,
+    digits is either an int or a series with the digits of each row
     """
     df["c"] = df["c"].round(1)
-    df["e"] = df["e"].round(digits)
-    df["m"] = df["m"].round(digits)
+    if isinstance(digits, pd.Series):
+        digits = digits.to_numpy()
+        for i in np.unique(digits):
+            rows = digits == i
+            df.loc[rows, "e"] = df.loc[rows, "e"].round(i)
+            df.loc[rows, "m"] = df.loc[rows, "m"].round(i)
+    else:
+        df["e"] = df["e"].round(digits)
+        df["m"] = df["m"].round(digits)
     df["p"] = df["p"].round(1)
     df["z"] = df["z"].round(1)
     return df
 
 
+@contextmanager
+def cache_lock(path: str):
+    """
+    exclusive lock on a cache entry shared by all processes, held on a
+    {path}.lock file next to the entry. Used to make sure only one
+    process computes a missing entry while the others wait for it
+    """
+    os.makedirs(Path(path).parent, exist_ok=True)
+    with open(f"{path}.lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_write(path: str):
+    """
+    yields a temporary path next to path to write to, and moves it
+    into place once it is fully written, so readers never see a
+    partially written file
+    """
+    fd, tmp = tempfile.mkstemp(dir=Path(path).parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+
 def write_to_cache(df: pd.DataFrame, path: str):
     """
     this function will cache a dataframe to a given path
     """
     if not os.path.isfile(path):
-        df.to_pickle(path)
+        with atomic_write(path) as tmp:
+            df.to_pickle(tmp)
     return None
+
+
+def fingerprint(*args) -> str:
+    """
+    returns a short, stable hash of json serializable arguments
+    """
+    return hashlib.sha1(
+        json.dumps(args, sort_keys=True, default=str).encode()
+    ).hexdigest()[:12]
+
+
+def file_fingerprint(*paths) -> str:
+    """
+    returns a short hash of the content of the given files,
+    files that don't exist are hashed by name only
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        h.update(Path(path).name.encode())
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()[:12]
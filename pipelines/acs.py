@@ -1,27 +1,59 @@
 import argparse
-import os
 import sys
 from typing import Tuple
 
-import pandas as pd
 from pathos.pools import ProcessPool
 
 from factfinder.calculate import Calculate
 
 from . import API_KEY
+from .checkpoint import Checkpoint
+from .scheduler import Scheduler
+from .writer import PartitionedWriter
+
+# Calculate instance of a worker, built once by _initialize
+calculate = None
+
+
+def _initialize(year: int, geography: str) -> None:
+    """
+    pool initializer, every worker builds its own Calculate once instead
+    of receiving a pickled copy with every task. Lookups and operators
+    are loaded from the artifacts compiled by the main process
+    """
+    global calculate
+    calculate = Calculate(api_key=API_KEY, year=year, source="acs", geography=geography)
 
 
 def _calculate(args):
-    var, domain, geo, calculate = args
+    """
+    calculate a task, returns the dataframe of the pairs calculated (or
+    None) and the {(pff_variable, geotype): error} of the pairs that failed
+    """
+    variables, geogs = args
+    failures = {}
     try:
-        df = calculate(var, geo).assign(domain=domain)
-        print(f"✅ SUCCESS: {var}\t{geo}", file=sys.stdout)
-        return df
-    except:
-        print(f"⛔️ FAILURE: {var}\t{geo}", file=sys.stdout)
+        df = calculate.calculate_many(
+            variables, geogs, errors="ignore", failures=failures
+        )
+    except Exception as e:
+        # e.g. the batch could not be rounded, cleaned or labeled
+        df = None
+        failures = {
+            (var, geo): failures.get((var, geo), repr(e))
+            for var in variables
+            for geo in geogs
+        }
+    for var in variables:
+        for geo in geogs:
+            if (var, geo) not in failures:
+                print(f"✅ SUCCESS: {var}\t{geo}", file=sys.stdout)
+            else:
+                print(f"⛔️ FAILURE: {var}\t{geo}", file=sys.stdout)
+    return df, failures
 
 
-def parse_args() -> Tuple[int, str]:
+def parse_args() -> Tuple[int, str, int, int, bool]:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-y", "--year", type=int, help="The ACS5 year, e.g. 2019 (2014-2018)"
@@ -29,35 +61,111 @@ def parse_args() -> Tuple[int, str]:
     parser.add_argument(
         "-g", "--geography", type=str, help="The geography year, e.g. 2010_to_2020"
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="The number of worker processes, based on the available cores by default",
+    )
+    parser.add_argument(
+        "--api-concurrency",
+        type=int,
+        default=50,
+        help="The maximum number of concurrent census API requests",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only calculate the pairs that are missing or failed in the last run",
+    )
     args = parser.parse_args()
-    return args.year, args.geography
+    return (args.year, args.geography, args.workers, args.api_concurrency, args.resume)
 
 
 if __name__ == "__main__":
     # Get ACS year
-    year, geography = parse_args()
-    pool = ProcessPool(nodes=10)
+    year, geography, workers, api_concurrency, resume = parse_args()
 
     # Initialize pff instance
-    calculate = Calculate(api_key=API_KEY, year=year, source="acs", geography=geography)
+    _initialize(year, geography)
 
     # Declare geography and variables involved in this caculation
     geogs = ["NTA", "CDTA", "CT20", "city", "borough"]
     if geography != "2010_to_2020":
         geogs.extend(["tract"])
     domains = ["demographic", "economic", "housing", "social"]
-    variables = [
-        (i["pff_variable"], i["domain"], j, calculate)
+    domain = {
+        i["pff_variable"]: i["domain"]
         for i in calculate.meta.metadata
-        for j in geogs
         if i["domain"] in domains
-    ]
-
-    # Loop through calculations and collect dataframes in dfs
-    dfs = pool.map(_calculate, variables)
+    }
+    variables = list(domain.keys())
+    pairs = [(var, geo) for var in variables for geo in geogs]
 
-    # Concatenate dataframes and export to 1 large csv
+    # Every result is saved as soon as it is calculated, so that a run can be
+    # resumed, e.g. after an API outage. Pairs whose metadata changed since
+    # they were saved are calculated again
     output_folder = f".output/acs/year={year}/geography={geography}"
-    df = pd.concat(dfs)
-    os.makedirs(output_folder, exist_ok=True)
-    df.to_csv(f"{output_folder}/acs.csv", index=False)
+    checkpoint = Checkpoint(
+        f"{output_folder}/checkpoint",
+        run={
+            "year": year,
+            "geography": geography,
+            "calculate": calculate.version,
+            "download": calculate.d.version,
+            "geography_version": calculate.geo.version,
+            "pairs": len(pairs),
+        },
+        resume=resume,
+        key=calculate.meta.fingerprint,
+    )
+
+    # Variables are calculated in batches of variables sharing their inputs,
+    # for geotypes calculated from the same geotype. Every batch is rounded,
+    # cleaned and labeled at once
+    scheduler = Scheduler(
+        calculate,
+        variables,
+        geogs,
+        api_concurrency=api_concurrency,
+        exclude=checkpoint.done(),
+    )
+
+    # Download all census variables up front in as few API calls as possible
+    calculate.prefetch(geogs)
+
+    # Build the metadata, geography lookups and operators once,
+    # workers unpickle or memory map the compiled artifacts
+    calculate.meta.compile()
+    calculate.geo.compile()
+
+    # Results are written to partitions by domain and geotype as they complete,
+    # starting with the results of the previous run when resuming.
+    # Tasks only carry variable names and geotypes
+    writer = PartitionedWriter(f"{output_folder}/partitions", ["domain", "geotype"])
+    for df in checkpoint.results():
+        df["domain"] = df.pff_variable.map(domain)
+        writer.write(df)
+    if scheduler.tasks:
+        pool = ProcessPool(
+            nodes=workers or scheduler.workers,
+            initializer=_initialize,
+            initargs=(year, geography),
+        )
+        for df, failures in scheduler.map(pool, _calculate):
+            df = checkpoint.save(df, failures)
+            if df is not None:
+                df["domain"] = df.pff_variable.map(domain)
+                writer.write(df)
+        print(scheduler.report(), file=sys.stdout)
+    writer.close()
+    summary = checkpoint.close(pairs)
+    print(
+        f"{summary['succeeded']} of {summary['pairs']} pairs calculated, "
+        f"{summary['failed']} failed, see {output_folder}/checkpoint/failures.json",
+        file=sys.stdout,
+    )
+
+    # Concatenate the partitions into 1 large csv
+    writer.to_csv(f"{output_folder}/acs.csv")
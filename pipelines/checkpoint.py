@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+from factfinder.utils import atomic_write, write_to_cache
+
+
+class Checkpoint:
+    """
+    Results of a pipeline run, saved (pff_variable, geotype) pair by pair
+    as they complete, with a manifest.json recording the status of every
+    pair, e.g.
+
+    checkpoint/manifest.json
+    checkpoint/results/geotype=NTA/pop_1.pkl
+
+    With resume, the pairs that succeeded in a previous run with the same
+    run key (year, geography and versions of the code and data) are kept,
+    so that only the missing and failed pairs are calculated again. Every
+    pair is also saved with key(pff_variable), e.g. the fingerprint of the
+    metadata the variable depends on, and is calculated again if its key
+    changed.
+    """
+
+    def __init__(self, path: str, run: dict, resume: bool = False, key=None):
+        self.path = Path(path)
+        self.run = run
+        self.key = key or (lambda pff_variable: None)
+        self.pairs = {}
+        manifest = self.read_manifest() if resume else None
+        if manifest and manifest["run"] == run:
+            self.pairs = {
+                (i["pff_variable"], i["geotype"]): i for i in manifest["pairs"]
+            }
+        else:
+            if manifest:
+                logging.warning("The previous run is out of date, starting over")
+            if self.path.is_dir():
+                shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def read_manifest(self) -> dict:
+        path = self.path / "manifest.json"
+        if not path.is_file():
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def write_json(self, name: str, content: dict) -> None:
+        with atomic_write(self.path / name) as tmp:
+            with open(tmp, "w") as f:
+                json.dump(content, f, indent=4)
+
+    def result_path(self, pff_variable: str, geotype: str) -> Path:
+        return self.path / "results" / f"geotype={geotype}" / f"{pff_variable}.pkl"
+
+    def done(self) -> set:
+        """
+        returns the (pff_variable, geotype) pairs calculated successfully,
+        with the current key of their pff_variable
+        """
+        return set(
+            k
+            for k, i in self.pairs.items()
+            if i["status"] == "success" and i.get("key") == self.key(k[0])
+        )
+
+    def save(self, df: pd.DataFrame, failures: dict) -> pd.DataFrame:
+        """
+        save the results of a task, df (or None if the whole task failed)
+        and the {(pff_variable, geotype): error} of its failed pairs, then
+        update the manifest. Returns the rows of df for the pairs that had
+        not been saved yet
+        """
+        done = self.done()
+        for (pff_variable, geotype), error in failures.items():
+            if (pff_variable, geotype) not in done:
+                self.pairs[(pff_variable, geotype)] = {
+                    "pff_variable": pff_variable,
+                    "geotype": geotype,
+                    "status": "failure",
+                    "error": error,
+                }
+        if df is not None:
+            df = df[
+                [i not in done for i in zip(df.pff_variable, df.geotype)]
+            ].reset_index(drop=True)
+            for (pff_variable, geotype), result in df.groupby(
+                ["pff_variable", "geotype"], sort=False
+            ):
+                path = self.result_path(pff_variable, geotype)
+                os.makedirs(path.parent, exist_ok=True)
+                write_to_cache(result, str(path))
+                self.pairs[(pff_variable, geotype)] = {
+                    "pff_variable": pff_variable,
+                    "geotype": geotype,
+                    "status": "success",
+                    "key": self.key(pff_variable),
+                    "path": str(path.relative_to(self.path)),
+                }
+        self.write_json(
+            "manifest.json",
+            {"run": self.run, "pairs": [self.pairs[k] for k in sorted(self.pairs)]},
+        )
+        return df
+
+    def results(self):
+        """
+        yields the saved dataframe of every successful pair
+        """
+        for k in sorted(self.done()):
+            yield pd.read_pickle(self.path / self.pairs[k]["path"])
+
+    def close(self, pairs: list) -> dict:
+        """
+        given every (pff_variable, geotype) pair of the run, write and
+        return the failure summary, pairs that were never saved are missing
+        and pairs saved with a previous key are outdated
+        """
+        done = self.done()
+        failures = []
+        for pff_variable, geotype in pairs:
+            pair = self.pairs.get((pff_variable, geotype), {"status": "missing"})
+            if (pff_variable, geotype) not in done:
+                failures.append(
+                    {
+                        "pff_variable": pff_variable,
+                        "geotype": geotype,
+                        "status": "outdated"
+                        if pair["status"] == "success"
+                        else pair["status"],
+                        "error": pair.get("error"),
+                    }
+                )
+        summary = {
+            "run": self.run,
+            "pairs": len(pairs),
+            "succeeded": len(pairs) - len(failures),
+            "failed": len(failures),
+            "failures": failures,
+        }
+        self.write_json("failures.json", summary)
+        return summary
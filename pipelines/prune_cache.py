@@ -0,0 +1,48 @@
+import argparse
+import logging
+from pathlib import Path
+
+import factfinder.geography
+from factfinder.calculate import Calculate
+from factfinder.download import Download
+from factfinder.geography import prune_lookups
+
+from . import API_KEY
+
+
+def parse_args() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-y", "--year", type=int, help="The ACS5 year, e.g. 2019 (2014-2018)"
+    )
+    args = parser.parse_args()
+    return args.year
+
+
+if __name__ == "__main__":
+    # Get ACS year
+    year = parse_args()
+
+    # Only the fields of the current download version are kept, so that
+    # the cache saved by the workflow does not grow with every version
+    d = Download(api_key=API_KEY, year=year, source="acs")
+    deleted = d.store.prune()
+
+    # Only the calculations and results keyed by the current metadata, code
+    # and geography versions are kept, for every geography
+    geographies = sorted(
+        i.stem
+        for i in Path(factfinder.geography.__file__).parent.glob("*.py")
+        if i.stem != "__init__"
+    )
+    versions = []
+    for geography in geographies:
+        calculate = Calculate(API_KEY, year=year, source="acs", geography=geography)
+        deleted.extend(calculate.prune())
+        versions.append(calculate.geo.version)
+
+    # Same for the lookups and operators, which are shared by every year
+    deleted.extend(prune_lookups(versions))
+
+    for path in deleted:
+        logging.info(f"deleted {path}")
@@ -0,0 +1,206 @@
+import os
+import time
+from functools import cached_property
+from itertools import groupby
+
+
+def available_cores() -> int:
+    """
+    number of cores this process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def timed(func):
+    """
+    wraps a task function so that it returns the worker pid, the start
+    and end time of the task along with its result
+    """
+
+    def wrapper(task):
+        start = time.time()
+        result = func(task)
+        return os.getpid(), start, time.time(), result
+
+    return wrapper
+
+
+class Scheduler:
+    """
+    Splits the (pff_variable, geotype) pairs of a pipeline run into tasks
+    that share as many intermediate results as possible, so that they stay
+    in the memo of the worker calculating the task.
+
+    Variables are clustered with the variables they are calculated from
+    (base variable, special and median inputs, percent variable), and the
+    clusters are cut into chunks of at most cluster_size variables, keeping
+    variables with the same base variable together. Geotypes are grouped by
+    the geotype they are calculated from, e.g. NTA, CDTA and CT20 are all
+    calculated from tracts. A task is one chunk of variables for one group
+    of geotypes. Pairs in exclude (e.g. calculated by a previous run) are
+    left out of the tasks, unless another pair of the task needs them.
+    """
+
+    def __init__(
+        self,
+        calculate,
+        pff_variables: list,
+        geotypes: list,
+        cluster_size: int = 20,
+        api_concurrency: int = 50,
+        exclude: set = None,
+    ):
+        self.calculate = calculate
+        self.meta = calculate.meta
+        self.pff_variables = pff_variables
+        self.geotypes = geotypes
+        self.cluster_size = cluster_size
+        self.api_concurrency = api_concurrency
+        self.exclude = exclude or set()
+        self.timings = []
+
+    def inputs(self, pff_variable: str) -> list:
+        """
+        the pff_variables pff_variable is directly calculated from
+        """
+        inputs = [f"{pff_variable}_pct"]
+        if pff_variable in self.meta.variables:
+            inputs.append(self.meta.create_variable(pff_variable).base_variable)
+        if pff_variable in self.meta.categories["special"]:
+            inputs.extend(self.meta.get_special_base_variables(pff_variable))
+        if pff_variable in self.meta.categories["median"]:
+            inputs.extend(self.meta.median_ranges(pff_variable).keys())
+        return [i for i in inputs if i != "nan"]
+
+    def clusters(self) -> list:
+        """
+        returns lists of pff_variables, the connected components of the
+        variables and their inputs cut into chunks of cluster_size. Small
+        components are packed together, so that they are still calculated
+        in batches of up to cluster_size variables
+        """
+        parent = {}
+
+        def find(i):
+            parent.setdefault(i, i)
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for pff_variable in self.pff_variables:
+            for i in self.inputs(pff_variable):
+                parent[find(i)] = find(pff_variable)
+
+        def key(pff_variable):
+            variable = self.meta.variables.get(pff_variable)
+            base_variable = variable.base_variable if variable else pff_variable
+            return find(pff_variable), base_variable, pff_variable
+
+        chunks = []
+        for _, members in groupby(sorted(self.pff_variables, key=key), key=find):
+            members = list(members)
+            for i in range(0, len(members), self.cluster_size):
+                chunks.append(members[i : i + self.cluster_size])
+        # first fit decreasing
+        clusters = []
+        for chunk in sorted(chunks, key=len, reverse=True):
+            for cluster in clusters:
+                if len(cluster) + len(chunk) <= self.cluster_size:
+                    cluster.extend(chunk)
+                    break
+            else:
+                clusters.append(list(chunk))
+        return clusters
+
+    def geotype_groups(self) -> list:
+        """
+        returns lists of geotypes calculated from the same geotype
+        """
+        groups = {}
+        for geotype in self.geotypes:
+            groups.setdefault(self.calculate.from_geotype(geotype), []).append(geotype)
+        return list(groups.values())
+
+    @cached_property
+    def tasks(self) -> list:
+        """
+        returns the (pff_variables, geotypes) tasks, the largest first so
+        that the small ones fill the gaps at the end of the run
+        """
+        tasks = []
+        for pff_variables in self.clusters():
+            for geotypes in self.geotype_groups():
+                pairs = [
+                    (i, j)
+                    for i in pff_variables
+                    for j in geotypes
+                    if (i, j) not in self.exclude
+                ]
+                if pairs:
+                    variables, geotypes = (set(i) for i in zip(*pairs))
+                    tasks.append(
+                        (
+                            [i for i in pff_variables if i in variables],
+                            [i for i in self.geotypes if i in geotypes],
+                        )
+                    )
+        return sorted(tasks, key=lambda task: len(task[0]) * len(task[1]), reverse=True)
+
+    @property
+    def workers(self) -> int:
+        """
+        number of workers, bounded by the available cores, the number of
+        tasks and the number of concurrent census API requests allowed,
+        every worker making up to Download.concurrency of them
+        """
+        return max(
+            1,
+            min(
+                available_cores(),
+                len(self.tasks),
+                self.api_concurrency // self.calculate.d.concurrency,
+            ),
+        )
+
+    def map(self, pool, func):
+        """
+        runs func on every task with pool, tasks are handed out one at a
+        time as workers become free. Yields the results as they complete
+        """
+        self.timings = []
+        for pid, start, end, result in pool.uimap(timed(func), self.tasks):
+            self.timings.append((pid, start, end))
+            yield result
+
+    def utilization(self) -> dict:
+        """
+        returns the number of tasks, the busy time (in seconds) and the
+        fraction of the run each worker spent calculating tasks
+        """
+        if not self.timings:
+            return {}
+        start = min(i[1] for i in self.timings)
+        wall = max(i[2] for i in self.timings) - start
+        workers = {}
+        for pid, task_start, task_end in self.timings:
+            worker = workers.setdefault(pid, {"tasks": 0, "busy": 0.0})
+            worker["tasks"] += 1
+            worker["busy"] += task_end - task_start
+        for worker in workers.values():
+            worker["utilization"] = worker["busy"] / wall if wall else 1.0
+        return workers
+
+    def report(self) -> str:
+        """
+        one line per worker with its number of tasks, busy time and
+        utilization
+        """
+        lines = [
+            f"worker {pid}: {i['tasks']} tasks, {i['busy']:.1f}s busy, "
+            f"{i['utilization']:.0%} utilization"
+            for pid, i in sorted(self.utilization().items())
+        ]
+        return "\n".join(lines)
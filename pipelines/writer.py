@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+from factfinder.utils import atomic_write
+
+
+class PartitionedWriter:
+    """
+    Writes the results of a pipeline run as they complete, appending every
+    dataframe to one csv file per partition, e.g. with
+    partition_cols = ["domain", "geotype"]
+
+    partitions/domain=housing/geotype=NTA/data.csv
+    partitions/domain=housing/geotype=CDTA/data.csv
+
+    so that only the dataframe being written is held in memory. Closing the
+    writer saves a manifest.json next to the partitions, listing the path,
+    the partition values and the number of rows of every partition, which
+    lets loaders read the partitions in parallel.
+    """
+
+    def __init__(self, path: str, partition_cols: list):
+        self.path = Path(path)
+        self.partition_cols = partition_cols
+        self.columns = None
+        self.partitions = {}
+        # partitions of a previous run are replaced
+        if self.path.is_dir():
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+
+    def partition_path(self, values: tuple) -> Path:
+        path = self.path
+        for col, value in zip(self.partition_cols, values):
+            path = path / f"{col}={value}"
+        return path / "data.csv"
+
+    def write(self, df: pd.DataFrame) -> None:
+        """
+        append df to the partitions of its rows, every partition has the
+        columns of the first dataframe written, in the same order
+        """
+        if self.columns is None:
+            self.columns = list(df.columns)
+        df = df[self.columns]
+        for values, partition in df.groupby(
+            self.partition_cols, sort=False, dropna=False
+        ):
+            values = values if isinstance(values, tuple) else (values,)
+            values = tuple(str(i) for i in values)
+            path = self.partition_path(values)
+            if values not in self.partitions:
+                os.makedirs(path.parent, exist_ok=True)
+                self.partitions[values] = {"path": path, "rows": 0}
+            partition.to_csv(
+                path, mode="a", header=self.partitions[values]["rows"] == 0, index=False
+            )
+            self.partitions[values]["rows"] += len(partition)
+
+    @property
+    def manifest(self) -> dict:
+        return {
+            "columns": self.columns,
+            "partition_cols": self.partition_cols,
+            "rows": sum(i["rows"] for i in self.partitions.values()),
+            "partitions": [
+                {
+                    **dict(zip(self.partition_cols, values)),
+                    "path": str(i["path"].relative_to(self.path)),
+                    "rows": i["rows"],
+                }
+                for values, i in sorted(self.partitions.items())
+            ],
+        }
+
+    def close(self) -> dict:
+        """
+        write the manifest and return it
+        """
+        manifest = self.manifest
+        with atomic_write(self.path / "manifest.json") as tmp:
+            with open(tmp, "w") as f:
+                json.dump(manifest, f, indent=4)
+        return manifest
+
+    def to_csv(self, path: str) -> None:
+        """
+        concatenate the partitions into one csv file, line by line
+        """
+        with atomic_write(path) as tmp:
+            with open(tmp, "w") as output:
+                for i, partition in enumerate(sorted(self.partitions)):
+                    with open(self.partitions[partition]["path"]) as f:
+                        header = f.readline()
+                        if i == 0:
+                            output.write(header)
+                        shutil.copyfileobj(f, output)
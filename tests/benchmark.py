@@ -0,0 +1,483 @@
+"""
+Offline benchmarks of the calculate pipeline stages, e.g.
+
+python -m tests.benchmark --output benchmark.json
+python -m tests.benchmark --output new.json --baseline benchmark.json
+
+Every stage runs on synthetic fixtures built from the metadata and the
+2010 to 2020 tract ratios in factfinder/data, and the end to end run
+downloads from the local CensusStub, so no network access or API key is
+needed. Results are saved as json, with the minimum, median and mean time
+of every stage. With a baseline, stages slower than threshold x the
+baseline are reported and the exit code is 1. Stages prefixed with
+legacy. time the implementation a stage replaced (from tests/legacy.py)
+on the same fixtures, for comparison.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from factfinder.calculate import Calculate
+from factfinder.download import Download
+from factfinder.special import evaluate
+from factfinder.store import Store
+from factfinder.utils import outliers, rounding
+
+from .legacy import c_p_z, create_c_p_z, legacy_c_p_z, legacy_clean
+from .stub import CensusStub
+
+year = 2019
+source = "acs"
+geography = "2010_to_2020"
+boroughs = {"005": "BX", "047": "BK", "061": "MN", "081": "QN", "085": "SI"}
+
+# representative mix of count, base, median, special and poverty variables
+variables = ["pop_1", "fem", "mdage", "pbwpv", "wrkrnothm", "mntrvtm", "hovacrt"]
+geotypes = ["NTA", "borough", "city"]
+
+
+def create_lookup_geo(ratio: pd.DataFrame) -> pd.DataFrame:
+    """
+    2020 tracts of the ratio table grouped into synthetic NTAs and CDTAs,
+    with 3 block groups per tract, a third of them in the 500 yr flood plain
+    """
+    tracts = pd.Series(sorted(ratio.geoid_ct2020.unique()))
+    boro = tracts.str[2:5].map(boroughs)
+    rank = tracts.groupby(boro).cumcount()
+    lookup_geo = pd.DataFrame(
+        {
+            "geoid_tract": tracts,
+            "nta2020": boro + (rank // 10).astype(str).str.zfill(4),
+            "cdta2020": boro + (rank // 40).astype(str).str.zfill(2),
+        }
+    )
+    lookup_geo = lookup_geo.loc[lookup_geo.index.repeat(3)].reset_index(drop=True)
+    lookup_geo["geoid_block_group"] = lookup_geo.geoid_tract + (
+        lookup_geo.index % 3 + 1
+    ).astype(str)
+    lookup_geo["cdta_fp_500"] = lookup_geo.cdta2020.where(lookup_geo.index % 3 == 0)
+    return lookup_geo
+
+
+def create_frame(census_geoids, pff_variables: list, geotype: str, seed=0):
+    """
+    e and m of every pff_variable for every census_geoid, with zeros and
+    missing values
+    """
+    rng = np.random.default_rng(seed)
+    census_geoids = np.asarray(census_geoids, dtype=object)
+    pff_variables = np.asarray(pff_variables, dtype=object)
+    n = len(census_geoids) * len(pff_variables)
+    e = rng.integers(0, 5000, n).astype("float64")
+    e[rng.random(n) < 0.05] = 0
+    e[rng.random(n) < 0.02] = np.nan
+    return pd.DataFrame(
+        {
+            "census_geoid": np.tile(census_geoids, len(pff_variables)),
+            "pff_variable": np.repeat(pff_variables, len(census_geoids)),
+            "geotype": geotype,
+            "e": e,
+            "m": rng.random(n) * 500,
+        }
+    )
+
+
+class Context:
+    """
+    fixtures shared by the stages, scale multiplies their number of rows.
+    Caches are written under root
+    """
+
+    def __init__(self, stub: CensusStub, root: str, scale: float = 1):
+        self.stub = stub
+        self.root = root
+        self.scale = scale
+        self.calculate = self.create_calculate()
+        self.meta = self.calculate.meta
+        self.geo = self.calculate.geo
+        self.tracts = list(self.geo.ratio.geoid_ct2010.unique())
+        self.block_groups = list(self.geo.lookup_geo.geoid_block_group.unique())
+        # pff_variables with at least one E field
+        self.pff_variables = [
+            i["pff_variable"]
+            for i in self.meta.metadata
+            if self.meta.create_variable(i["pff_variable"]).census_variables[1]
+        ][: max(1, int(100 * scale))]
+
+    def create_calculate(self) -> Calculate:
+        calculate = Calculate("bench", year=year, source=source, geography=geography)
+        d = Download("bench", year=year, source=source, geography=geography)
+        d.store = Store(year, source, base_path=".cache/download")
+        calculate.d = self.stub.attach(d)
+        calculate.geo.lookup_geo = create_lookup_geo(calculate.geo.ratio)
+        return calculate
+
+    def rows(self, n: int) -> int:
+        return max(1, int(n * self.scale))
+
+
+def download_clean(context: Context, clean=Download.clean):
+    """
+    sanitization of a block group pull, chunk by chunk of at most
+    max_fields fields, as returned by the API for the block groups of the
+    lookup
+    """
+    d = context.calculate.d
+    geotype = "block group"
+    fields = set()
+    for i in context.meta.metadata[: context.rows(100)]:
+        if "census_variable" in i:
+            v = context.meta.create_variable(i["pff_variable"])
+            profile_only = d.profile_only(geotype, i["pff_variable"])
+            for f in d.census_fields(v, profile_only).values():
+                fields.update(f)
+    geoids = pd.Series(context.block_groups[: context.rows(len(context.block_groups))])
+    rng = np.random.default_rng(0)
+    raws = []
+    for chunk in d.chunks(sorted(fields)):
+        values = rng.integers(0, 5000, (len(geoids), len(chunk)))
+        values[rng.random(values.shape) < 0.05] = 0
+        mask = rng.random(values.shape) < 0.05
+        values[mask] = rng.choice(outliers, size=mask.sum())
+        raw = pd.DataFrame(values.astype(str), columns=chunk)
+        raw["NAME"] = "Block Group " + geoids.str[11:]
+        raw["state"] = geoids.str[:2]
+        raw["county"] = geoids.str[2:5]
+        raw["tract"] = geoids.str[5:11]
+        raw["block group"] = geoids.str[11:]
+        raw["census_geoid"] = geoids
+        raws.append((raw, chunk))
+
+    def setup():
+        return ([(raw.copy(), chunk) for raw, chunk in raws],)
+
+    def run(raws):
+        for raw, chunk in raws:
+            clean(raw, geotype, chunk)
+
+    return setup, run
+
+
+def download_clean_legacy(context: Context):
+    """
+    the per-field sanitization download.clean replaced, on the same chunks
+    """
+    return download_clean(context, legacy_clean)
+
+
+def aggregate_horizontal(context: Context):
+    """
+    sum of the census fields of each pff_variable, one at a time
+    """
+    v = max(
+        (context.meta.create_variable(i) for i in context.pff_variables),
+        key=lambda v: len(v.census_variable),
+    )
+    E, M, _, _ = v.census_variables
+    rng = np.random.default_rng(0)
+    n = context.rows(20000)
+    df = pd.DataFrame(rng.random((n, len(E + M))) * 100, columns=E + M)
+    df["census_geoid"] = [f"{i:011d}" for i in range(n)]
+    df["pff_variable"] = v.pff_variable
+    df["geotype"] = "tract"
+
+    def setup():
+        return df.copy(), v
+
+    return setup, context.calculate.aggregate_horizontal
+
+
+def aggregate_horizontal_many(context: Context):
+    """
+    sum of the census fields of many pff_variables at once
+    """
+    pff_variables = context.pff_variables
+    E, _, M, _ = context.meta.incidence(pff_variables)
+    rng = np.random.default_rng(0)
+    n = context.rows(2000)
+    df = pd.DataFrame(rng.random((n, len(E + M))) * 100, columns=E + M)
+    df["census_geoid"] = [f"{i:011d}" for i in range(n)]
+    df["geotype"] = "tract"
+
+    def setup():
+        return df, pff_variables
+
+    return setup, context.calculate.aggregate_horizontal_many
+
+
+def tract_to_nta(context: Context):
+    df = create_frame(context.tracts, context.pff_variables, "tract")
+
+    def setup():
+        return (df,)
+
+    return setup, context.geo.tract_to_nta
+
+
+def ct2010_to_ct2020(context: Context):
+    df = create_frame(context.tracts, context.pff_variables, "tract")
+
+    def setup():
+        return (df,)
+
+    return setup, context.geo.ct2010_to_ct2020
+
+
+def block_group_to_cdta_fp500(context: Context):
+    df = create_frame(context.block_groups, context.pff_variables, "block group")
+
+    def setup():
+        return (df,)
+
+    return setup, context.geo.block_group_to_cdta_fp500
+
+
+def calculate_e_m_median(context: Context):
+    """
+    median and median moe of every median variable, from inputs in the memo
+    """
+    calculate = context.calculate
+    ntas = list(context.geo.lookup_geo.nta2020.unique())
+    median_variables = context.meta.median_variables
+    inputs = sorted(set(context.meta.median_inputs))
+    df = create_frame(ntas, inputs, "NTA")
+    for pff_variable, output in df.groupby("pff_variable"):
+        key = calculate.memo_key("e_m", pff_variable, "NTA")
+        calculate.memo.put(key, output.reset_index(drop=True))
+    func = Calculate.calculate_e_m_median.__wrapped__
+
+    def setup():
+        return ()
+
+    def run():
+        for pff_variable in median_variables:
+            func(calculate, pff_variable, "NTA")
+
+    return setup, run
+
+
+def utils_c_p_z(context: Context):
+    """
+    c, p and z of tract sized data with the array functions
+    """
+    df = create_c_p_z(rows=context.rows(20000))
+
+    def setup():
+        return (df.copy(),)
+
+    return setup, c_p_z
+
+
+def utils_c_p_z_legacy(context: Context):
+    """
+    c, p and z with the row-wise apply the array functions replaced
+    """
+    setup, _ = utils_c_p_z(context)
+    return setup, legacy_c_p_z
+
+
+def special(context: Context):
+    """
+    every special variable formula, evaluated in one batch
+    """
+    formulas = list(context.meta.formulas.values())
+    outputs = set(context.meta.formulas)
+    inputs = sorted(
+        set(i for f in formulas for i in f.base_variables if i not in outputs)
+    )
+    df = create_frame(context.tracts, inputs, "tract")
+
+    def setup():
+        return df, formulas
+
+    return setup, evaluate
+
+
+def output_frame(context: Context) -> pd.DataFrame:
+    """
+    c, e, m, p and z of every pff_variable for every NTA
+    """
+    ntas = list(context.geo.lookup_geo.nta2020.unique())
+    pff_variables = [i["pff_variable"] for i in context.meta.metadata]
+    df = create_frame(ntas, pff_variables[: context.rows(len(pff_variables))], "NTA")
+    df["c"] = df.m / 1.645 / df.e * 100
+    df["p"] = df.e / 50
+    df["z"] = df.m / 50
+    return df
+
+
+def cleaning(context: Context):
+    df = output_frame(context)
+
+    def setup():
+        return (df.copy(),)
+
+    return setup, context.calculate.cleaning
+
+
+def rounding_(context: Context):
+    df = output_frame(context)
+    digits = {i["pff_variable"]: i["rounding"] for i in context.meta.metadata}
+
+    def setup():
+        return df.copy(), df.pff_variable.map(digits)
+
+    return setup, rounding
+
+
+def labs_geoid(context: Context):
+    df = output_frame(context)
+
+    def setup():
+        return (df.copy(),)
+
+    return setup, context.calculate.labs_geoid
+
+
+def end_to_end(context: Context):
+    """
+    Calculate.__call__ over the representative variables and geotypes,
+    from an empty cache, downloads from the stub included
+    """
+
+    def setup():
+        os.chdir(tempfile.mkdtemp(dir=context.root))
+        return (context.create_calculate(),)
+
+    def run(calculate):
+        for pff_variable in variables:
+            for geotype in geotypes:
+                calculate(pff_variable, geotype)
+
+    return setup, run
+
+
+stages = {
+    "download.clean": download_clean,
+    "legacy.download.clean": download_clean_legacy,
+    "calculate.aggregate_horizontal": aggregate_horizontal,
+    "calculate.aggregate_horizontal_many": aggregate_horizontal_many,
+    "geography.tract_to_nta": tract_to_nta,
+    "geography.ct2010_to_ct2020": ct2010_to_ct2020,
+    "geography.block_group_to_cdta_fp500": block_group_to_cdta_fp500,
+    "calculate.calculate_e_m_median": calculate_e_m_median,
+    "utils.c_p_z": utils_c_p_z,
+    "legacy.utils.c_p_z": utils_c_p_z_legacy,
+    "special.evaluate": special,
+    "calculate.cleaning": cleaning,
+    "utils.rounding": rounding_,
+    "calculate.labs_geoid": labs_geoid,
+    "calculate.__call__": end_to_end,
+}
+
+
+def measure(setup, run, repeat: int) -> dict:
+    """
+    time run(*setup()) repeat times, setup is not timed
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+    }
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(repeat: int = 5, scale: float = 1, names: list = None) -> dict:
+    """
+    run the stages (all of them by default) in a temporary directory, so
+    that every cache starts empty, and return the results
+    """
+    cwd = os.getcwd()
+    results = {}
+    with tempfile.TemporaryDirectory() as root, CensusStub(tracts=20, delay=0) as stub:
+        try:
+            os.chdir(root)
+            context = Context(stub, root, scale)
+            for name in names or stages:
+                setup, run = stages[name](context)
+                results[name] = measure(setup, run, repeat)
+                os.chdir(root)
+        finally:
+            os.chdir(cwd)
+    return {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scale": scale,
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    returns the stages whose median time is more than threshold times
+    their median time in the baseline
+    """
+    return [
+        name
+        for name, i in results["results"].items()
+        if name in baseline["results"]
+        and i["median"] > threshold * baseline["results"][name]["median"]
+    ]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", type=str, help="The json file to write")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument(
+        "-s", "--scale", type=float, default=1, help="Multiplies the fixture sizes"
+    )
+    parser.add_argument(
+        "--stage", action="append", choices=list(stages), help="The stages to run"
+    )
+    parser.add_argument("--baseline", type=str, help="The json file to compare to")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmarks(args.repeat, args.scale, args.stage)
+    for name, i in results["results"].items():
+        print(f"{name:<40}{i['median'] * 1000:>10.1f} ms", file=sys.stdout)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name in regressions:
+            print(f"regression: {name}", file=sys.stdout)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,279 @@
+"""
+the merge, groupby and apply based implementations that were replaced by
+vectorized ones, kept as oracles for the tests and benchmarks, and the
+fixtures they are compared on
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+from factfinder.geography import agg_moe
+from factfinder.utils import (
+    get_c,
+    get_c_array,
+    get_p,
+    get_p_array,
+    get_z,
+    get_z_array,
+    outliers,
+)
+
+
+def create_output(df, colname):
+    """
+    this function will calculate the aggregated e and m
+    given colname we would like to aggregate over
+    """
+    return (
+        df[[colname, "e"]]
+        .groupby([colname])
+        .sum()
+        .merge(df[[colname, "m"]].groupby([colname]).agg(agg_moe), on=colname)
+        .reset_index()
+        .rename(columns={colname: "census_geoid"})
+    )
+
+
+def legacy_clean(df: pd.DataFrame, geotype: str, fields: list) -> pd.DataFrame:
+    """
+    The per-field sanitization previously used in Download
+    """
+    for field in fields:
+        df[field] = df[field].astype("float64")
+    for E in fields:
+        M = E[:-1] + "M"
+        if E.endswith("E") and not E.endswith("PE") and M in fields:
+            df.loc[df[E] == 0, M] = 0
+            df.loc[df[E].isin(outliers), M] = np.nan
+    if geotype in ("city", "borough"):
+        for M in fields:
+            if M.endswith("M"):
+                df.loc[df[M].isin([-555555555, 555555555]), M] = 0
+    return df.replace(outliers, np.nan)
+
+
+def legacy_c_p_z(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The row-wise calculation previously used in Calculate
+    """
+    df["p"] = df.apply(lambda row: get_p(row["e"], row["agg_e"]), axis=1)
+    df["z"] = df.apply(
+        lambda row: get_z(row["e"], row["m"], row["p"], row["agg_e"], row["agg_m"]),
+        axis=1,
+    )
+    df["c"] = df.apply(lambda row: get_c(row["e"], row["m"]), axis=1)
+    return df
+
+
+def create_fields(rows=6500, variables=100, seed=0) -> tuple:
+    """
+    returns a dataframe of downloaded fields with zeros, outliers and
+    controlled values, and the list of fields
+    """
+    rng = np.random.default_rng(seed)
+    fields = [f"B{i:05d}_001{s}" for i in range(variables) for s in "EM"]
+    fields += [f"DP{i:02d}_0001{s}" for i in range(variables // 10) for s in "EM"]
+    fields += [
+        f"DP{i:02d}_0001{s}" for i in range(variables // 10) for s in ["PE", "PM"]
+    ]
+    values = rng.integers(0, 5000, size=(rows, len(fields))).astype(object)
+    sentinels = np.array(outliers + [0, 0, 0], dtype=object)
+    mask = rng.random(values.shape) < 0.1
+    values[mask] = rng.choice(sentinels, size=mask.sum())
+    df = pd.DataFrame(values, columns=fields)
+    df["NAME"] = [f"Block Group {i}" for i in range(rows)]
+    df["census_geoid"] = [f"36005{i:07d}" for i in range(rows)]
+    return df, fields
+
+
+def create_c_p_z(rows=2168, seed=0) -> pd.DataFrame:
+    """
+    returns e, m, agg_e and agg_m with zeros, missing values, e == agg_e
+    (p == 100) and margins of error small enough to take the
+    m² - (e·agg_m/agg_e)² < 0 branch of get_z
+    """
+    rng = np.random.default_rng(seed)
+    agg_e = rng.integers(0, 5000, rows).astype("float64")
+    e = np.floor(agg_e * rng.random(rows))
+    df = pd.DataFrame(
+        {
+            "census_geoid": [f"36005{i:06d}" for i in range(rows)],
+            "e": e,
+            "m": rng.random(rows) * 300,
+            "agg_e": agg_e,
+            "agg_m": rng.random(rows) * 300,
+        }
+    )
+    edges = rng.random(rows)
+    df.loc[edges < 0.05, "e"] = 0
+    df.loc[(edges >= 0.05) & (edges < 0.1), "e"] = df.agg_e
+    df.loc[(edges >= 0.1) & (edges < 0.15), "agg_e"] = 0
+    df.loc[(edges >= 0.15) & (edges < 0.2), ["e", "m"]] = np.nan
+    df.loc[(edges >= 0.2) & (edges < 0.25), ["agg_e", "agg_m"]] = np.nan
+    df.loc[(edges >= 0.25) & (edges < 0.3), "m"] = 0
+    return df
+
+
+def c_p_z(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    p, z and c with the array functions, as in Calculate.calculate_c_e_m_p_z
+    """
+    df["p"] = get_p_array(df["e"], df["agg_e"])
+    df["z"] = get_z_array(df["e"], df["m"], df["p"], df["agg_e"], df["agg_m"])
+    df["c"] = get_c_array(df["e"], df["m"])
+    return df
+
+
+def legacy_pivot(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    dff = df.loc[:, ["census_geoid", "pff_variable", "e", "m"]].pivot(
+        index="census_geoid", columns="pff_variable", values=["e", "m"]
+    )
+    pivoted = pd.DataFrame()
+    pivoted["census_geoid"] = dff.index
+    del df
+    for i in base_variables:
+        pivoted[i + "e"] = dff.e.loc[pivoted.census_geoid, i].to_list()
+        pivoted[i + "m"] = dff.m.loc[pivoted.census_geoid, i].to_list()
+    del dff
+    return pivoted
+
+
+def hovacrtm(hovacue, vacsalee, vacsalem, hovacum):
+    if hovacue == 0:
+        return 0
+    elif vacsalee == 0:
+        return 0
+    elif vacsalem ** 2 - (vacsalee * hovacum / hovacue) ** 2 < 0:
+        return (
+            math.sqrt(vacsalem ** 2 + (vacsalee * hovacum / hovacue) ** 2)
+            / hovacue
+            * 100
+        )
+    else:
+        return (
+            math.sqrt(vacsalem ** 2 - (vacsalee * hovacum / hovacue) ** 2)
+            / hovacue
+            * 100
+        )
+
+
+def percapinc(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = df.agip15ple / df.pop_6e
+    df["m"] = (
+        1
+        / df.pop_6e
+        * np.sqrt(df.agip15plm ** 2 + (df.agip15ple * df.pop_6m / df.pop_6e) ** 2)
+    )
+    return df
+
+
+def mntrvtm(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = df["agttme"] / (df["wrkr16ple"] - df["cw_wrkdhme"])
+    df["m"] = (
+        1
+        / df["wrkrnothme"]
+        * np.sqrt(
+            df["agttmm"] ** 2
+            + (df["agttme"] * df["wrkrnothmm"] / df["wrkrnothme"]) ** 2
+        )
+    )
+    return df
+
+
+def mnhhinc(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = df["aghhince"] / df["hh2e"]
+    df["m"] = (
+        1
+        / df["hh5e"]
+        * np.sqrt(df["aghhincm"] ** 2 + (df["aghhince"] * df["hh5m"] / df["hh5e"]) ** 2)
+    )
+    return df
+
+
+def avghhsooc(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = df["popoochue"] / df["oochu1e"]
+    df["m"] = (
+        df["popoochum"] ** 2 + (df["popoochue"] * df["oochu4m"] / df["oochu4e"]) ** 2
+    ) ** 0.5 / df["oochu4e"]
+    return df
+
+
+def avghhsroc(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = df["poprtochue"] / df["rochu1e"]
+    df["m"] = (
+        df["poprtochum"] ** 2 + (df["poprtochue"] * df["rochu2m"] / df["rochu2e"]) ** 2
+    ) ** 0.5 / df["rochu2e"]
+    return df
+
+
+def avghhsz(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = df["hhpop1e"] / df["hh1e"]
+    df["m"] = (
+        df["hhpop1m"] ** 2 + (df["hh4m"] * df["hhpop1e"] / df["hh4e"]) ** 2
+    ) ** 0.5 / df["hh4e"]
+    return df
+
+
+def avgfmsz(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = df["popinfmse"] / df["fam1e"]
+    df["m"] = (
+        df["popinfmsm"] ** 2 + (df["fam3m"] * df["popinfmse"] / df["fam3e"]) ** 2
+    ) ** 0.5 / df["fam3e"]
+    return df
+
+
+def hovacrt(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = 100 * df["vacsalee"] / df["hovacue"]
+    df["m"] = df.apply(
+        lambda row: hovacrtm(
+            row["hovacue"], row["vacsalee"], row["vacsalem"], row["hovacum"]
+        ),
+        axis=1,
+    )
+    df.loc[df.e == 0, "e"] = np.nan
+    return df
+
+
+def rntvacrt(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = 100 * df["vacrnte"] / df["rntvacue"]
+    df["m"] = df.apply(
+        lambda row: hovacrtm(
+            row["rntvacue"], row["vacrnte"], row["vacrntm"], row["rntvacum"]
+        ),
+        axis=1,
+    )
+    df.loc[df.e == 0, "e"] = np.nan
+    return df
+
+
+def wrkrnothm(df: pd.DataFrame, base_variables: list) -> pd.DataFrame:
+    df = legacy_pivot(df, base_variables)
+    df["e"] = df["wrkr16ple"] - df["cw_wrkdhme"]
+    df["m"] = (df["wrkr16plm"] ** 2 + df["cw_wrkdhmm"] ** 2) ** 0.5
+    return df
+
+
+# the special variable calculations previously used in Calculate, by
+# pff_variable
+legacy_special = {
+    "percapinc": percapinc,
+    "mntrvtm": mntrvtm,
+    "mnhhinc": mnhhinc,
+    "avghhsooc": avghhsooc,
+    "avghhsroc": avghhsroc,
+    "avghhsz": avghhsz,
+    "avgfmsz": avgfmsz,
+    "rntvacrt": rntvacrt,
+    "hovacrt": hovacrt,
+    "wrkrnothm": wrkrnothm,
+}
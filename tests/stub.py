@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+counties = ["005", "081", "085", "047", "061"]
+
+
+class CensusStub:
+    """
+    A local HTTP server that mimics the Census API data endpoints.
+    Every requested field of every geography gets a deterministic value,
+    and the server keeps track of the requests it has received and of the
+    maximum number of requests that were in flight at the same time.
+    """
+
+    def __init__(self, tracts=3, blocks=4, delay=0.05, coalesce=True):
+        self.tracts = tracts
+        self.blocks = blocks
+        self.delay = delay
+        # whether multiple counties are accepted in the "in" predicate
+        self.coalesce = coalesce
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @staticmethod
+    def value(name: str, field: str) -> int:
+        return sum(map(ord, name + field)) % 1000
+
+    def rows(self, _for: str, _in: str) -> list:
+        geo = dict(i.split(":") for i in _in.split(" ") if i)
+        geotype, value = _for.split(":")
+        if geotype == "place":
+            return [{"NAME": "New York city", "state": "36", "place": value}]
+        if geotype == "county":
+            return [
+                {"NAME": f"County {i}", "state": "36", "county": i}
+                for i in (counties if value == "*" else value.split(","))
+            ]
+        county = geo.get("county", "*")
+        tracts = [
+            {
+                "NAME": f"Census Tract {j}, County {i}",
+                "state": "36",
+                "county": i,
+                "tract": f"{j:04d}00",
+            }
+            # county:* includes counties outside of NYC
+            for i in (counties + ["001"] if county == "*" else county.split(","))
+            for j in range(1, self.tracts + 1)
+        ]
+        if geotype == "block":
+            return [
+                {**tract, "NAME": f"Block {k}, {tract['NAME']}", "block": f"{k:04d}"}
+                for tract in tracts
+                for k in range(1, self.blocks + 1)
+            ]
+        return tracts
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.endswith(".json"):
+                    # Variable definitions are not served, fields default to str
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with stub.lock:
+                    stub.requests.append(params)
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                time.sleep(stub.delay)
+                if not stub.coalesce and "," in params.get("in", ""):
+                    with stub.lock:
+                        stub.in_flight -= 1
+                    self.send_response(400)
+                    self.end_headers()
+                    self.wfile.write(b"error: unsupported geography hierarchy")
+                    return
+                fields = params["get"].split(",")
+                rows = stub.rows(params["for"], params.get("in", ""))
+                geo = [i for i in rows[0].keys() if i != "NAME"]
+                body = [fields + geo] + [
+                    [
+                        r["NAME"] if f == "NAME" else str(stub.value(r["NAME"], f))
+                        for f in fields
+                    ]
+                    + [r[i] for i in geo]
+                    for r in rows
+                ]
+                with stub.lock:
+                    stub.in_flight -= 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+
+        return Handler
+
+    def attach(self, d):
+        """
+        route the requests of a Download instance to the stub
+        """
+        url = self.url
+        adapter = d.session.get_adapter("https://api.census.gov")
+
+        class Adapter(requests.adapters.BaseAdapter):
+            def send(self, request, **kwargs):
+                request.url = request.url.replace("https://api.census.gov", url)
+                return adapter.send(request, **kwargs)
+
+            def close(self):
+                adapter.close()
+
+        d.session.mount("https://api.census.gov", Adapter())
+        return d
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,47 @@
+import importlib
+
+import numpy as np
+import pandas as pd
+
+AggregatedGeography = importlib.import_module(
+    "factfinder.geography.2010"
+).AggregatedGeography
+
+
+def sample(blocks=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    geoid_block = [f"36005{i:06d}{i % 7:04d}" for i in range(blocks)]
+    cd = rng.choice(["201", "202", "203", "204"], blocks).astype(object)
+    lookup_geo = pd.DataFrame(
+        {
+            "geoid_block": geoid_block,
+            "cd_fp_500": np.where(rng.random(blocks) < 0.3, cd, np.nan),
+            "cd_fp_100": np.where(rng.random(blocks) < 0.1, cd, np.nan),
+            "cd_park_access": np.where(rng.random(blocks) < 0.8, cd, np.nan),
+        }
+    )
+    # some blocks in the lookup are missing from the data
+    df = pd.DataFrame(
+        {
+            "census_geoid": geoid_block[: int(blocks * 0.9)],
+            "pff_variable": "pop_1",
+            "geotype": "block",
+            "e": rng.integers(0, 100, int(blocks * 0.9)).astype("float64"),
+            "m": np.nan,
+        }
+    )
+    return lookup_geo, df
+
+
+def test_block_to_cd_chunks(tmp_path, monkeypatch):
+    # the operators compiled from the sample lookup are saved in tmp_path
+    monkeypatch.chdir(tmp_path)
+    geography = AggregatedGeography()
+    geography.lookup_geo, df = sample()
+    options = geography.options["decennial"]["block"]
+    stream_options = geography.stream_options["decennial"]["block"]
+    for geotype in ["cd_fp_500", "cd_fp_100", "cd_park_access"]:
+        expected = options[geotype](df)
+        chunks = (df.iloc[i : i + 64] for i in range(0, len(df), 64))
+        output = stream_options[geotype](chunks)
+        pd.testing.assert_frame_equal(output, expected, check_dtype=False)
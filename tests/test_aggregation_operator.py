@@ -0,0 +1,167 @@
+import importlib
+
+import numpy as np
+import pandas as pd
+
+from factfinder.geography import AggregationOperator, empty_frame, load_operator
+
+from .legacy import create_output
+
+
+def sample(tracts=500, seed=0):
+    rng = np.random.default_rng(seed)
+    geoid_tract = [f"36005{i:06d}" for i in range(tracts)]
+    lookup_geo = pd.DataFrame(
+        {
+            "geoid_tract": geoid_tract,
+            "nta": rng.choice(
+                np.array(["BX01", "BX02", "BX03", np.nan], dtype=object), tracts
+            ),
+            "cd": rng.choice(["201", "202", "203"], tracts),
+        }
+    )
+    lookup_geo["cd_fp_500"] = np.where(
+        rng.random(tracts) < 0.3, lookup_geo.cd, np.nan
+    ).astype(object)
+    # a tract can be in more than one target
+    lookup_geo = pd.concat([lookup_geo, lookup_geo.sample(50, random_state=seed)])
+    lookup_geo.loc[lookup_geo.index.duplicated(), "cd_fp_500"] = "204"
+    # some tracts are missing from the data, others from the lookup
+    df = pd.DataFrame(
+        {
+            "census_geoid": geoid_tract[50:]
+            + [f"36005{i:06d}" for i in range(9000, 9010)],
+            "pff_variable": "pop_1",
+            "geotype": "tract",
+            "e": rng.integers(0, 1000, tracts - 40).astype("float64"),
+            "m": rng.integers(0, 100, tracts - 40).astype("float64"),
+        }
+    )
+    df.loc[df.sample(20, random_state=seed).index, "e"] = np.nan
+    df.loc[df.sample(20, random_state=seed + 1).index, "m"] = np.nan
+    return lookup_geo, df
+
+
+def merge_and_group(lookup_geo, df, geoid, colname, how):
+    """
+    the translation with a merge and a groupby, that the operator replaces
+    """
+    df = df.merge(
+        lookup_geo.loc[~lookup_geo[colname].isna(), [geoid, colname]].drop_duplicates(),
+        how=how,
+        right_on=geoid,
+        left_on="census_geoid",
+    )
+    output = create_output(df, colname)
+    output["pff_variable"] = "pop_1"
+    return output[["census_geoid", "pff_variable", "e", "m"]]
+
+
+def test_aggregation_operator():
+    lookup_geo, df = sample()
+    for colname, how in [("nta", "left"), ("cd", "left"), ("cd_fp_500", "right")]:
+        operator = AggregationOperator(lookup_geo, "geoid_tract", colname, how)
+        pd.testing.assert_frame_equal(
+            operator(df), merge_and_group(lookup_geo, df, "geoid_tract", colname, how)
+        )
+
+
+def test_aggregation_operator_many():
+    lookup_geo, df = sample()
+    operator = AggregationOperator(lookup_geo, "geoid_tract", "nta", "left")
+    # the second variable has no data for part of the targets
+    other = df.assign(pff_variable="pop_2", e=df.e * 2)
+    other = other[
+        ~other.census_geoid.isin(lookup_geo.geoid_tract[lookup_geo.nta == "BX01"])
+    ]
+    expected = pd.concat([operator(df), operator(other)], ignore_index=True)
+    pd.testing.assert_frame_equal(operator(pd.concat([df, other])), expected)
+    assert "BX01" not in expected[expected.pff_variable == "pop_2"].census_geoid.values
+
+
+def test_aggregation_operator_stream():
+    lookup_geo, df = sample()
+    other = df.assign(pff_variable="pop_2", e=df.e * 2)
+    df = pd.concat([df, other])
+    for colname, how in [("nta", "left"), ("cd_fp_500", "right")]:
+        operator = AggregationOperator(lookup_geo, "geoid_tract", colname, how)
+        # pop_2 only appears from the second chunk on
+        chunks = (df.iloc[i : i + 100] for i in range(0, len(df), 100))
+        pd.testing.assert_frame_equal(operator.stream(chunks), operator(df))
+    assert operator.stream([]).empty
+
+
+def test_load_operator(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lookup_geo, df = sample()
+    built = []
+
+    def build():
+        built.append(1)
+        return AggregationOperator(lookup_geo, "geoid_tract", "nta")
+
+    for _ in range(2):
+        operator = load_operator("test/geoid_tract-nta", "1", build, "left")
+        assert isinstance(operator.rows, np.memmap)
+        pd.testing.assert_frame_equal(
+            operator(df), merge_and_group(lookup_geo, df, "geoid_tract", "nta", "left")
+        )
+    # built once, then loaded from the artifact
+    assert len(built) == 1
+    assert operator(empty_frame()).empty
+
+
+def ct2010_to_ct2020(geography, df):
+    """
+    the translation with a merge, a row-wise convert_moe and a groupby,
+    that the vectorized ct2010_to_ct2020 replaces
+    """
+    df = df.merge(
+        geography.ratio, how="right", right_on="geoid_ct2010", left_on="census_geoid"
+    )
+    df["e_2010"] = df.e
+    df["m_2010"] = df.m
+    df.e = df.e * df.ratio
+    df.m = df.apply(
+        lambda row: geography.convert_moe(
+            row["e_2010"], row["m_2010"], row["e"], row["ratio"]
+        ),
+        axis=1,
+    )
+    df.e = df.e.round(16)
+    df.m = df.m.round(16)
+    output = create_output(df, "geoid_ct2020")
+    output["pff_variable"] = "pop_1"
+    output["geotype"] = "CT20"
+    return output[["census_geoid", "pff_variable", "geotype", "e", "m"]]
+
+
+def test_ct2010_to_ct2020(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    geography = importlib.import_module(
+        "factfinder.geography.2010_to_2020"
+    ).AggregatedGeography()
+    rng = np.random.default_rng(0)
+    tracts = geography.ratio.geoid_ct2010.unique()
+    df = pd.DataFrame(
+        {
+            "census_geoid": tracts[100:],
+            "pff_variable": "pop_1",
+            "geotype": "tract",
+            "e": rng.integers(0, 5000, len(tracts) - 100).astype("float64"),
+            "m": rng.integers(0, 500, len(tracts) - 100).astype("float64"),
+        }
+    )
+    df.loc[df.sample(100, random_state=0).index, "e"] = 0
+    df.loc[df.sample(50, random_state=1).index, "m"] = np.nan
+    expected = ct2010_to_ct2020(geography, df)
+    pd.testing.assert_frame_equal(
+        geography.ct2010_to_ct2020(df), expected, check_exact=True
+    )
+    # every pff_variable at once
+    other = df.assign(pff_variable="pop_2", e=df.e / 3)
+    output = geography.ct2010_to_ct2020(pd.concat([df, other]))
+    pd.testing.assert_frame_equal(
+        output[output.pff_variable == "pop_2"].reset_index(drop=True),
+        geography.ct2010_to_ct2020(other),
+    )
@@ -0,0 +1,17 @@
+import json
+
+from .benchmark import compare, run_benchmarks, stages
+
+
+def test_benchmark():
+    results = run_benchmarks(repeat=1, scale=0.05)
+    assert list(results["results"]) == list(stages)
+    assert all(i["min"] > 0 for i in results["results"].values())
+    results = json.loads(json.dumps(results))
+    assert compare(results, results, 1) == []
+    slower = {
+        "results": {
+            k: {**i, "median": i["median"] * 2} for k, i in results["results"].items()
+        }
+    }
+    assert compare(slower, results, 1.25) == list(stages)
@@ -0,0 +1,184 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pandas as pd
+import requests
+import retry.api
+
+from factfinder.calculate import Calculate
+from factfinder.download import Download
+from factfinder.metadata import Metadata
+from factfinder.store import Store
+
+from .stub import CensusStub
+
+year = 2019
+source = "acs"
+geography = "2010_to_2020"
+
+
+def create_calculate(stub, tmp_path):
+    calculate = Calculate("stub", year=year, source=source, geography=geography)
+    d = Download("stub", year=year, source=source, geography=geography)
+    d.store = Store(year, source, base_path=tmp_path / "download")
+    calculate.d = stub.attach(d)
+    return calculate
+
+
+def test_incremental_rebuild(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with CensusStub() as stub:
+        calculate = create_calculate(stub, tmp_path)
+        df = calculate("pop_1", "borough")
+        n_requests = len(stub.requests)
+
+        # nothing changed, the result is read from the cache
+        calculate = create_calculate(stub, tmp_path)
+        calculate.d.c = None
+        assert calculate("pop_1", "borough").equals(df)
+
+        # a changed census variable is downloaded and recalculated
+        calculate = create_calculate(stub, tmp_path)
+        # a private copy of the metadata, that is not shared with other tests
+        calculate.meta = Metadata(year=year, source=source)
+        record = next(
+            i for i in calculate.meta.metadata if i["pff_variable"] == "pop_1"
+        )
+        record["census_variable"] = ["B01001_002"]
+        calculate.d.meta = calculate.meta
+        changed = calculate("pop_1", "borough")
+        assert len(stub.requests) == n_requests + 1
+    assert not changed.e.equals(df.e)
+
+
+def test_prune_calculate(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with CensusStub() as stub:
+        calculate = create_calculate(stub, tmp_path)
+        calculate("pop_1", "borough")
+        calculate("pop_5", "borough")
+        key = calculate.cache_key("results", "pop_1", "borough")
+
+        # pop_1 is calculated again with changed metadata
+        calculate = create_calculate(stub, tmp_path)
+        calculate.meta = Metadata(year=year, source=source)
+        record = next(
+            i for i in calculate.meta.metadata if i["pff_variable"] == "pop_1"
+        )
+        record["census_variable"] = ["B01001_002"]
+        calculate.d.meta = calculate.meta
+        calculate("pop_1", "borough")
+
+    deleted = calculate.prune()
+    assert [i.name for i in deleted if i.suffix == ".pkl"] == [f"pop_1-{key}.pkl"]
+    # only the entries of the current keys are left, without lock files
+    entries = sorted(Path(".cache").glob("calculate/**/*")) + sorted(
+        Path(".cache").glob("results/**/*")
+    )
+    entries = [str(i) for i in entries if i.is_file()]
+    assert len(entries) == 3
+    for path in entries:
+        stage = path.split("/")[1]
+        pff_variable = Path(path).name.rsplit("-", 1)[0]
+        key = calculate.cache_key(stage, pff_variable, "borough")
+        assert path == calculate.cache_path(stage, pff_variable, "borough", key)
+
+
+def test_calculate_many(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pff_variables = ["pop_1", "mdage", "pbwpv", "wrkrnothm", "mntrvtm", "fem"]
+    geotypes = ["borough", "city"]
+    with CensusStub() as stub:
+        calculate = create_calculate(stub, tmp_path)
+        df = calculate.calculate_many(pff_variables, geotypes)
+        expected = pd.concat([calculate(v, g) for v in pff_variables for g in geotypes])
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_calculate_e_m_many(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with CensusStub() as stub:
+        calculate = create_calculate(stub, tmp_path)
+        pff_variables = [i["pff_variable"] for i in calculate.meta.metadata][::10]
+        for geotype in ["borough", "city", "CT20"]:
+            calculate.calculate_e_m_many(pff_variables, geotype)
+            n_requests = len(stub.requests)
+            for pff_variable in pff_variables:
+                key = calculate.memo_key("e_m", pff_variable, geotype)
+                assert key in calculate.memo
+                pd.testing.assert_frame_equal(
+                    calculate.memo.get(key),
+                    Calculate.calculate_e_m.__wrapped__(
+                        calculate, pff_variable, geotype
+                    ),
+                )
+            assert len(stub.requests) == n_requests
+
+
+def test_calculate_e_m_special_many(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with CensusStub() as stub:
+        calculate = create_calculate(stub, tmp_path)
+        pff_variables = calculate.meta.special_variables
+        calculate.calculate_e_m_special_many(pff_variables, "borough")
+        for pff_variable in pff_variables:
+            key = calculate.memo_key("special", pff_variable, "borough")
+            assert key in calculate.memo
+            pd.testing.assert_frame_equal(
+                calculate.memo.get(key),
+                Calculate.calculate_e_m_special.__wrapped__(
+                    calculate, pff_variable, "borough"
+                ),
+            )
+
+
+def test_calculate_many_failures(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sleeps = []
+    monkeypatch.setattr(retry.api, "time", SimpleNamespace(sleep=sleeps.append))
+    with CensusStub() as stub:
+        calculate = create_calculate(stub, tmp_path)
+        failures = {}
+        df = calculate.calculate_many(
+            ["pop_1", "unknown"], ["borough"], errors="ignore", failures=failures
+        )
+    assert set(df.pff_variable) == {"pop_1"}
+    assert list(failures) == [("unknown", "borough")]
+    # the unknown variable is not retried
+    assert sleeps == []
+    # a batch where every pair fails is empty
+    df = calculate.calculate_many(["unknown"], ["borough"], errors="ignore")
+    assert df.empty
+    assert list(df.columns) == Calculate.output_columns
+
+
+def test_calculate_many_transient(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sleeps = []
+    monkeypatch.setattr(retry.api, "time", SimpleNamespace(sleep=sleeps.append))
+    with CensusStub() as stub:
+        calculate = create_calculate(stub, tmp_path)
+
+        # the batch keeps failing, the pairs are calculated one by one
+        def calculate_e_m_many(pff_variables, geotype):
+            raise requests.ConnectionError("batch")
+
+        # the first calculation of the pair fails and is retried
+        errors = [requests.ConnectionError("pair")]
+        calculate_c_e_m_p_z = calculate.calculate_c_e_m_p_z
+
+        def flaky_calculate_c_e_m_p_z(pff_variable, geotype):
+            if errors:
+                raise errors.pop()
+            return calculate_c_e_m_p_z(pff_variable, geotype)
+
+        calculate.calculate_e_m_many = calculate_e_m_many
+        calculate.calculate_c_e_m_p_z = flaky_calculate_c_e_m_p_z
+        failures = {}
+        df = calculate.calculate_many(
+            ["pop_1"], ["borough"], errors="ignore", failures=failures
+        )
+        expected = calculate("pop_1", "borough")
+    assert failures == {}
+    pd.testing.assert_frame_equal(df, expected)
+    assert sleeps == [5, 5, 5]
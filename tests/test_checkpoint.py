@@ -0,0 +1,53 @@
+import copy
+import importlib
+
+import pandas as pd
+import pytest
+
+from factfinder.metadata import Metadata
+
+
+@pytest.fixture
+def Checkpoint(monkeypatch):
+    # the pipelines package reads the API key when it is imported
+    monkeypatch.setenv("API_KEY", "stub")
+    return importlib.import_module("pipelines.checkpoint").Checkpoint
+
+
+def results(pairs):
+    return pd.DataFrame(
+        [
+            {"pff_variable": var, "geotype": geo, "census_geoid": "1", "e": 1.0}
+            for var, geo in pairs
+        ]
+    )
+
+
+def test_checkpoint_resume_metadata(Checkpoint, tmp_path):
+    run = {"year": 2019, "geography": "2010_to_2020"}
+    pairs = [(var, "NTA") for var in ["pop_1", "pop_6", "percapinc"]]
+    meta = Metadata(year=2019, source="acs")
+    checkpoint = Checkpoint(tmp_path, run, key=meta.fingerprint)
+    checkpoint.save(results(pairs), {})
+    checkpoint.close(pairs)
+
+    # Resuming with the same metadata keeps every pair
+    checkpoint = Checkpoint(tmp_path, run, resume=True, key=meta.fingerprint)
+    assert checkpoint.done() == set(pairs)
+
+    # Editing pop_6 calculates pop_6 and percapinc (calculated from pop_6) again
+    edited = Metadata(year=2019, source="acs")
+    edited.definitions = copy.deepcopy(meta.definitions)
+    for i in edited.definitions["metadata"]:
+        if i["pff_variable"] == "pop_6":
+            i["rounding"] = 1
+    checkpoint = Checkpoint(tmp_path, run, resume=True, key=edited.fingerprint)
+    assert checkpoint.done() == {("pop_1", "NTA")}
+    assert [df.pff_variable[0] for df in checkpoint.results()] == ["pop_1"]
+    summary = checkpoint.close(pairs)
+    assert [i["status"] for i in summary["failures"]] == ["outdated", "outdated"]
+
+    # Results of the edited pairs replace the outdated ones
+    df = checkpoint.save(results(pairs), {})
+    assert sorted(df.pff_variable) == ["percapinc", "pop_6"]
+    assert checkpoint.done() == set(pairs)
@@ -0,0 +1,13 @@
+import pandas as pd
+
+from factfinder.download import Download
+
+from .legacy import create_fields, legacy_clean
+
+
+def test_clean():
+    df, fields = create_fields(rows=500, variables=50)
+    for geotype in ["tract", "block group", "city", "borough"]:
+        expected = legacy_clean(df.copy(), geotype, fields)
+        result = Download.clean(df.copy(), geotype, fields)
+        pd.testing.assert_frame_equal(expected, result)
@@ -0,0 +1,134 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from factfinder.download import Download
+from factfinder.store import Store
+
+from .stub import CensusStub
+
+year = 2019
+source = "acs"
+geography = "2010_to_2020"
+
+
+def create_download(stub, tmp_path, concurrency):
+    d = Download(
+        "stub", year=year, source=source, geography=geography, concurrency=concurrency
+    )
+    d.store = Store(year, source, base_path=tmp_path)
+    return stub.attach(d)
+
+
+def test_coalesced_download(tmp_path):
+    with CensusStub() as stub:
+        d = create_download(stub, tmp_path, concurrency=3)
+        df = d("tract", "lgoenlep1")
+        assert len(stub.requests) == 1
+        d("borough", "pop_1")
+        assert len(stub.requests) == 2
+    assert df.shape[0] == 15
+    row = df.loc[df.census_geoid == "36005000100"].iloc[0]
+    assert row["C16001_005E"] == stub.value("Census Tract 1, County 005", "C16001_005E")
+
+
+def test_concurrent_download(tmp_path):
+    with CensusStub(coalesce=False) as stub:
+        d = create_download(stub, tmp_path, concurrency=3)
+        df = d("tract", "lgoenlep1")
+        # the coalesced request is rejected, then one request per county,
+        # never more than 3 at a time
+        assert len(stub.requests) == 6
+        assert 1 < stub.max_in_flight <= 3
+        assert d.split_geotypes == {"tract"}
+        d("tract", "pop_1")
+        assert len(stub.requests) == 11
+    assert df.shape[0] == 15
+
+
+def test_concurrent_prefetch(tmp_path):
+    pff_variables = ["lgoenlep1", "pop_1", "mdage", "f16pl"]
+    with CensusStub() as stub:
+        d = create_download(stub, tmp_path, concurrency=5)
+        d.prefetch(["tract", "borough"], pff_variables)
+        assert stub.max_in_flight <= 5
+        n_requests = len(stub.requests)
+        for pff_variable in pff_variables:
+            d("tract", pff_variable)
+            d("borough", pff_variable)
+    # everything is served from the store after prefetching
+    assert len(stub.requests) == n_requests
+
+
+def test_sequential_download(tmp_path):
+    with CensusStub() as stub:
+        d = create_download(stub, tmp_path, concurrency=1)
+        d("borough", "pop_1")
+    assert stub.max_in_flight == 1
+
+
+def test_single_flight_download(tmp_path):
+    # Download instances sharing a store (e.g. in different pool workers)
+    # wait for each other instead of downloading the same fields twice
+    with CensusStub() as stub:
+        downloads = [create_download(stub, tmp_path, concurrency=5) for _ in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            dfs = list(executor.map(lambda d: d("tract", "pop_1"), downloads))
+    assert len(stub.requests) == 1
+    for df in dfs[1:]:
+        pd.testing.assert_frame_equal(dfs[0], df)
+
+
+def test_streaming_download(tmp_path):
+    with CensusStub(blocks=4) as stub:
+        d = create_download(stub, tmp_path, concurrency=2)
+        d.chunksize = 5
+        chunks = list(d.stream("block", "pop_1"))
+        # one request per county, written to the store as it arrives
+        assert len(stub.requests) == 5
+        assert all("," not in i["in"] for i in stub.requests)
+        assert stub.max_in_flight <= 2
+        df = d("block", "pop_1")
+    assert len(stub.requests) == 5
+    assert df.shape[0] == 5 * 3 * 4
+    assert max(len(i) for i in chunks) == 5
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df)
+    for county in d.counties:
+        assert os.path.isfile(
+            d.store.field_path("block", "DP05_0001E", partition=county)
+        )
+
+
+def test_prune_store(tmp_path):
+    with CensusStub() as stub:
+        d = create_download(stub, tmp_path, concurrency=3)
+        d.store.version = "old"
+        d("borough", "pop_1")
+        d.store.version = "new"
+        d("borough", "pop_1")
+    path = tmp_path / f"year={year}" / f"source={source}"
+    assert sorted(i.name for i in path.iterdir()) == ["version=new", "version=old"]
+    deleted = d.store.prune()
+    assert [i.name for i in path.iterdir()] == ["version=new"]
+    assert any(i.suffix == ".lock" for i in deleted)
+    assert not list(path.glob("**/*.lock"))
+    assert d.store.missing("borough", ["DP05_0001E"]) == []
+
+
+def test_store_write_new_geoids(tmp_path):
+    store = Store(year, source, base_path=tmp_path)
+    store.write("tract", pd.DataFrame({"census_geoid": ["1", "2"], "X": [1.0, 2.0]}))
+    # geoids missing from the index are added, none of the rows is dropped
+    store.write("tract", pd.DataFrame({"census_geoid": ["3", "2"], "Y": [4.0, 3.0]}))
+    expected = pd.DataFrame(
+        {
+            "census_geoid": ["1", "2", "3"],
+            "X": [1.0, 2.0, np.nan],
+            "Y": [np.nan, 3.0, 4.0],
+        }
+    )
+    pd.testing.assert_frame_equal(store.read("tract", ["X", "Y"]), expected)
+    chunks = store.read_chunks("tract", ["X", "Y"], chunksize=2)
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
@@ -0,0 +1,84 @@
+import importlib
+
+import numpy as np
+import pandas as pd
+
+from factfinder.geography import prune_lookups
+
+AggregatedGeography = importlib.import_module(
+    "factfinder.geography.2010_to_2020"
+).AggregatedGeography
+
+
+def test_lookup_artifact(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ratio = AggregatedGeography().ratio
+    assert len(list((tmp_path / ".cache/lookup_geo/2010_to_2020").iterdir())) == 1
+
+    # the artifact is loaded instead of the csv
+    def read_csv(*args, **kwargs):
+        raise AssertionError("read_csv should not be called")
+
+    with monkeypatch.context() as m:
+        m.setattr(pd, "read_csv", read_csv)
+        pd.testing.assert_frame_equal(AggregatedGeography().ratio, ratio)
+
+    # a stale artifact is rebuilt from the csv
+    geography = AggregatedGeography()
+    geography.version = "changed"
+    pd.testing.assert_frame_equal(geography.ratio, ratio)
+    assert len(list((tmp_path / ".cache/lookup_geo/2010_to_2020").iterdir())) == 2
+
+
+def test_prune_lookups(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lookup_geo = pd.DataFrame({"geoid_tract": ["1", "2"], "nta2020": ["A", "A"]})
+    geographies = [AggregatedGeography(), AggregatedGeography()]
+    geographies[0].version = "old"
+    for geography in geographies:
+        geography.lookup_geo = lookup_geo
+        geography.ratio
+        geography.operator("geoid_tract", "nta2020")
+    path = tmp_path / ".cache/lookup_geo"
+    assert len(list(path.glob("2010_to_2020/ratio-*.pkl"))) == 2
+    assert len(list(path.glob("2020/lookup_geo/*.lock"))) == 2
+
+    version = geographies[1].version
+    deleted = prune_lookups([version])
+    assert len(deleted) == 4
+    assert [i.name for i in path.glob("2010_to_2020/*")] == [f"ratio-{version}.pkl"]
+    assert [i.name for i in path.glob("2020/lookup_geo/*")] == [
+        f"geoid_tract-nta2020-{version}"
+    ]
+    # the operator of the current version is still loaded from its artifact
+    geography = AggregatedGeography()
+    geography.lookup_geo = None
+    assert list(geography.operator("geoid_tract", "nta2020").targets) == ["A"]
+
+
+def test_read_lookup_geo(monkeypatch):
+    rng = np.random.default_rng(0)
+    n = 1000
+    csv = pd.DataFrame(
+        {
+            "geoid": [f"36005{i:06d}{i % 7:04d}" for i in range(n)],
+            "cdta2020": rng.choice(["BX01", "BX02", "BX03"], n).astype(object),
+            "fp_500": rng.choice(["0", "1"], n).astype(object),
+            "fp_100": rng.choice(["0", "1"], n).astype(object),
+            "park_access": rng.choice(["0", "1"], n).astype(object),
+        }
+    )
+    monkeypatch.setattr(pd, "read_csv", lambda *args, **kwargs: csv.copy())
+    lookup_geo = AggregatedGeography().read_lookup_geo()
+    # the derived columns as they were built row by row
+    assert lookup_geo.geoid_tract.equals(csv.geoid.apply(lambda x: str(x)[:11]))
+    assert lookup_geo.geoid_block_group.equals(csv.geoid.apply(lambda x: x[0:12]))
+    for colname, flag in [
+        ("cdta_fp_500", "fp_500"),
+        ("cdta_fp_100", "fp_100"),
+        ("cdta_park_access", "park_access"),
+    ]:
+        expected = csv.apply(
+            lambda row: row["cdta2020"] if int(row[flag]) else np.nan, axis=1
+        )
+        pd.testing.assert_series_equal(lookup_geo[colname], expected, check_names=False)
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from factfinder.median import BatchMedian, Median
+from factfinder.metadata import Metadata
+
+meta = Metadata(year=2019, source="acs")
+
+
+def sample(ranges, rows=200, seed=0):
+    """
+    bin counts with empty and missing bins, fractional counts (e.g. from
+    converting tracts to 2020 tracts), geographies concentrated in the
+    bottom bins and geographies without any counts
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 50, (rows, len(ranges))).astype("float64")
+    values[rng.random(values.shape) < 0.3] = 0
+    values[rows // 4 : rows // 2] *= rng.random((rows // 2 - rows // 4, len(ranges)))
+    values[rows // 2 : 3 * rows // 4, 2:] = 0
+    values[-5:] = 0
+    values[-20:-15, 3] = np.nan
+    values[-10:-5] = rng.integers(0, 2, (5, len(ranges)))
+    # columns in pivot (alphabetical) order, as in calculate_e_m_median
+    return pd.DataFrame(values, columns=list(ranges.keys())).sort_index(axis=1)
+
+
+def expected(ranges, df, pff_variable, *args):
+    results = [Median(ranges, row, pff_variable, *args) for _, row in df.iterrows()]
+    return (
+        np.array([i.median for i in results], dtype="float64"),
+        np.array([i.median_moe for i in results], dtype="float64"),
+    )
+
+
+@pytest.mark.parametrize("pff_variable", meta.median_variables)
+def test_batch_median(pff_variable):
+    ranges = meta.median_ranges(pff_variable)
+    df = sample(ranges)
+    for top_coding in [True, False]:
+        for bottom_coding in [True, False]:
+            args = (meta.median_design_factor(pff_variable), top_coding, bottom_coding)
+            median, median_moe = expected(ranges, df, pff_variable, *args)
+            md = BatchMedian(ranges, df, pff_variable, *args)
+            np.testing.assert_array_equal(md.median, median)
+            np.testing.assert_array_equal(md.median_moe, median_moe)
+
+
+def test_batch_median_errors():
+    ranges = meta.median_ranges("mdage")
+    df = sample(ranges)
+    df.index = [f"36005{i:06d}" for i in range(len(df))]
+    # negative counts leave no bin above p_lower, Median fails on min()
+    df.iloc[0] = 0
+    df.loc[df.index[0], "mdpop0t4"] = -1
+    with pytest.raises(ValueError):
+        Median(ranges, df.iloc[0], "mdage")
+    with pytest.raises(ValueError, match="mdage for 36005000000: no bin"):
+        BatchMedian(ranges, df, "mdage")
+    # a defined moe without an upper bin, Median fails on indexing with NaN
+    df = df.iloc[1:]
+    defined = BatchMedian(ranges, df, "mdage").median_moe
+    geoid = df.index[~np.isnan(defined)][0]
+    md = BatchMedian(ranges, df, "mdage")
+    md.upper_bin[df.index.get_loc(geoid)] = -1
+    with pytest.raises(ValueError, match=f"mdage for {geoid}: no bin"):
+        md.median_moe
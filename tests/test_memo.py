@@ -0,0 +1,51 @@
+import pickle
+
+import pandas as pd
+
+from factfinder.memo import Memo
+
+
+def frame(rows=100):
+    return pd.DataFrame({"e": range(rows), "m": range(rows)}, dtype="float64")
+
+
+def test_memo():
+    memo = Memo()
+    assert memo.get(("a",)) is None
+    df = frame()
+    memo.put(("a",), df)
+    # dataframes are copied in and out of the memo
+    df["e"] = 0
+    cached = memo.get(("a",))
+    assert cached.e.sum() == sum(range(100))
+    cached["e"] = 0
+    assert memo.get(("a",)).e.sum() == sum(range(100))
+    assert memo.stats["hits"] == 2
+    assert memo.stats["misses"] == 1
+    assert memo.stats["bytes"] == Memo.size(df)
+
+
+def test_memo_eviction():
+    size = Memo.size(frame())
+    memo = Memo(max_bytes=3 * size)
+    for key in ["a", "b", "c"]:
+        memo.put((key,), frame())
+    # "a" becomes the most recently used, "b" is evicted first
+    memo.get(("a",))
+    memo.put(("d",), frame())
+    assert ("b",) not in memo
+    assert all((i,) in memo for i in ["a", "c", "d"])
+    assert memo.stats["evictions"] == 1
+    assert memo.stats["bytes"] == 3 * size
+    # dataframes larger than the budget are not cached
+    memo.put(("e",), frame(rows=1000))
+    assert ("e",) not in memo
+    assert len(memo) == 3
+
+
+def test_memo_pickle():
+    memo = Memo(max_bytes=1000)
+    memo.put(("a",), frame(rows=10))
+    memo = pickle.loads(pickle.dumps(memo))
+    assert memo.max_bytes == 1000
+    assert len(memo) == 0
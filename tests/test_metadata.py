@@ -39,3 +39,75 @@ def test_create_census_variables():
     assert type(M_variables) == list
     assert len(E_variables) == len(M_variables)
     assert len(E_variables) == len(v.census_variable)
+
+
+def test_dependencies():
+    assert meta.dependencies("pop_1") == ["pop_1"]
+    assert "pbwpv_pct" in meta.dependencies("pbwpv")
+    assert set(meta.median_ranges("mdage").keys()) < set(meta.dependencies("mdage"))
+    assert set(meta.get_special_base_variables("wrkrnothm")) < set(
+        meta.dependencies("wrkrnothm")
+    )
+
+
+def test_fingerprint():
+    assert meta.fingerprint("mdage") == Metadata(2019, "acs").fingerprint("mdage")
+    assert meta.fingerprint("pop_1") != meta.fingerprint("mdage")
+
+    # changing one median input only changes the fingerprints depending on it
+    other = Metadata(year=2019, source="acs")
+    record = next(i for i in other.metadata if i["pff_variable"] == "mdpop0t4")
+    record["census_variable"] = record["census_variable"] + ["B01001_027"]
+    assert meta.fingerprint("mdage") != other.fingerprint("mdage")
+    assert meta.fingerprint("pop_1") == other.fingerprint("pop_1")
+
+
+def test_incidence():
+    pff_variables = ["pop_1", "mdpop65t66"]
+    E_fields, A_E, M_fields, A_M = meta.incidence(pff_variables)
+    for j, pff_variable in enumerate(pff_variables):
+        E, M, _, _ = meta.create_variable(pff_variable).census_variables
+        assert sorted(E_fields[i] for i in A_E[:, j].nonzero()[0]) == sorted(E)
+        assert sorted(M_fields[i] for i in A_M[:, j].nonzero()[0]) == sorted(M)
+    assert A_E.sum() == sum(
+        len(meta.create_variable(i).census_variable) for i in pff_variables
+    )
+
+
+def test_registry():
+    assert Metadata.load(2019, "acs") is Metadata.load(2019, "acs")
+    assert Metadata.load(2019, "acs") is not Metadata.load(2018, "acs")
+    # variables are indexed and shared
+    v = meta.create_variable("pop_1")
+    assert v is meta.create_variable("pop_1")
+    assert len(meta.variables) == len(meta.metadata)
+    for category, variables in [
+        ("profile_only", meta.profile_only_variables),
+        ("base", meta.base_variables),
+        ("median", meta.median_variables),
+        ("median_inputs", meta.median_inputs),
+        ("special", meta.special_variables),
+    ]:
+        assert variables == sorted(meta.categories[category])
+
+
+def test_compile(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Metadata, "registry", {})
+    Metadata(2019, "acs").compile()
+
+    def read_json(self, name):
+        raise AssertionError("the json files are parsed")
+
+    # the registry loads the artifact instead of parsing the json files
+    with monkeypatch.context() as m:
+        m.setattr(Metadata, "read_json", read_json)
+        loaded = Metadata.load(2019, "acs")
+        assert loaded.metadata == meta.metadata
+        assert loaded.median == meta.median
+        assert loaded.special == meta.special
+        assert loaded.categories == meta.categories
+    # the artifact of another version of the json files is not used
+    monkeypatch.setattr(Metadata, "registry", {})
+    monkeypatch.setattr(Metadata, "version", "other")
+    assert "definitions" not in vars(Metadata.load(2019, "acs"))
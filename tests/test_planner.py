@@ -0,0 +1,71 @@
+import pandas as pd
+
+from factfinder.calculate import Calculate, memoized
+
+from .stub import CensusStub
+from .test_calculate_stub import create_calculate
+
+calculate = Calculate("stub", 2019, "acs", "2010_to_2020")
+pff_variables = [
+    i["pff_variable"] for i in calculate.meta.metadata if i["base_variable"] == "pop_5"
+]
+
+
+def test_plan():
+    plan = calculate.plan(pff_variables + ["mdage", "mntrvtm"], ["NTA", "borough"])
+    report = plan.report()
+    assert report["nodes"] == len(plan.graph)
+    assert report["steps"]["output"] == 2 * (len(pff_variables) + 2)
+    # the base variable is calculated once per geotype for all numerators
+    assert len(plan.dependents[("e_m", "pop_5", "NTA")]) >= len(pff_variables) - 1
+    assert report["shared"] > 0
+    assert plan.graph[("output", "mdage", "NTA")] == [("median", "mdage", "NTA")]
+    assert ("e_m", "mdpop0t4", "NTA") in plan.graph[("median", "mdage", "NTA")]
+    assert report["critical_path"][-1][0] == "output"
+    # NTA is aggregated from CT20
+    assert plan.graph[("e_m", "pop_5", "NTA")] == [("e_m", "pop_5", "CT20")]
+    assert len(report["critical_path"]) == 5
+    # every node comes after its dependencies
+    order = {node: i for i, node in enumerate(plan.order)}
+    for node, dependencies in plan.graph.items():
+        assert all(order[i] < order[node] for i in dependencies)
+
+
+def test_calculate_many_plan(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calculated = []
+    # the undecorated method, to count calculations that miss the memo
+    calculate_e_m_uncached = Calculate.calculate_e_m.__wrapped__
+
+    def calculate_e_m(self, pff_variable, geotype):
+        calculated.append((pff_variable, geotype))
+        return calculate_e_m_uncached(self, pff_variable, geotype)
+
+    with CensusStub() as stub:
+        calculate = create_calculate(stub, tmp_path)
+        with monkeypatch.context() as m:
+            m.setattr(Calculate, "calculate_e_m", memoized("e_m")(calculate_e_m))
+            df = calculate.calculate_many(pff_variables[:10], ["borough", "city"])
+        # the e and m nodes of the plan are calculated in batches and kept
+        # in the memo until every pair is calculated
+        plan = calculate.plan(pff_variables[:10], ["borough", "city"])
+        for step, pff_variable, geotype in plan.graph:
+            if step == "e_m":
+                assert (
+                    calculate.memo_key("e_m", pff_variable, geotype) in calculate.memo
+                )
+        assert calculated == []
+        assert calculate.memo.stats["evictions"] == 0
+
+        # calculate the same variables one by one, without the batches
+        (tmp_path / "direct").mkdir()
+        monkeypatch.chdir(tmp_path / "direct")
+        calculate = create_calculate(stub, tmp_path)
+        expected = pd.concat(
+            [
+                calculate(pff_variable, geotype)
+                for pff_variable in pff_variables[:10]
+                for geotype in ["borough", "city"]
+            ]
+        )
+    pd.testing.assert_frame_equal(df, expected)
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from factfinder.metadata import Metadata
+from factfinder.special import Formula, evaluate
+
+from .legacy import hovacrtm, legacy_special
+
+meta = Metadata(year=2019, source="acs")
+
+
+def base_frame(pff_variables: list, n: int = 200) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    dfs = []
+    for pff_variable in pff_variables:
+        e = rng.integers(0, 50, n).astype(float)
+        e[:10] = 0
+        e[10:15] = np.nan
+        m = rng.random(n) * 30
+        dfs.append(
+            pd.DataFrame(
+                {
+                    "census_geoid": [f"{i:05d}" for i in range(n)],
+                    "pff_variable": pff_variable,
+                    "e": e,
+                    "m": m,
+                }
+            )
+        )
+    return pd.concat(dfs, ignore_index=True)
+
+
+def test_special_formulas():
+    assert set(meta.formulas) == set(meta.special_variables)
+
+
+def test_hovacrt():
+    df = base_frame(["hovacu", "vacsale"])
+    output = evaluate(df, [meta.formulas["hovacrt"]])
+    pivoted = df.pivot(index="census_geoid", columns="pff_variable", values=["e", "m"])
+    e = 100 * pivoted.e.vacsale / pivoted.e.hovacu
+    m = [
+        hovacrtm(*i)
+        for i in zip(
+            pivoted.e.hovacu, pivoted.e.vacsale, pivoted.m.vacsale, pivoted.m.hovacu
+        )
+    ]
+    assert list(output.census_geoid) == list(pivoted.index)
+    np.testing.assert_array_equal(output.e, e.where(e != 0))
+    np.testing.assert_array_equal(output.m, m)
+
+
+@pytest.mark.parametrize("pff_variable", list(meta.formulas))
+def test_formula_legacy(pff_variable):
+    # every formula in special.json matches the function it replaced
+    formula = meta.formulas[pff_variable]
+    df = base_frame(formula.base_variables)
+    output = evaluate(df, [formula])
+    legacy = legacy_special[pff_variable](df, formula.base_variables)
+    assert list(output.census_geoid) == list(legacy.census_geoid)
+    np.testing.assert_allclose(output.e, legacy.e)
+    np.testing.assert_allclose(output.m, legacy.m)
+
+
+def test_evaluate_batch():
+    # wrkrnothm is evaluated first and used by mntrvtm
+    df = base_frame(["agttm", "wrkr16pl", "cw_wrkdhm"])
+    output = evaluate(df, [meta.formulas["mntrvtm"], meta.formulas["wrkrnothm"]])
+    assert list(output.pff_variable.unique()) == ["wrkrnothm", "mntrvtm"]
+    wrkrnothm = evaluate(df, [meta.formulas["wrkrnothm"]])
+    mntrvtm = evaluate(
+        pd.concat([df, wrkrnothm]), [meta.formulas["mntrvtm"]]
+    ).reset_index(drop=True)
+    pd.testing.assert_frame_equal(
+        output.loc[output.pff_variable == "mntrvtm"].reset_index(drop=True), mntrvtm
+    )
+
+
+@pytest.mark.parametrize(
+    "expression",
+    ["__import__('os')", "pop_1e.real", "[pop_1e]", "open(pop_1e)", "unknown + 1"],
+)
+def test_formula_invalid(expression):
+    with pytest.raises(ValueError):
+        Formula(
+            {
+                "pff_variable": "invalid",
+                "base_variables": ["pop_1"],
+                "e": expression,
+                "m": "pop_1m",
+            }
+        )
@@ -0,0 +1,66 @@
+import pickle
+
+import pandas as pd
+import pytest
+
+from factfinder.download import Download
+from factfinder.store import Store
+from factfinder.transport import FixtureNotFound
+
+from .stub import CensusStub
+
+year = 2019
+source = "acs"
+geography = "2010_to_2020"
+
+
+def create_download(tmp_path, transport, api_key="stub"):
+    d = Download(
+        api_key,
+        year=year,
+        source=source,
+        geography=geography,
+        transport=transport,
+        fixtures=tmp_path / "fixtures",
+    )
+    d.store = Store(year, source, base_path=tmp_path / transport)
+    return d
+
+
+def test_record_replay(tmp_path):
+    with CensusStub() as stub:
+        d = stub.attach(create_download(tmp_path, "record"))
+        recorded = d("tract", "lgoenlep1")
+    # the stub server is down, and no api key is needed to replay
+    d = create_download(tmp_path, "replay", api_key=None)
+    replayed = d("tract", "lgoenlep1")
+    pd.testing.assert_frame_equal(recorded, replayed)
+
+
+def test_pickle_replay(tmp_path):
+    with CensusStub() as stub:
+        d = stub.attach(create_download(tmp_path, "record"))
+        recorded = d("tract", "lgoenlep1")
+    # e.g. a Download sent to a worker process
+    d = pickle.loads(pickle.dumps(create_download(tmp_path, "replay")))
+    transport = d.session.get_adapter("https://api.census.gov")
+    assert (transport.mode, transport.path) == ("replay", tmp_path / "fixtures")
+    pd.testing.assert_frame_equal(recorded, d("tract", "lgoenlep1"))
+
+
+def test_replay_missing_fixture(tmp_path):
+    d = create_download(tmp_path, "replay")
+    with pytest.raises(FixtureNotFound):
+        d("borough", "pop_1")
+
+
+def test_fixture_key():
+    d = Download("stub", year=year, source=source, geography=geography)
+    transport = d.session.get_adapter("https://api.census.gov")
+    url = "https://api.census.gov/data/2019/acs/acs5/profile"
+    a = transport.fixture_path(f"{url}?get=NAME&for=county:005&in=state:36&key=a")
+    b = transport.fixture_path(f"{url}?key=b&in=state:36&get=NAME&for=county:005")
+    c = transport.fixture_path(f"{url}?get=NAME&for=county:047&in=state:36&key=a")
+    assert a == b
+    assert a != c
+    assert a.parent.parent.name == "acs_acs5_profile"
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from factfinder.utils import (
+    get_c,
+    get_c_array,
+    get_p,
+    get_p_array,
+    get_z,
+    get_z_array,
+    rounding,
+)
+
+from .legacy import c_p_z, create_c_p_z, legacy_c_p_z
+
+
+def test_c_p_z_arrays():
+    df = create_c_p_z(rows=1000)
+    pd.testing.assert_frame_equal(legacy_c_p_z(df.copy()), c_p_z(df.copy()))
+
+
+def test_c_p_z_edge_cases():
+    nan = np.nan
+    cases = [
+        # e, m, p, agg_e, agg_m
+        (0, 5, 0, 10, 2),
+        (10, 5, 100, 10, 2),
+        (10, 5, 50, 0, 2),
+        (10, 1, 50, 20, 30),
+        (10, 30, 50, 20, 1),
+        (nan, 5, nan, 10, 2),
+        (10, nan, 50, 20, nan),
+        (10, 5, nan, nan, 2),
+    ]
+    for e, m, p, agg_e, agg_m in cases:
+        np.testing.assert_equal(get_c_array([e], [m])[0], get_c(e, m))
+        np.testing.assert_equal(get_p_array([e], [agg_e])[0], get_p(e, agg_e))
+        np.testing.assert_equal(
+            get_z_array([e], [m], [p], [agg_e], [agg_m])[0],
+            get_z(e, m, p, agg_e, agg_m),
+        )
+
+
+def test_rounding_digits():
+    df = create_c_p_z(rows=100)
+    df = pd.DataFrame({i: df.e * 1.23456 for i in ["c", "e", "m", "p", "z"]})
+    digits = pd.Series([0, 1, 2, 0] * 25)
+    expected = pd.concat(
+        [rounding(df[digits == i].copy(), i) for i in [0, 1, 2]]
+    ).sort_index()
+    pd.testing.assert_frame_equal(rounding(df.copy(), digits), expected)